@@ -0,0 +1,71 @@
+# hybrid_dict_cache の S3 に保存する形式 (codec) ごとのサイズと encode/decode 時間のベンチマーク
+# 実行方法: . ./env && python benchmarks/bench_cache_codec.py
+import json
+import random
+import time
+from datetime import date
+
+from slot import SLOT_COUNT, Slot
+from util import CACHE_CODECS
+
+FAMILY_NAMES = ["山田", "佐藤", "鈴木", "高橋", "田中", "伊藤", "渡辺", "中村", "小林", "加藤"]
+GIVEN_NAMES = ["花子", "太郎", "一郎", "京子", "美咲", "健太", "陽子", "大輔"]
+GROUPS = ["囲碁クラブ", "太極拳の会", "民謡保存会", "子ども会", "老人会", "ヨガ教室", "書道サークル", "合唱団"]
+
+
+# 1か月分の予約 (report.make_month_dataset が返す形) を作る
+def make_month_dataset(year: int, month: int, access_guests: int, seed: int = 0) -> dict:
+    rng = random.Random(seed)
+    first = date(year, month, 1).toordinal()
+    items = []
+    for group in GROUPS:
+        weekday = rng.randrange(7)
+        index = rng.randrange(SLOT_COUNT)
+        for ordinal in range(first, first + 31):
+            if (ordinal + 6) % 7 == weekday:
+                items.append([Slot(ordinal, index).key, "access_user", group, "定期予約(町内会公認団体)"])
+    for _i in range(access_guests):
+        family = rng.choice(FAMILY_NAMES)
+        name = f"{family}{rng.choice(GIVEN_NAMES)}"
+        block = f"{rng.randint(1, 9)}ブロック {rng.randint(1, 12)}組 {family}"
+        ordinal = first + rng.randrange(31)
+        start = rng.randrange(SLOT_COUNT)
+        for index in range(start, min(SLOT_COUNT, start + rng.randint(1, 2))):
+            items.append([Slot(ordinal, index).key, "access_guest", name, block])
+    return {"year": year, "month": month, "items": items}
+
+
+# 以前の形式 (reservation の一覧をそのままキャッシュしたもの)
+def make_reservation_list(dataset: dict) -> list:
+    ret = []
+    for key, _type, name, block in dataset["items"]:
+        slot = Slot.from_key(key)
+        ret.append({"start_time": slot.start_time_iso, "date": slot.iso_date, "timeslot": slot.timeslot, "name": name, "block": block})
+    return ret
+
+
+def bench(func, repeat: int = 50) -> float:
+    best = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main() -> None:
+    print(f"{'payload':<28} {'codec':<10} {'bytes':>9} {'ratio':>6} {'encode':>10} {'decode':>10}")
+    for access_guests in (50, 200, 800):
+        dataset = make_month_dataset(2024, 5, access_guests)
+        for label, data in ((f"month dataset ({access_guests} guests)", dataset), (f"reservation ({access_guests} guests)", make_reservation_list(dataset))):
+            raw = len(json.dumps(data, ensure_ascii=False).encode("utf-8"))
+            for name, (compress, decompress) in CACHE_CODECS.items():
+                body = compress(json.dumps(data, ensure_ascii=False).encode("utf-8"))
+                encode = bench(lambda: compress(json.dumps(data, ensure_ascii=False).encode("utf-8")))
+                decode = bench(lambda: json.loads(decompress(body).decode("utf-8")))
+                print(f"{label:<28} {name:<10} {len(body):>9} {len(body) / raw:>6.2f} {encode * 1000:>7.2f} ms {decode * 1000:>7.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+# access user の予約パターン展開 (RemoteLock.make_calendar_list) のベンチマーク
+# 実行方法: . ./env && python benchmarks/bench_calendar.py
+import random
+import time
+from datetime import datetime
+
+from remotelock import RemoteLock, compile_access_rules, expand_access_rules
+
+DAYS = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
+SLOTS = [["05:00", "09:00"], ["09:00", "13:00"], ["13:00", "17:00"], ["17:00", "21:00"]]
+
+
+def make_access_info_list(rnd: random.Random, rule_count: int, unused_count: int) -> list[dict]:
+    ret = []
+    for _ in range(rule_count):
+        slot = []
+        for s in rnd.sample(SLOTS, rnd.randint(1, 2)):
+            slot.extend(s)
+        ret.append({"day": rnd.choice(DAYS), "slot": slot, "week": rnd.sample([1, 2, 3, 4, 5], rnd.randint(1, 2))})
+    for _ in range(unused_count):
+        ret.append({"unused-date": f"{rnd.randint(2024, 2027)}-{rnd.randint(1, 12):02}-{rnd.randint(1, 28):02}"})
+    return ret
+
+
+def bench(label: str, users: list[list[dict]], day_range: int, repeat: int = 5) -> None:
+    start_day = datetime(2024, 1, 1)
+    remotelock = RemoteLock()
+
+    best = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        for access_info_list in users:
+            remotelock.make_calendar_list(access_info_list, start_day, day_range)
+        elapsed = time.perf_counter() - t0
+        best = elapsed if best is None else min(best, elapsed)
+
+    compiled = [compile_access_rules(access_info_list) for access_info_list in users]
+    best_compiled = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        for c in compiled:
+            expand_access_rules(c, start_day, day_range)
+        elapsed = time.perf_counter() - t0
+        best_compiled = elapsed if best_compiled is None else min(best_compiled, elapsed)
+
+    print(f"{label:<28} users={len(users):>4} days={day_range:>5}  compile+expand={best * 1000:8.2f} ms  expand only={best_compiled * 1000:8.2f} ms")
+
+
+def main() -> None:
+    rnd = random.Random(0)
+    for user_count in (10, 100, 500):
+        users = [make_access_info_list(rnd, rnd.randint(1, 4), rnd.randint(0, 40)) for _ in range(user_count)]
+        bench("1 year", users, 365)
+        bench("3 years", users, 365 * 3)
+        bench("10 years", users, 365 * 10, repeat=2)
+
+
+if __name__ == "__main__":
+    main()
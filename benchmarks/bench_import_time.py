@@ -0,0 +1,59 @@
+# Lambda のコールドスタートで各 handler のモジュールを読み込む時間のベンチマーク (python -X importtime)
+# 実行方法: . ./env && python benchmarks/bench_import_time.py [--repeat N] [--top N]
+# モジュールごとに新しいプロセスで読み込み、N 回のうち最短の結果を表示する。
+# 重いライブラリ (HEAVY_PACKAGES) はどのモジュールから読み込まれたかに関わらず、読み込まれていればその時間を表示する。
+import argparse
+import os
+import subprocess
+import sys
+
+# template.yaml の Handler ごとのモジュール
+HANDLER_MODULES = {
+    "ReservaRequestFunction / CreateAccessFunction": "app",
+    "ReportFunction / ReportPrewarmFunction": "report",
+    "StoreBatchFunction": "storebatch",
+}
+HEAVY_PACKAGES = ["boto3", "botocore", "aws_lambda_powertools", "requests", "gspread", "bs4", "numpy", "pandas", "dateutil"]
+
+
+# -X importtime の出力 "import time: self [us] | cumulative | imported package" を (深さ, 名前, cumulative) のリストにする
+def parse_importtime(stderr: str) -> list[tuple[int, str, int]]:
+    ret = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        _self, cumulative, name = line[len("import time:") :].split("|")
+        depth = (len(name) - len(name.lstrip(" ")) - 1) // 2
+        ret.append((depth, name.strip(), int(cumulative)))
+    return ret
+
+
+def measure(module: str) -> list[tuple[int, str, int]]:
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "reserva_request")
+    r = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], env=env, capture_output=True, text=True)
+    if r.returncode != 0:
+        raise RuntimeError(f"import {module} failed: {r.stderr.splitlines()[-1]}")
+    return parse_importtime(r.stderr)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--top", type=int, default=8)
+    args = parser.parse_args()
+
+    for function, module in HANDLER_MODULES.items():
+        runs = [measure(module) for _ in range(args.repeat)]
+        best = min(runs, key=lambda r: next(c for d, n, c in r if d == 0 and n == module))
+        total = next(c for d, n, c in best if d == 0 and n == module)
+        print(f"{function:<46} import {module:<11} {total / 1000:8.1f} ms")
+        heavy = {n: c for d, n, c in best if n in HEAVY_PACKAGES}
+        print("    heavy: " + (", ".join(f"{n} {c / 1000:.1f} ms" for n, c in heavy.items()) or "-"))
+        # handler のモジュールが直接読み込んだもの (深さ 1) の上位
+        children = sorted(((c, n) for d, n, c in best if d == 1), reverse=True)[: args.top]
+        print("    direct: " + ", ".join(f"{n} {c / 1000:.1f} ms" for c, n in children))
+
+
+if __name__ == "__main__":
+    main()
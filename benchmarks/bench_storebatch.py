@@ -0,0 +1,75 @@
+# storebatch の月次テーブル作成のベンチマーク (コールドスタートと1ヶ月分の作成時間)
+# 実行方法: . ./env && python benchmarks/bench_storebatch.py
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from used_data import COLUMNS, UsedDataTable, encode_partition
+
+ROWS = 31 * 4
+
+
+def cold_import(module: str, repeat: int = 3) -> float:
+    best = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        subprocess.run([sys.executable, "-c", f"import {module}"], check=True, env=os.environ)
+        elapsed = time.perf_counter() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def make_rows() -> list[tuple[str, list]]:
+    rows = []
+    for day in range(31):
+        for index in range(4):
+            iso = f"2024-05-{day + 1:02}"
+            rows.append((f"{day}-{index + 1}", [f"{iso}T09:00:00.000000", f"{iso}T13:00:00.000000", "a@example.com", "1ブロック", "1組", "False", "False", "山田", "山田花子 <X>", "会議"]))
+    return rows
+
+
+def bench(label: str, func, repeat: int = 20) -> None:
+    best = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    print(f"{label:<46} {best * 1000:8.2f} ms")
+
+
+def main() -> None:
+    print(f"{'cold start: python only':<46} {cold_import('sys') * 1000:8.2f} ms")
+    print(f"{'cold start: import used_data':<46} {cold_import('used_data') * 1000:8.2f} ms")
+    print(f"{'cold start: import pandas':<46} {cold_import('pandas') * 1000:8.2f} ms")
+
+    import pandas as pd
+
+    rows = make_rows()
+    tmpdir = tempfile.mkdtemp()
+
+    def loc_append():
+        df = pd.DataFrame(index=[], columns=COLUMNS)
+        for label, row in rows:
+            df.loc[label] = row
+        df.to_pickle(f"{tmpdir}/loc.pkl")
+
+    def columnar(write):
+        def run():
+            table = UsedDataTable()
+            for label, row in rows:
+                table.append(label, row)
+            write(table)
+
+        return run
+
+    print(f"per month build ({ROWS} rows)")
+    bench("DataFrame.loc append + to_pickle", loc_append, repeat=5)
+    bench("UsedDataTable + write_pickle", columnar(lambda t: t.write_pickle(f"{tmpdir}/table.pkl")))
+    bench("UsedDataTable + encode_partition (no pandas)", columnar(lambda t: encode_partition(t, 2024, 5)))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,10 @@
 from remotelock import RemoteLock
+from slot import Slot
 from util import GSpreadsheetUtil
 from typing import Any
 import requests
 from bs4 import BeautifulSoup
-from aws_lambda_powertools.utilities import parameters
+from config import get_config
 from aws_lambda_powertools import Logger
 from aws_lambda_powertools.utilities.typing import LambdaContext
 
@@ -13,7 +14,7 @@ import base64
 import urllib.parse
 import re
 import hashlib
-from util import ret_json, error_json
+from util import ret_json, error_json, invalidate_cache_tags, month_tag
 
 # logger についてはここに書いておかないと初期化時の injection でエラーになる。
 logger = Logger()
@@ -23,7 +24,7 @@ session = None
 
 
 def get_reserva_parameters():
-    reserva_system_info = parameters.get_parameter("reserva_systeminfo", transform="json")
+    reserva_system_info = get_config().reserva_systeminfo
     return (
         reserva_system_info["bus_id"],
         reserva_system_info["svd_id"],
@@ -54,7 +55,7 @@ def reserva_login():
         "Referer": "https://www.google.com/",
     }
     session.headers = headers
-    reserva_userinfo = parameters.get_parameter("reserva_userinfo", transform="json")
+    reserva_userinfo = get_config().reserva_userinfo
     reserva_userid = reserva_userinfo["userid"]
     reserva_pass = reserva_userinfo["password"]
     r = session.get("https://reserva.be/rsv/dashboard")
@@ -209,6 +210,19 @@ def append_log_to_spreadsheet(rsv_info, registered_info, log_info):
     sheet.append_row(row)
 
 
+# 予約を変更した月のレポートのキャッシュを無効化する。days は "YYYY/MM/DD" か "YYYY-MM-DD" で始まる文字列
+# 無効化に失敗しても予約の処理は終わっているので、ログに残すだけにする
+def invalidate_report_cache(days: list[str]) -> None:
+    tags = sorted({month_tag(int(day[:4]), int(day[5:7])) for day in days})
+    if len(tags) == 0:
+        return
+    try:
+        invalidate_cache_tags(tags)
+        logger.info({"service": "report_cache", "command": "invalidate", "tags": tags})
+    except Exception:
+        logger.exception(f"failed to invalidate report cache. tags={tags}")
+
+
 # 引数として Reserva の予約申請メールに記載されている確認用の URL が必要
 
 
@@ -249,6 +263,8 @@ def handler(event: dict, context: LambdaContext) -> dict[str, Any]:
 
     rsv_info = None
     registered_info = None
+    # RemoteLock の access guest を登録/キャンセルしたら True
+    booking_changed: bool = False
     try:
         rsv_info = get_reservation_info_from_reserva(reserva_url)
         registered_info = GSpreadsheetUtil.get_registered_info_from_spreadsheet(workbook, rsv_info["email"])
@@ -288,6 +304,7 @@ def handler(event: dict, context: LambdaContext) -> dict[str, Any]:
                     # 鍵番号を発行してから Approve する
                     log_info.append("request: approve")
                     key_no = remotelock.register_guest()
+                    booking_changed = True
                     approve_status = approve(rsv_info["hidden_rsv_no"], key_no)
                     log_info.append(approve_status)
                     if approve_status != "success":
@@ -314,6 +331,7 @@ def handler(event: dict, context: LambdaContext) -> dict[str, Any]:
                 log_info.append("正しくキャンセルされていません")
             # Reserva は既にキャンセルされているので何もしなくて良くて、RemoteLock のキャンセルのみを行う
             if remotelock.cancel_guest():
+                booking_changed = True
                 log_info.append("success")
             else:
                 log_info.append("RemoteLock側で既にキャンセルされています。")
@@ -330,13 +348,17 @@ def handler(event: dict, context: LambdaContext) -> dict[str, Any]:
         if rsv_info and registered_info:
             append_log_to_spreadsheet(rsv_info, registered_info, log_info)
         raise
+    finally:
+        # approve やスプレッドシートへの追記が例外になっても、RemoteLock を変更していればキャッシュを無効化する
+        if booking_changed:
+            invalidate_report_cache([rsv_info["rsv_time"]])
 
     append_log_to_spreadsheet(rsv_info, registered_info, log_info)
 
     return ret_json(response_code, {"log": log_info})
 
 
-def reserva_check_reservation(schedule: dict):
+def reserva_check_reservation(schedule: Slot):
     params = {
         "cmd": "reserva_admin_check",
         "checkflg": 1,
@@ -344,7 +366,7 @@ def reserva_check_reservation(schedule: dict):
         "rsv_svd_no": RESERVA_SVD_ID,
         "rsv_stf_cd": "undefined",
         "all_day_flag": 0,
-        "reserve_time": f'{schedule["start_time"]}:0@{schedule["end_time"]}:0@',
+        "reserve_time": f"{schedule.start_time}:0@{schedule.end_time}:0@",
         "bus_cd": RESERVA_BUS_ID,
         "rsd_room_no": "",
         "rsd_sec_no": "undefined",
@@ -364,7 +386,7 @@ def reserva_check_reservation(schedule: dict):
         return None
 
 
-def reserva_make_reservation(user: dict, schedule: dict, check_param: dict):
+def reserva_make_reservation(user: dict, schedule: Slot, check_param: dict):
     # 時間区分を表す svd_sub_no という数字を抽出する
     r = session.get(f"https://reserva.be/rsv/reservations?mode=list_add&callback_url=https://reserva.be/rsv/reservations/calendar")
     r = session.post(
@@ -373,7 +395,7 @@ def reserva_make_reservation(user: dict, schedule: dict, check_param: dict):
             "cmd": "get_institution_reserve_time",
             "ist_no": RESERVA_SVD_ID,
             "reserve_unit": "reserve_time",
-            "reserve_date": schedule["day"],
+            "reserve_date": schedule.day,
             "rst_data_since": "",
             "rsv_data_until": "",
         },
@@ -388,7 +410,7 @@ def reserva_make_reservation(user: dict, schedule: dict, check_param: dict):
     time_input_list = soup.find_all("input", attrs={"name": "rsv_svd_start_time[]", "type": "hidden"})
     rsv_svd_subno = -1
     for item in time_input_list:
-        if f'{schedule["start_time"]}:00' == item["value"]:
+        if f"{schedule.start_time}:00" == item["value"]:
             rsv_svd_subno = int(re.sub(r"\D", "", item["id"]))  # 数字だけを残す
     if rsv_svd_subno < 0:
         logger.error(
@@ -440,16 +462,16 @@ def reserva_make_reservation(user: dict, schedule: dict, check_param: dict):
             "rsv_svd_no": RESERVA_SVD_ID,
             "rsd_group_people": 1,
             "select_timeorday": 1,
-            "rsv_data": schedule["day"],
-            "rsv_svd_start_time[]": f"{schedule['day']} 05:00:00",
-            "rsv_svd_end_time[]": f"{schedule['day']} 09:00:00",
-            "rsv_svd_start_time[]": f"{schedule['day']} 09:00:00",
-            "rsv_svd_end_time[]": f"{schedule['day']} 13:00:00",
-            "rsv_svd_start_time[]": f"{schedule['day']} 13:00:00",
-            "rsv_svd_end_time[]": f"{schedule['day']} 17:00:00",
-            "rsv_svd_start_time[]": f"{schedule['day']} 17:00:00",
-            "rsv_svd_end_time[]": f"{schedule['day']} 21:00:00",
-            "rsv_svd_no|rsv_svd_subno[]": f"{RESERVA_SVD_ID}|{rsv_svd_subno}|{schedule['start_time']}:00|{schedule['end_time']}:00|0",
+            "rsv_data": schedule.day,
+            "rsv_svd_start_time[]": f"{schedule.day} 05:00:00",
+            "rsv_svd_end_time[]": f"{schedule.day} 09:00:00",
+            "rsv_svd_start_time[]": f"{schedule.day} 09:00:00",
+            "rsv_svd_end_time[]": f"{schedule.day} 13:00:00",
+            "rsv_svd_start_time[]": f"{schedule.day} 13:00:00",
+            "rsv_svd_end_time[]": f"{schedule.day} 17:00:00",
+            "rsv_svd_start_time[]": f"{schedule.day} 17:00:00",
+            "rsv_svd_end_time[]": f"{schedule.day} 21:00:00",
+            "rsv_svd_no|rsv_svd_subno[]": f"{RESERVA_SVD_ID}|{rsv_svd_subno}|{schedule.start_time}:00|{schedule.end_time}:00|0",
             "rsv_payment": 0,
             "rsv_text": "システムによる予約",
             "rsv_memo": "",
@@ -463,16 +485,20 @@ def reserva_make_reservation(user: dict, schedule: dict, check_param: dict):
             "service": "reserva",
             "command": "create_reservation",
             "name": user["name"],
-            "schedule": schedule,
+            "schedule": str(schedule),
         }
     )
 
 
-def reserva_create_reservation(user: dict, target_list: list):
+# 予約した枠のリストを返す
+def reserva_create_reservation(user: dict, target_list: list[Slot]) -> list[Slot]:
+    ret = []
     for target in target_list:
         check_param = reserva_check_reservation(target)
         if check_param:
             reserva_make_reservation(user, target, check_param)
+            ret.append(target)
+    return ret
 
 
 @logger.inject_lambda_context(log_event=True)
@@ -486,12 +512,21 @@ def batch_handler(event: dict, context: LambdaContext) -> dict[str, Any]:
     # Book Automation
     users: list[dict] = remotelock.get_users(datetime.now(), RESERVA_DAY_RANGE)
     reserva_login()
-    for user in users:
-        target_list = user["timeslots"]
-        exception_list = user["exception_timeslots"]
-        if len(target_list) > 0:
-            reserva_create_reservation(user, target_list)
-        if len(exception_list) > 0:
-            remotelock.update_access_exceptions(user, exception_list)
+    reserved: list[Slot] = []
+    # RemoteLock のアクセス不可日を更新した日 (YYYY-MM-DD)
+    exception_days: list[str] = []
+    try:
+        for user in users:
+            target_list = user["timeslots"]
+            exception_list = user["exception_timeslots"]
+            if len(target_list) > 0:
+                reserved.extend(reserva_create_reservation(user, target_list))
+            if len(exception_list) > 0:
+                remotelock.update_access_exceptions(user, exception_list)
+                exception_days.extend(exception["start_date"] for exception in exception_list)
+    finally:
+        # 途中で Reserva の予約が例外になっても、それまでに更新したアクセス不可日の月は無効化する
+        # 古い access guest の削除では無効化しない (過去の月のキャッシュは削除前の内容を残しておく)
+        invalidate_report_cache(exception_days + [slot.day for slot in reserved])
 
     return ret_json(200, {"message": "finished normally"})
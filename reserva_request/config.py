@@ -0,0 +1,101 @@
+from aws_lambda_powertools import Logger
+from typing import Any, Callable, NamedTuple
+import json
+import os
+import threading
+import time
+import boto3
+
+logger = Logger()
+
+
+# SSM パラメータストアの設定値。名前はパラメータ名と同じ
+class Config(NamedTuple):
+    reserva_systeminfo: dict[str, Any]  # bus_id, svd_id, day_range, auth_token
+    reserva_userinfo: dict[str, Any]  # userid, password
+    ichiba_google_apikey: dict[str, Any]  # サービスアカウントの鍵
+    ichiba_google_spreadsheet_key: str
+    reserva_bucket_info: str  # S3 のバケット名
+    remotelock_buffer_min: int  # 鍵を予約の何分前から有効にするか
+    remotelock_expired_days_for_access_guest: int
+    remotelock_clientkey: dict[str, Any]  # client_id, client_secret
+    remotelock_token: dict[str, Any]  # access_token, refresh_token, expires_at
+
+
+# JSON のパラメータ。上書き用のファイルでは JSON の文字列でもオブジェクトでもよい
+def decode_json(value: Any) -> dict[str, Any]:
+    return json.loads(value) if isinstance(value, str) else value
+
+
+# パラメータごとの値の変換。JSON は読み込んだときに一度だけ解析する
+CONFIG_DECODERS: dict[str, Callable[[Any], Any]] = {
+    "reserva_systeminfo": decode_json,
+    "reserva_userinfo": decode_json,
+    "ichiba_google_apikey": decode_json,
+    "ichiba_google_spreadsheet_key": str,
+    "reserva_bucket_info": str,
+    "remotelock_buffer_min": int,
+    "remotelock_expired_days_for_access_guest": int,
+    "remotelock_clientkey": decode_json,
+    "remotelock_token": decode_json,
+}
+
+# 読み込んだ設定を使い続ける秒数
+CONFIG_TTL = 300
+
+# オフラインでの実行やテスト用の上書き
+# - 環境変数 RESERVA_CONFIG_FILE に JSON ファイル ({パラメータ名: 値}) のパスを指定する
+# - 環境変数 RESERVA_CONFIG_<パラメータ名の大文字> で1つずつ指定する (ファイルより優先)
+# 全てのパラメータが上書きされていれば SSM にはアクセスしない
+CONFIG_FILE_ENV = "RESERVA_CONFIG_FILE"
+CONFIG_ENV_PREFIX = "RESERVA_CONFIG_"
+
+config_lock = threading.Lock()
+config_cache: tuple[Config, float] = None
+
+
+def read_overrides() -> dict[str, Any]:
+    ret = {}
+    path = os.environ.get(CONFIG_FILE_ENV)
+    if path:
+        with open(path, encoding="utf-8") as f:
+            ret.update({name: value for name, value in json.load(f).items() if name in Config._fields})
+    for name in Config._fields:
+        value = os.environ.get(CONFIG_ENV_PREFIX + name.upper())
+        if value is not None:
+            ret[name] = value
+    return ret
+
+
+# 上書きされていないパラメータを GetParameters 1回でまとめて読む (1回に10個まで)
+def fetch_parameters(names: list[str]) -> dict[str, str]:
+    if len(names) == 0:
+        return {}
+    res = boto3.client("ssm").get_parameters(Names=names, WithDecryption=True)
+    if len(res["InvalidParameters"]) > 0:
+        raise RuntimeError(f"SSM parameters not found: {res['InvalidParameters']}")
+    return {p["Name"]: p["Value"] for p in res["Parameters"]}
+
+
+def load_config() -> Config:
+    values = read_overrides()
+    fetched = fetch_parameters([name for name in Config._fields if not name in values])
+    logger.info({"service": "config", "fetched": len(fetched), "overridden": len(values)})
+    values.update(fetched)
+    return Config(**{name: CONFIG_DECODERS[name](values[name]) for name in Config._fields})
+
+
+# 設定を返す。読み込んでから CONFIG_TTL 秒を過ぎているか force_fetch を指定した場合は読み直す
+def get_config(force_fetch: bool = False) -> Config:
+    global config_cache
+    with config_lock:
+        if force_fetch or config_cache is None or time.monotonic() - config_cache[1] > CONFIG_TTL:
+            config_cache = (load_config(), time.monotonic())
+        return config_cache[0]
+
+
+# 次の get_config で読み直させる (パラメータを書き換えた後など)
+def clear_config() -> None:
+    global config_cache
+    with config_lock:
+        config_cache = None
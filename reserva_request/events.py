@@ -0,0 +1,118 @@
+from used_data import get_json, iter_months, month_key
+from slot import iso_ordinal, MINUTES_PER_DAY
+from typing import Any
+from datetime import date, datetime
+import json
+
+# 解錠イベントの列。minute は occurred_at (ローカル時刻) を 1970-01-01 0時からの分にしたもの
+EVENT_COLUMNS = ["id", "occurred_at", "minute", "event_type", "status", "user_type", "user_id"]
+
+# イベントストアの形式のバージョン。形式を変えたら上げる
+EVENT_SCHEMA_VERSION = 1
+EVENT_ROOT = f"events/v{EVENT_SCHEMA_VERSION}"
+WATERMARK_KEY = f"{EVENT_ROOT}/_watermark.json"
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+"""
+イベントストア (EVENT_ROOT/)
+  YYYY-MM.json   : 発生した月ごとのイベント。列ごとのリストで、occurred_at の順に並べる
+  _watermark.json: 取り込んだイベントの最新の occurred_at と、取り込みが済んだ月 (months)
+更新では RemoteLock から watermark 以降のイベントだけを読み、該当する月のファイルに id で重複を除いて追加する。
+watermark と同じ時刻のイベントは再度読まれるが、id で除かれる。watermark は月のファイルを書いた後で更新するので、
+途中で失敗しても次の更新で同じイベントから読み直せる。
+イベントが1件も無かった月は月のファイルができないので、取り込みが済んだ月を months に記録し、イベントの無い月と区別する。
+"""
+
+
+def iso_minute(dt: str) -> int:
+    return (iso_ordinal(dt) - EPOCH_ORDINAL) * MINUTES_PER_DAY + int(dt[11:13]) * 60 + int(dt[14:16])
+
+
+def event_month_key(year: int, month: int) -> str:
+    return f"{EVENT_ROOT}/{month_key(year, month)}.json"
+
+
+def empty_event_columns() -> dict[str, list]:
+    return {column: [] for column in EVENT_COLUMNS}
+
+
+# 月のイベントを読む。まだ無い月は None
+def read_event_month(s3bucket, year: int, month: int) -> dict[str, list]:
+    data = get_json(s3bucket, event_month_key(year, month))
+    if data is None:
+        return None
+    return data["columns"]
+
+
+def write_event_month(s3bucket, year: int, month: int, columns: dict[str, list]) -> None:
+    body = {"schema_version": EVENT_SCHEMA_VERSION, "num_rows": len(columns["id"]), "columns": columns}
+    s3bucket.Object(event_month_key(year, month)).put(Body=json.dumps(body, ensure_ascii=False), ContentType="application/json")
+
+
+# 月のイベントに新しいイベントを追加する。追加したイベントの数を返す
+def merge_events(columns: dict[str, list], events: list[dict]) -> int:
+    known = set(columns["id"])
+    added = [e for e in events if not e["id"] in known]
+    if len(added) == 0:
+        return 0
+    rows = list(zip(*(columns[column] for column in EVENT_COLUMNS)))
+    rows.extend(tuple(iso_minute(e["occurred_at"]) if column == "minute" else e[column] for column in EVENT_COLUMNS) for e in added)
+    rows.sort(key=lambda row: (row[1], row[0]))
+    for i, column in enumerate(EVENT_COLUMNS):
+        columns[column] = [row[i] for row in rows]
+    return len(added)
+
+
+# RemoteLock から前回以降のイベントを取り込む。today までの月を取り込みが済んだ月にする
+def update_event_store(s3bucket, remotelock, today: date = None) -> dict[str, Any]:
+    if today is None:
+        today = date.today()
+    watermark = get_json(s3bucket, WATERMARK_KEY) or {}
+    since: str = watermark.get("occurred_at", "")
+    events = remotelock.get_events_since(since)
+
+    by_month: dict[str, list[dict]] = {}
+    for e in events:
+        by_month.setdefault(e["occurred_at"][:7], []).append(e)
+    added: dict[str, int] = {}
+    for ym, month_events in sorted(by_month.items()):
+        year, month = int(ym[:4]), int(ym[5:7])
+        columns = read_event_month(s3bucket, year, month) or empty_event_columns()
+        count = merge_events(columns, month_events)
+        if count > 0:
+            write_event_month(s3bucket, year, month, columns)
+            added[ym] = count
+
+    # 前回に取り込みが済んだ最後の月 (months の無い以前の watermark では最新のイベントの月) から今月まで
+    ingested: list[str] = watermark.get("months", [])
+    first: str = max(ingested, default=since[:7]) or min(by_month, default=month_key(today.year, today.month))
+    months = set(ingested) | set(by_month) | {month_key(y, m) for y, m in iter_months(date(int(first[:4]), int(first[5:7]), 1), today)}
+    watermark = {
+        "occurred_at": events[-1]["occurred_at"] if len(events) > 0 else since,
+        "months": sorted(months),
+        "updated_at": datetime.now().isoformat(timespec="seconds"),
+    }
+    s3bucket.Object(WATERMARK_KEY).put(Body=json.dumps(watermark), ContentType="application/json")
+    return {"read": len(events), "added": added, "watermark": watermark["occurred_at"]}
+
+
+# start から end まで (両端を含む) のイベントを読む。months は取り込みが済んだ月 (イベントの無い月を含む) で、
+# イベントストアに無い月は含めない
+def read_events(s3bucket, start: date, end: date) -> tuple[dict[str, list], list[str]]:
+    ingested = set((get_json(s3bucket, WATERMARK_KEY) or {}).get("months", []))
+    start_iso, end_iso = start.isoformat(), end.isoformat()
+    ret = empty_event_columns()
+    months = []
+    for year, month in iter_months(start, end):
+        columns = read_event_month(s3bucket, year, month)
+        if columns is None:
+            if month_key(year, month) in ingested:
+                months.append(month_key(year, month))
+            continue
+        months.append(month_key(year, month))
+        # 期間の途中から始まる月と途中で終わる月は、期間内のイベントだけにする
+        selected = [i for i, occurred_at in enumerate(columns["occurred_at"]) if start_iso <= occurred_at[:10] <= end_iso]
+        for column in EVENT_COLUMNS:
+            values = columns[column]
+            ret[column].extend(values[i] for i in selected)
+    return ret, months
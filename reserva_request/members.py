@@ -0,0 +1,40 @@
+from util import GSpreadsheetUtil, hybrid_dict_cache
+
+"""
+事前登録シートの登録ユーザと町内会員
+report と storebatch で使う。report の handler を読み込まなくて済むように分けてある。
+"""
+
+
+@hybrid_dict_cache(default_local_ttl=3600, default_s3_ttl=43200)
+def get_registered_users_and_community_members_from_workbook(__cache_refresh: bool = False):
+    return get_all_registered_users()
+
+
+def get_all_registered_users():
+    # users を取得する
+    # 列は { 0:'timestamp', 1:'email', 2:'user_name', 3:'member_name', 4:'block', 5:'kumi', 6:'objective' }
+    workbook = GSpreadsheetUtil.get_workbook()
+    cell_users = workbook.get_worksheet_by_id(95987732).get_all_values()
+    cell_users.pop(0)  # 先頭行は不要なので削除する
+    members = {}
+    users = {}
+    for cell_user in cell_users:
+        user = {}
+        user["email"] = cell_user[1]
+        user["reg_timestamp"] = cell_user[0]
+        user["user_name"] = cell_user[2]
+        user["objective"] = cell_user[6]
+        user["guests"] = []
+        users[cell_user[1]] = user  # email が主キーとなる
+
+        member_name = cell_user[3]
+        member_block = cell_user[4]
+        member_kumi = cell_user[5]
+        member_id = f"{member_block}{member_kumi} {member_name}"
+        if not member_id in members:
+            members[member_id] = {"id": member_id, "block": member_block, "kumi": member_kumi, "member_name": member_name, "users": []}
+        user["member_id"] = member_id
+        members[member_id]["users"].append(user)
+
+    return users, members
@@ -1,18 +1,23 @@
 from typing import Any
 from aws_lambda_powertools import Logger
-from aws_lambda_powertools.utilities import parameters
+from config import get_config, clear_config
 import requests
 import re
 import time
 import json
 import boto3
-from datetime import timedelta, datetime
-import calendar
-from collections import deque
+from datetime import timedelta, datetime, date
+from zoneinfo import ZoneInfo
+from slot import Slot, SLOT_INDEX, classify_time_ranges, slots_from_mask
 
 
 logger = Logger()
 
+# 記録するイベントの種類 (解錠と拒否)。オートロックなどのイベントは捨てる
+EVENT_TYPES = ["unlocked_event", "access_denied"]
+# 錠の time_zone が無い場合のタイムゾーン
+LOCAL_TIME_ZONE = "Asia/Tokyo"
+
 
 class ResponseError(Exception):
     def __init__(self, status_code, message):
@@ -27,6 +32,13 @@ class RemoteLock:
 
     # 対象月のイベントを返す。オートロックの情報は意味を持たないので捨てている。
     def get_events(self, target_year: int, target_month: int) -> list[dict]:
+        target_ym: str = f"{target_year:04}-{target_month:02}"
+        return [e for e in self.get_events_since(f"{target_ym}-01T00:00:00") if e["occurred_at"][:7] == target_ym]
+
+    # since (ローカル時刻の YYYY-MM-DDTHH:MM:SS) 以降に発生した解錠イベントと拒否イベントを古い順に返す
+    # 一覧は sort で新しい順を指定して読み、ページ内が全て since より前になったところで読むのをやめる。
+    # ページ内の順序には依存しないので、同じ時刻のイベントが前後しても取りこぼさない。
+    def get_events_since(self, since: str = "") -> list[dict]:
         end_of_read: bool = False
         ret = []
         page: int = 1
@@ -34,7 +46,7 @@ class RemoteLock:
             data, meta = self.api(
                 method="GET",
                 path="events",
-                params={"page": page, "per_page": 50},
+                params={"page": page, "per_page": 50, "sort": "-occurred_at"},
                 with_metadata=True,
             )
             total_page = meta["total_pages"]
@@ -43,27 +55,36 @@ class RemoteLock:
             page += 1
 
             if self.empty_data_check(data, "get_events", "NO EVENTS"):
-                return []
-            for item in data:
-                if item["type"] in ["unlocked_event", "access_denied"]:
-                    st_data = {}
-                    print(item["attributes"]["time_zone"])
-                    occurred_at = datetime.fromisoformat(item["attributes"]["occurred_at"])
-                    st_data["time"] = occurred_at
-                    st_data["event_type"] = item["type"]
-                    if item["type"] == "unlocked_event":
-                        st_data["status"] = item["attributes"]["status"]
-                        st_data["user_type"] = item["attributes"]["associated_resource_type"]
-                        st_data["user_id"] = item["attributes"]["associated_resource_id"]
-                    if occurred_at.year == target_year and occurred_at.month == target_month:
-                        ret.append(st_data)
-                    if occurred_at.year < target_year or (occurred_at.year == target_year and occurred_at.month < target_month):
-                        end_of_read = True
+                break
+            page_events = [self.make_event_data(item) for item in data]
+            ret.extend(e for e in page_events if e["event_type"] in EVENT_TYPES and e["occurred_at"] >= since)
+            if max(e["occurred_at"] for e in page_events) < since:
+                end_of_read = True
 
+        ret.sort(key=lambda e: (e["occurred_at"], e["id"]))
         return ret
 
+    # イベントの発生日時は錠の time_zone のローカル時刻 (枠と同じ YYYY-MM-DDTHH:MM:SS) にそろえる
+    def make_event_data(self, item) -> dict:
+        attributes = item["attributes"]
+        occurred_at = datetime.fromisoformat(attributes["occurred_at"])
+        if occurred_at.tzinfo is not None:
+            occurred_at = occurred_at.astimezone(ZoneInfo(attributes.get("time_zone") or LOCAL_TIME_ZONE)).replace(tzinfo=None)
+        return {
+            "id": item["id"],
+            "occurred_at": occurred_at.isoformat(timespec="seconds"),
+            "event_type": item["type"],
+            "status": attributes.get("status", ""),
+            "user_type": attributes.get("associated_resource_type", ""),
+            "user_id": attributes.get("associated_resource_id", ""),
+        }
+
     # access user を返す。定期予約が設定してある access user のみが返される。
     def get_users(self, start_day: datetime, target_day_range: int = 31, exp_day_range=365) -> list[dict]:
+        return self.make_access_users(self.get_access_user_records(), start_day, target_day_range, exp_day_range)
+
+    # 定期予約が設定してある access user を API の形式のまま返す。月毎に予定を展開する場合はこれを1回だけ呼んで make_access_users に渡す。
+    def get_access_user_records(self) -> list[dict]:
         end_of_read: bool = False
         ret = []
         page: int = 1
@@ -85,29 +106,46 @@ class RemoteLock:
             for g in r:
                 department: str = g["attributes"]["department"]
                 if department and department.startswith("[{"):
-                    deptjson = json.loads(department)
-                    target_slots, exception_slots = self.make_calendar_list(
-                        access_info_list=deptjson,
-                        start_day=start_day,
-                        day_range=target_day_range,
-                        exp_day_range=exp_day_range,
-                    )
-                    ret.append(
-                        {
-                            "type": "access_user",
-                            "id": g["id"],
-                            "name": g["attributes"]["name"],
-                            "email": g["attributes"]["email"],
-                            "timeslots": target_slots,
-                            "exception_timeslots": exception_slots,
-                        }
-                    )
+                    ret.append(g)
+        return ret
+
+    def make_access_users(self, records: list[dict], start_day: datetime, target_day_range: int = 31, exp_day_range=365) -> list[dict]:
+        ret = []
+        for g in records:
+            # 定期予約の設定が誤っている access user は飛ばし、他の access user の予約は返す
+            try:
+                compiled = compile_department(g["attributes"]["department"])
+            except ValueError as e:
+                logger.error({"service": "remotelock", "command": "make_access_users", "id": g["id"], "name": g["attributes"]["name"], "error": str(e)})
+                continue
+            target_slots, exception_slots = expand_access_rules(
+                compiled,
+                start_day=start_day,
+                day_range=target_day_range,
+                exp_day_range=exp_day_range,
+            )
+            ret.append(
+                {
+                    "type": "access_user",
+                    "id": g["id"],
+                    "name": g["attributes"]["name"],
+                    "email": g["attributes"]["email"],
+                    "timeslots": target_slots,
+                    "exception_timeslots": exception_slots,
+                }
+            )
         return ret
 
     # access guest を返す。access guest は数が多いため、ターゲットとなる年月のものだけを抽出する。
     def get_access_guests(self, target_year: int, target_month: int) -> list[dict]:
+        return self.get_access_guests_range(target_year, target_month, target_year, target_month).get(f"{target_year:04}-{target_month:02}", [])
+
+    # 開始年月から終了年月までの access guest を、一覧を新しい順に1回だけ読んで年月 (YYYY-MM) 毎に振り分けて返す
+    def get_access_guests_range(self, start_year: int, start_month: int, end_year: int, end_month: int) -> dict[str, list[dict]]:
+        start_ym: str = f"{start_year:04}-{start_month:02}"
+        end_ym: str = f"{end_year:04}-{end_month:02}"
         end_of_read: bool = False
-        ret = []
+        ret: dict[str, list[dict]] = {}
         page: int = 1
         while not end_of_read:
             data, meta = self.api(
@@ -128,64 +166,34 @@ class RemoteLock:
             page += 1
 
             if self.empty_data_check(data, "get_expired_access_guests", "NO ACCESS GUESTS"):
-                return []
-            for item in data:
-                st_data = self.make_access_guest_data(item)
-                day = st_data["timeslots"][0]["day"]
-                slot_year: int = int(day[:4])
-                slot_month: int = int(day[5:7])
-                if slot_year == target_year and slot_month == target_month:
-                    ret.append(st_data)
-                if slot_year < target_year or (slot_year == target_year and slot_month < target_month):
+                return {}
+            for item, st_data in zip(data, self.make_access_guest_page(data)):
+                # 開始日時の YYYY-MM で比較する
+                slot_ym: str = item["attributes"]["starts_at"][:7]
+                if start_ym <= slot_ym <= end_ym:
+                    ret.setdefault(slot_ym, []).append(st_data)
+                if slot_ym < start_ym:
                     end_of_read = True
 
         return ret
 
-    def make_slot(self, dtstr: str, dtstr_iso: str, start_time: str, end_time: str):
-        return {
-            "day": dtstr,
-            "start_time": f"{dtstr} {start_time}",
-            "end_time": f"{dtstr} {end_time}",
-            "start_time_iso": f"{dtstr_iso}T{start_time}:00.000000",
-            "end_time_iso": f"{dtstr_iso}T{end_time}:00.000000",
-        }
-
     def make_access_guest_data(self, item) -> dict:
-        ga = item["attributes"]
-        starts_at = ga["starts_at"]
-        ends_at = ga["ends_at"]
-        m_start = re.match(r"([0-9]+)-([0-9]+)-([0-9]+)T([0-9]+):([0-9]+):([0-9]+)", starts_at)
-        (s_year, s_month, s_day, s_hour, s_min, s_sec) = m_start.groups()
-        m_end = re.match(r"([0-9]+)-([0-9]+)-([0-9]+)T([0-9]+):([0-9]+):([0-9]+)", ends_at)
-        (e_year, e_month, e_day, e_hour, e_min, e_sec) = m_end.groups()
-
-        s_datetime = datetime(int(s_year), int(s_month), int(s_day), int(s_hour), int(s_min), int(s_sec))
-        e_datetime = datetime(int(e_year), int(e_month), int(e_day), int(e_hour), int(e_min), int(e_sec))
-
-        slot1 = datetime(int(s_year), int(s_month), int(s_day), 7, 0, 0)  # 早朝枠 5:00-9:00
-        slot2 = datetime(int(s_year), int(s_month), int(s_day), 10, 0, 0)  # 午前枠 9:00-13:00
-        slot3 = datetime(int(s_year), int(s_month), int(s_day), 15, 0, 0)  # 午後枠 13:00-17:00
-        slot4 = datetime(int(s_year), int(s_month), int(s_day), 19, 0, 0)  # 夜枠 17:00-21:00
-
-        slots = []
-        dtstr: str = f"{s_year}/{s_month}/{s_day}"
-        dtstr_iso: str = f"{s_year}-{s_month}-{s_day}"
-        if s_datetime < slot1 and slot1 < e_datetime:
-            slots.append(self.make_slot(dtstr, dtstr_iso, "05:00", "09:00"))
-        if s_datetime < slot2 and slot2 < e_datetime:
-            slots.append(self.make_slot(dtstr, dtstr_iso, "09:00", "13:00"))
-        if s_datetime < slot3 and slot3 < e_datetime:
-            slots.append(self.make_slot(dtstr, dtstr_iso, "13:00", "17:00"))
-        if s_datetime < slot4 and slot4 < e_datetime:
-            slots.append(self.make_slot(dtstr, dtstr_iso, "17:00", "21:00"))
+        return self.make_access_guest_page([item])[0]
 
-        return {
-            "type": "access_guest",
-            "id": item["id"],
-            "name": ga["name"],
-            "email": ga["email"],
-            "timeslots": slots,
-        }
+    # API の1ページ分の access guest をまとめて変換する。鍵の有効時間帯は一度だけ解析し、枠の判定はページ単位で行う。
+    def make_access_guest_page(self, items: list[dict]) -> list[dict]:
+        attributes = [item["attributes"] for item in items]
+        ordinals, masks = classify_time_ranges([ga["starts_at"] for ga in attributes], [ga["ends_at"] for ga in attributes])
+        return [
+            {
+                "type": "access_guest",
+                "id": item["id"],
+                "name": ga["name"],
+                "email": ga["email"],
+                "timeslots": slots_from_mask(ordinal, mask),
+            }
+            for item, ga, ordinal, mask in zip(items, attributes, ordinals, masks)
+        ]
 
     def register_guest(self) -> str:
         r = self.api(method="GET", path="devices", params={"type": ["lock"]})
@@ -240,7 +248,7 @@ class RemoteLock:
         return key_no
 
     def delete_old_guests(self) -> None:
-        remote_lock_expired_days: int = int(parameters.get_parameter("remotelock_expired_days_for_access_guest"))
+        remote_lock_expired_days: int = get_config().remotelock_expired_days_for_access_guest
         expired_count: int = 0
 
         end_of_read: bool = False
@@ -353,7 +361,7 @@ class RemoteLock:
 
         # 開始時間にn分のバッファを持たせるためのロジック
         starts_at_datetime = datetime(int(year), int(month), int(day), int(s_hour), int(s_min))
-        remotelock_buffer_min: int = int(parameters.get_parameter("remotelock_buffer_min"))
+        remotelock_buffer_min: int = get_config().remotelock_buffer_min
         td_buffer_min = timedelta(minutes=remotelock_buffer_min)
         starts_at_datetime -= td_buffer_min
         # 日付が変更されることはないので hour と min だけ補正する
@@ -452,7 +460,7 @@ class RemoteLock:
 
     def __refresh_token(self, remotelock_token: dict[str, str]) -> dict[str, str]:
         logger.info("refresh token...")
-        client_key = parameters.get_parameter("remotelock_clientkey", transform="json")
+        client_key = get_config().remotelock_clientkey
         client_id = client_key["client_id"]
         client_secret = client_key["client_secret"]
         refresh_token = remotelock_token["refresh_token"]
@@ -470,41 +478,41 @@ class RemoteLock:
         access_token = res["access_token"]
         refresh_token = res["refresh_token"]
         expires_at = int(epoch_now + res["expires_in"])
+        remotelock_token = {
+            "access_token": access_token,
+            "refresh_token": refresh_token,
+            "expires_at": expires_at,
+        }
         ssm = boto3.client("ssm")
         ssm.put_parameter(
             Name="remotelock_token",
-            Value=json.dumps(
-                {
-                    "access_token": access_token,
-                    "refresh_token": refresh_token,
-                    "expires_at": expires_at,
-                }
-            ),
+            Value=json.dumps(remotelock_token),
             Type="String",
             Overwrite=True,
         )
-        return parameters.get_parameter("remotelock_token", force_fetch=True, transform="json")
+        # 手元の設定に残っている古いトークンを使わないように、次は読み直させる
+        clear_config()
+        return remotelock_token
 
     def __get_token(self) -> dict[str, str]:
-        remotelock_token = parameters.get_parameter("remotelock_token", transform="json")
-        expires_at: int = int(remotelock_token["expires_at"])
-        epoch_now: int = int(time.time())
-        if expires_at <= epoch_now + 120:  # 有効期限が切れているか、今から2分以内に有効期限が切れる
-            remotelock_token = self.__refresh_token(remotelock_token)
+        remotelock_token = get_config().remotelock_token
+        if self.__token_expiring(remotelock_token):
+            # 他の Lambda が更新済みかもしれないので、手元の設定を読み直してから更新する
+            remotelock_token = get_config(force_fetch=True).remotelock_token
+            if self.__token_expiring(remotelock_token):
+                remotelock_token = self.__refresh_token(remotelock_token)
         return remotelock_token["access_token"]
 
+    # 有効期限が切れているか、今から2分以内に有効期限が切れる
+    def __token_expiring(self, remotelock_token: dict[str, str]) -> bool:
+        return int(remotelock_token["expires_at"]) <= int(time.time()) + 120
+
     def empty_data_check(self, data, command, guest_id):
         if data is None or len(data) == 0:
             logger.warn({"service": "remotelock", "command": command, "guest_id": guest_id})
             return True
         return False
 
-    def get_nth_week(self, day):
-        return (day - 1) // 7 + 1
-
-    def get_nth_dow(self, year, month, day):
-        return self.get_nth_week(day), calendar.weekday(year, month, day)
-
     # day_range 日後までの予定を決める
     # RemoteLock のユーザの desc に設定してある JSON を処理をする
     # JSON の形式は以下。day-slot-week の組み合わせ and/or unused-date の組み合わせとなる。
@@ -521,80 +529,90 @@ class RemoteLock:
         day_range: int,
         exp_day_range: int = 365,
     ):
-        weekday_dict = {
-            "Mon": 0,
-            "Tue": 1,
-            "Wed": 2,
-            "Thu": 3,
-            "Fri": 4,
-            "Sat": 5,
-            "Sun": 6,
-        }
-        target_list: list = []
-        exception_list: list = []
-
-        # JSON を読む
-        # 先に例外日を追加しておく
-        for access_info in access_info_list:
-            if "unused-date" in access_info:
-                dstr = access_info["unused-date"]
+        return expand_access_rules(compile_access_rules(access_info_list), start_day, day_range, exp_day_range)
+
+
+WEEKDAY_DICT = {
+    "Mon": 0,
+    "Tue": 1,
+    "Wed": 2,
+    "Thu": 3,
+    "Fri": 4,
+    "Sat": 5,
+    "Sun": 6,
+}
+
+# department の JSON 文字列をキーとしたコンパイル済みルールのキャッシュ
+compiled_rules_cache: dict[str, tuple] = {}
+
+
+# JSON の予約パターンを (曜日 -> [(第n週の集合, 枠のリスト), ...], 例外日の集合, 例外日のリスト) にコンパイルする
+# 曜日毎に JSON の出現順を保ったままルールを並べるので、展開結果は JSON を順に評価した場合と同じになる
+def compile_access_rules(access_info_list: list[dict]) -> tuple:
+    rules: dict[int, list] = {}
+    unused_date_list: list[str] = []
+    for access_info in access_info_list:
+        if "unused-date" in access_info:
+            unused_date_list.append(access_info["unused-date"])
+            continue
+        if not "day" in access_info:
+            continue
+        slot = access_info["slot"]
+        # (開始時刻, 終了時刻) の組を SLOT_TABLE の添字にしておく
+        slot_indexes = []
+        for start_time, end_time in zip(slot[0::2], slot[1::2]):
+            if not (start_time, end_time) in SLOT_INDEX:
+                raise ValueError(f"{start_time}-{end_time} in {access_info} is not a slot of the hall")
+            slot_indexes.append(SLOT_INDEX[(start_time, end_time)])
+        rules.setdefault(WEEKDAY_DICT[access_info["day"]], []).append((frozenset(access_info["week"]), tuple(slot_indexes)))
+    return rules, frozenset(unused_date_list), unused_date_list
+
+
+def compile_department(department: str) -> tuple:
+    compiled = compiled_rules_cache.get(department)
+    if compiled is None:
+        compiled = compile_access_rules(json.loads(department))
+        compiled_rules_cache[department] = compiled
+    return compiled
+
+
+# コンパイル済みルールを start_day から day_range 日分展開し、予約枠のリストとアクセス不可日のリストを返す
+def expand_access_rules(compiled: tuple, start_day: datetime, day_range: int, exp_day_range: int = 365):
+    rules, unused_dates, unused_date_list = compiled
+    target_list: list = []
+    # 先に例外日を追加しておく
+    exception_list: list = [{"start_date": dstr, "end_date": dstr} for dstr in unused_date_list]
+
+    start_ordinal: int = start_day.toordinal()
+    for ordinal in range(start_ordinal, start_ordinal + day_range):
+        # ordinal 1 (0001-01-01) は月曜日なので、曜日は ordinal だけで決まる
+        day_rules = rules.get((ordinal + 6) % 7)
+        if day_rules is None:
+            continue
+        t: date = date.fromordinal(ordinal)
+
+        # RemoteLock 形式 (ISO)
+        dstr = t.isoformat()
+        # 既に例外日に追加されている場合には当該日は処理しない
+        if dstr in unused_dates:
+            continue
+
+        nth_week: int = (t.day - 1) // 7 + 1
+        for weeks, slot_indexes in day_rules:
+            if nth_week in weeks:
+                # 同一日複数予約に対応する
+                # target_list の開始時刻/終了時刻は Reserva に合わせるため30分前倒しなどはしない (access guest は鍵設定時、access user はアクセス時間帯を設定時に調整している)
+                target_list.extend(Slot(ordinal, index) for index in slot_indexes)
+            else:
+                # アクセス不可日を RemoteLock に設定する
+                # アクセス不可日は一括で設定する
+                # 日付の形式は RemoteLock に合わせて YYYY-MM-DD となる (Reserva と異なる)
                 exception_list.append({"start_date": dstr, "end_date": dstr})
-
-        for i in range(0, day_range):
-            t: datetime = start_day + timedelta(days=i)
-
-            # RemoteLock 形式 (ISO)
-            dstr = f"{t.year:04}-{t.month:02}-{t.day:02}"
-
-            # 日付の形式は Reserva に合わせて YYYY/MM/DD となる (RemoteLock と異なる)
-            dtstr = f"{t.year:04}/{t.month:02}/{t.day:02}"
-
-            # 既に例外日に追加されている場合には当該日は処理しない
-            skip_flag = False
-            for unused_date_entry in exception_list:
-                if dstr == unused_date_entry["start_date"]:
-                    skip_flag = True
-            if skip_flag:
-                continue
-            # JSON を読む
-            for access_info in access_info_list:
-                # 例外日のエントリは事前処理済なので処理しない
-                if "unused-date" in access_info or not "day" in access_info:
-                    continue
-                target_wd = weekday_dict[access_info["day"]]
-                no, wd = self.get_nth_dow(t.year, t.month, t.day)
-                if target_wd == wd:
-                    if no in access_info["week"]:
-                        # pop するのでキューを複製して使う
-                        slot_queue = deque(access_info["slot"])
-                        while len(slot_queue) > 0:  # 同一日複数予約に対応するためのループ
-                            start_time = slot_queue.popleft()
-                            end_time = slot_queue.popleft()
-                            start_dt = f"{dtstr} {start_time}"
-                            end_dt = f"{dtstr} {end_time}"
-                            dtstr_iso = f"{t.year:04}-{t.month:02}-{t.day:02}"
-                            start_iso = f"{dtstr_iso}T{start_time}:00.000000"
-                            end_iso = f"{dtstr_iso}T{end_time}:00.000000"
-                            # target_list の開始時刻/終了時刻は Reserva に合わせるため30分前倒しなどはしない (access guest は鍵設定時、access user はアクセス時間帯を設定時に調整している)
-                            target_list.append(
-                                {
-                                    "day": dtstr,
-                                    "start_time": start_dt,
-                                    "end_time": end_dt,
-                                    "start_time_iso": start_iso,
-                                    "end_time_iso": end_iso,
-                                }
-                            )
-                    else:
-                        # アクセス不可日を RemoteLock に設定する
-                        # アクセス不可日は一括で設定する
-                        # 日付の形式は RemoteLock に合わせて YYYY-MM-DD となる (Reserva と異なる)
-                        exception_list.append({"start_date": dstr, "end_date": dstr})
-        if len(exception_list) == 0:
-            # 空だと同期エラーになる仕様なのでデフォルトで1年先をダミーで追加しておく
-            # 日付の形式は RemoteLock に合わせて YYYY-MM-DD となる (Reserva と異なる)
-            t: datetime = start_day + timedelta(days=exp_day_range)
-            dstr = f"{t.year:04}-{t.month:02}-{t.day:02}"
-            exception_list.append({"start_date": dstr, "end_date": dstr})
-
-        return target_list, exception_list
+    if len(exception_list) == 0:
+        # 空だと同期エラーになる仕様なのでデフォルトで1年先をダミーで追加しておく
+        # 日付の形式は RemoteLock に合わせて YYYY-MM-DD となる (Reserva と異なる)
+        t: datetime = start_day + timedelta(days=exp_day_range)
+        dstr = f"{t.year:04}-{t.month:02}-{t.day:02}"
+        exception_list.append({"start_date": dstr, "end_date": dstr})
+
+    return target_list, exception_list
@@ -1,62 +1,96 @@
-from remotelock import RemoteLock
-from typing import Any
-from util import GSpreadsheetUtil, ret_json, error_json, hybrid_dict_cache
+from members import get_registered_users_and_community_members_from_workbook
+from slot import Slot, SLOT_COUNT
+from typing import Any, NamedTuple
+from util import ret_json, ret_json_cacheable, ret_body_cacheable, error_json, hybrid_dict_cache, month_tag, get_cache_bucket
+from used_data import iter_months, month_key, read_manifest, read_partition_meta, read_partition, read_used_data
 
-from aws_lambda_powertools.utilities import parameters
+from config import get_config
 from aws_lambda_powertools import Logger
 from aws_lambda_powertools.utilities.typing import LambdaContext
+from bisect import bisect_left
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import calendar
-from datetime import datetime, date
+import json
+import time
+from datetime import datetime, date, timedelta
 
 # logger についてはここに書いておかないと初期化時の injection でエラーになる。
 logger = Logger()
 
 
-def init_reporter_object(target_year: int, target_month: int, start_date: datetime):
-    reporter: ReservationReporter = ReservationReporter(datetime.fromisoformat(start_date), target_year, target_month)
+def init_reporter_object(target_year: int, target_month: int):
+    reporter: ReservationReporter = ReservationReporter(target_year, target_month)
     reporter.collect_data()
     return reporter
 
 
-@hybrid_dict_cache(default_local_ttl=3600, default_s3_ttl=43200)
-def get_registered_users_and_community_members_from_workbook(__cache_refresh: bool = False):
-    return get_all_registered_users()
-
-
-def get_all_registered_users():
-    # users を取得する
-    # 列は { 0:'timestamp', 1:'email', 2:'user_name', 3:'member_name', 4:'block', 5:'kumi', 6:'objective' }
-    workbook = GSpreadsheetUtil.get_workbook()
-    cell_users = workbook.get_worksheet_by_id(95987732).get_all_values()
-    cell_users.pop(0)  # 先頭行は不要なので削除する
-    members = {}
-    users = {}
-    for cell_user in cell_users:
-        user = {}
-        user["email"] = cell_user[1]
-        user["reg_timestamp"] = cell_user[0]
-        user["user_name"] = cell_user[2]
-        user["objective"] = cell_user[6]
-        user["guests"] = []
-        users[cell_user[1]] = user  # email が主キーとなる
-
-        member_name = cell_user[3]
-        member_block = cell_user[4]
-        member_kumi = cell_user[5]
-        member_id = f"{member_block}{member_kumi} {member_name}"
-        if not member_id in members:
-            members[member_id] = {"id": member_id, "block": member_block, "kumi": member_kumi, "member_name": member_name, "users": []}
-        user["member_id"] = member_id
-        members[member_id]["users"].append(user)
-
-    return users, members
+# 1か月分の予約の1件 (1枠)。type は access_user (定期予約) か access_guest (都度予約)
+class MonthItem(NamedTuple):
+    slot: Slot
+    type: str
+    name: str
+    block: str
+
+
+# 1か月分の予約をまとめた不変なデータ。reservation / calendar (month, day) のどの形式もここから作る。
+# 予約は (Slot.key, type, name, block) の行として枠の順 (同じ枠は access user、access guest の順) に並べ、
+# 日ごとの先頭の位置 (day_offsets) を持つ。1日分の予約は day_items でその日の行だけを取り出す。
+class MonthDataset:
+    __slots__ = ("year", "month", "rows", "day_offsets")
+
+    def __init__(self, year: int, month: int, items: tuple[MonthItem, ...]) -> None:
+        rows = sorted(((item.slot.key, item.type, item.name, item.block) for item in items), key=lambda row: row[0])
+        self.__set_rows(year, month, rows, make_day_offsets(year, month, rows))
+
+    def __set_rows(self, year: int, month: int, rows: list, day_offsets: list[int]) -> None:
+        object.__setattr__(self, "year", year)
+        object.__setattr__(self, "month", month)
+        object.__setattr__(self, "rows", tuple(rows))
+        object.__setattr__(self, "day_offsets", tuple(day_offsets))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("MonthDataset is immutable")
+
+    @property
+    def items(self) -> tuple[MonthItem, ...]:
+        return tuple(MonthItem(Slot.from_key(key), type, name, block) for key, type, name, block in self.rows)
+
+    # 対象日の予約。対象月以外の日は空
+    def day_items(self, target_date: date) -> tuple[MonthItem, ...]:
+        if (target_date.year, target_date.month) != (self.year, self.month):
+            return ()
+        start, end = self.day_offsets[target_date.day - 1], self.day_offsets[target_date.day]
+        return tuple(MonthItem(Slot.from_key(key), type, name, block) for key, type, name, block in self.rows[start:end])
+
+    # キャッシュには JSON で保存するので、枠は Slot.key で持つ
+    def to_dict(self) -> dict[str, Any]:
+        return {"year": self.year, "month": self.month, "items": [list(row) for row in self.rows], "days": list(self.day_offsets)}
+
+    @classmethod
+    def from_dict(cls, data: dict[str, Any]) -> "MonthDataset":
+        # days の無い以前の形式は、並べ直して索引を作る
+        if not "days" in data:
+            return cls(data["year"], data["month"], (MonthItem(Slot.from_key(key), type, name, block) for key, type, name, block in data["items"]))
+        dataset = cls.__new__(cls)
+        dataset.__set_rows(data["year"], data["month"], data["items"], data["days"])
+        return dataset
+
+
+# 枠の順に並んだ行から、対象月の各日の先頭の位置 (月の日数 + 1 個、最後は月末の翌日の先頭) を作る
+def make_day_offsets(year: int, month: int, rows: list) -> list[int]:
+    keys = [row[0] for row in rows]
+    first_key: int = date(year, month, 1).toordinal() * SLOT_COUNT
+    return [bisect_left(keys, first_key + day * SLOT_COUNT) for day in range(calendar.monthrange(year, month)[1] + 1)]
 
 
 class ReservationReporter:
-    def __init__(self, start_date: datetime, target_year: int, target_month: int) -> None:
-        self.start_date = start_date
+    def __init__(self, target_year: int, target_month: int) -> None:
         self.target_year = target_year
         self.target_month = target_month
+        # RemoteLock (requests) はキャッシュに無い月を作るときだけ読み込む
+        from remotelock import RemoteLock
+
         self.remotelock: RemoteLock = RemoteLock()
         self.registered_users: list = None
         self.community_members: list = None
@@ -65,12 +99,12 @@ class ReservationReporter:
         self.today: datetime = datetime.now()
 
     # 登録ユーザ(registered_users)、町内会員(community_members)、定期登録ユーザ(access_users)、都度登録ゲスト(access_guests) を収集する
+    # access_users は対象月の1日から月末までの予約を展開する
     def collect_data(self):
         self.registered_users, self.community_members = get_registered_users_and_community_members_from_workbook()
 
-        # キャッシュ
         _wday, lastday = calendar.monthrange(self.target_year, self.target_month)
-        self.access_users = self.remotelock.get_users(self.start_date, lastday)
+        self.access_users = self.remotelock.get_users(datetime(self.target_year, self.target_month, 1), lastday)
         self.access_guests = self.remotelock.get_access_guests(self.target_year, self.target_month)
         logger.info(f"{len(self.registered_users)} registered users, {len(self.community_members)} community members, {len(self.access_users)} access users, {len(self.access_guests)} access guests.")
 
@@ -82,138 +116,267 @@ class ReservationReporter:
                 user = self.registered_users[email]
                 user["guests"].append(guest)
 
-    def report(self) -> None:
-        reported_members = []
-        for member_key in self.community_members:
-            member = self.community_members[member_key]
-            member_usage_count = 0
-            users = member["users"]
-            for user in users:
-                for guest in user["guests"]:
-                    member_usage_count += len(guest["slots"])
-            member["usage_count"] = member_usage_count
-            if member_usage_count > 0:
-                reported_members.append(member)
-
-        reported_members.sort(key=lambda x: x["usage_count"], reverse=True)
-
-        weekday_list = ["月", "火", "水", "木", "金", "土", "日"]
-        for member in reported_members:
-            print(f'{member["id"]}: {member["usage_count"]}')
-            for user in member["users"]:
-                user["guests"].sort(key=lambda x: x["date"])
-                for guest in user["guests"]:
-                    for slot in guest["slots"]:
-                        print(f'  {guest["date"]}({weekday_list[guest["weekday"]]}) {slot}')
-
-    """
-    {
-        date: "2022-01-06",
-        timeslot: "09:00-13:00",
-        name: "名前",
-        block: "2ブロック2組",
-    },
-    """
-
-    def build_reservation_item(self, actor):
-        ret = []
-        for slot in actor["timeslots"]:
-            item = {}
-            item["start_time"] = slot["start_time_iso"]
-            item["date"] = slot["start_time_iso"][:10]
-            item["timeslot"] = f'{slot["start_time"][-5:]}-{slot["end_time"][-5:]}'
-            if actor["type"] == "access_user":
-                item["name"] = actor["name"]
-                item["block"] = "定期予約(町内会公認団体)"
-            else:
-                if actor["email"]:
-                    registered_user = self.registered_users[actor["email"]]
-                    item["name"] = registered_user["user_name"]
-                    cm = self.community_members[registered_user["member_id"]]
-                    item["block"] = f'{cm["block"]} {cm["kumi"]} {cm["member_name"]}'
-                else:
-                    item["name"] = actor["name"]
-                    item["block"] = "-"
-
-            ret.append(item)
-        return ret
-
-    """
-      {
-        start: new Date(),
-        title: "test",
-        description: "test description", // day only
-        color: "info", // primary or secondary
-        icon: "repeat", // or person // day only
-      },
-    """
-
-    def build_calendar_item(self, actor, scope: str) -> list:
-        ret = []
-        for slot in actor["timeslots"]:
-            item = {}
-            day_flag: bool = False
-            item["start"] = slot["start_time_iso"]
-            start_time: datetime = datetime.fromisoformat(slot["start_time_iso"])
-            end_time: datetime = datetime.fromisoformat(slot["end_time_iso"])
-            if actor["type"] == "access_user":
-                item["title"] = actor["name"]
-            else:
-                if actor["email"]:
-                    registered_user = self.registered_users[actor["email"]]
-                    item["title"] = registered_user["user_name"]
-                else:
-                    item["title"] = actor["name"]
-
-            if scope == "day" and start_time.year == self.target_year and start_time.month == self.target_month and start_time.day == self.start_date.day:
-                day_flag = True
-                if actor["type"] == "access_user":
-                    item["icon"] = "repeat"  # access_user は定期予約なので repeat
-                    item["description"] = f"{start_time.hour:02}:00-{end_time.hour:02}:00 定期予約(町内会公認団体)"
-                else:
-                    # community_member
-                    cm = self.community_members[registered_user["member_id"]]
-                    item["icon"] = "person"
-                    item["description"] = f'{start_time.hour:02}:00-{end_time.hour:02}:00 {cm["block"]} {cm["kumi"]} {cm["member_name"]}'
-
-            item["color"] = "secondary"
-
-            if scope == "month" or day_flag:
-                ret.append(item)
-
-        return ret
-
-
-@hybrid_dict_cache()
-def make_reservation_list(target_year: int, target_month: int, start_date: datetime, local_ttl: int, s3_ttl: int, __cache_refresh: bool = False):
-    reporter: ReservationReporter = init_reporter_object(target_year, target_month, start_date)
+    # 予約者の名前と所属 (定期予約は町内会公認団体、都度予約は登録ユーザの町内会員) を決める
+    def build_month_items(self, actor) -> list[MonthItem]:
+        if actor["type"] == "access_user":
+            name = actor["name"]
+            block = "定期予約(町内会公認団体)"
+        elif actor["email"]:
+            registered_user = self.registered_users[actor["email"]]
+            name = registered_user["user_name"]
+            cm = self.community_members[registered_user["member_id"]]
+            block = f'{cm["block"]} {cm["kumi"]} {cm["member_name"]}'
+        else:
+            name = actor["name"]
+            block = "-"
+        return [MonthItem(slot, actor["type"], name, block) for slot in actor["timeslots"]]
+
+    def build_month_dataset(self) -> MonthDataset:
+        items = []
+        for actor in self.access_users + self.access_guests:
+            items.extend(self.build_month_items(actor))
+        return MonthDataset(self.target_year, self.target_month, items)
+
+
+def month_dataset_tags(target_year: int, target_month: int, *args, **kwargs) -> list[str]:
+    return [month_tag(target_year, target_month)]
+
+
+# 月のデータは (年, 月) ごとに1つだけキャッシュし、reservation と calendar (month, day) で共有する
+# 予約の承認やキャンセルがあった月は app.py が month タグを無効化するので、期限は長めにしてある
+# 過去の月は storebatch が作った利用データから作り、RemoteLock には問い合わせない (利用データが無ければ RemoteLock から作る)
+@hybrid_dict_cache(tags=month_dataset_tags)
+def make_month_dataset(target_year: int, target_month: int, local_ttl: int, s3_ttl: int, hard_ttl: int = None, __cache_refresh: bool = False) -> dict[str, Any]:
+    if target_month_is_past(target_year, target_month):
+        registered_users, _community_members = get_registered_users_and_community_members_from_workbook()
+        dataset: MonthDataset = make_month_dataset_from_used_data(get_cache_bucket(), target_year, target_month, registered_users)
+        if dataset is not None:
+            logger.info(f"month dataset {target_year}-{target_month:02} is built from used data. {len(dataset.rows)} items.")
+            return dataset.to_dict()
+    reporter: ReservationReporter = init_reporter_object(target_year, target_month)
+    return reporter.build_month_dataset().to_dict()
+
+
+USED_DATA_COLUMNS = ["slot_start", "slot_end", "user_email", "block", "kumi", "user_name", "guest_name", "objective"]
+
+
+# storebatch の利用データ (used_data のパーティション) から月のデータを作る
+# 月が終わった後に作られたもの (マニフェストの built_at が月末より後) でなければ、月の途中までしか入っていないので None を返す。
+# 利用データは1枠1行なので、同じ枠に access user と access guest の両方がある場合、access user は shared_access_users から作る。
+def make_month_dataset_from_used_data(s3bucket, target_year: int, target_month: int, registered_users: dict[str, Any]) -> MonthDataset:
+    manifest = read_manifest(s3bucket)
+    entry = (manifest or {}).get("months", {}).get(month_key(target_year, target_month))
+    last_day = date(target_year, target_month, calendar.monthrange(target_year, target_month)[1])
+    if entry is None or entry.get("built_at", "")[:10] <= last_day.isoformat():
+        return None
+    meta = read_partition_meta(s3bucket, target_year, target_month)
+    if meta is None:
+        return None
+    table = read_partition(s3bucket, meta, USED_DATA_COLUMNS)
+
+    def slot_of(slot_start: str, slot_end: str) -> Slot:
+        return Slot.from_times(date.fromisoformat(slot_start[:10]), slot_start[11:16], slot_end[11:16])
+
+    # 同じ枠は access user、access guest の順 (RemoteLock から作った場合と同じ) にするので、access user を先に入れる
+    items = [MonthItem(slot_of(slot_start, slot_end), "access_user", user_name, "定期予約(町内会公認団体)") for slot_start, slot_end, user_name, _user_email in table.shared_access_users]
+    columns = [table.columns[column] for column in USED_DATA_COLUMNS]
+    for slot_start, slot_end, user_email, block, kumi, user_name, guest_name, objective in zip(*columns):
+        if user_name == "" and guest_name == "":
+            # 予約の無い枠
+            continue
+        slot = slot_of(slot_start, slot_end)
+        if guest_name == "" and block == "" and kumi == "" and objective == "定期予約":
+            items.append(MonthItem(slot, "access_user", user_name, "定期予約(町内会公認団体)"))
+            continue
+        # access guest の user_name は町内会員の名前なので、名前は登録ユーザから取る
+        registered_user = registered_users.get(user_email)
+        name = registered_user["user_name"] if registered_user is not None else guest_name
+        items.append(MonthItem(slot, "access_guest", name, f"{block} {kumi} {user_name}"))
+    return MonthDataset(target_year, target_month, items)
+
+
+def get_month_dataset(target_year: int, target_month: int, local_ttl: int, s3_ttl: int, hard_ttl: int = None, cache_refresh: bool = False) -> MonthDataset:
+    data = make_month_dataset(target_year, target_month, local_ttl=local_ttl, s3_ttl=s3_ttl, hard_ttl=hard_ttl, __cache_refresh=cache_refresh)
+    return MonthDataset.from_dict(data)
+
+
+"""
+{
+    date: "2022-01-06",
+    timeslot: "09:00-13:00",
+    name: "名前",
+    block: "2ブロック2組",
+},
+"""
+
+
+def make_reservation_list(dataset: MonthDataset) -> list:
     ret = []
-    for user in reporter.access_users:
-        ret.extend(reporter.build_reservation_item(user))
-
-    for guest in reporter.access_guests:
-        ret.extend(reporter.build_reservation_item(guest))
+    # 月のデータは昇順 (同じ枠は access user が先) に並んでいる
+    for item in dataset.items:
+        ret.append({"start_time": item.slot.start_time_iso, "date": item.slot.iso_date, "timeslot": item.slot.timeslot, "name": item.name, "block": item.block})
+    return ret
 
-    # 昇順でソート
-    ret.sort(key=lambda x: x["start_time"])
 
-    return ret
+"""
+  {
+    start: new Date(),
+    title: "test",
+    description: "test description", // day only
+    color: "info", // primary or secondary
+    icon: "repeat", // or person // day only
+  },
+"""
 
 
-@hybrid_dict_cache()
-def make_calendar_list(target_year: int, target_month: int, start_date: datetime, scope: str, local_ttl: int, s3_ttl: int, __cache_refresh: bool = False):
-    reporter: ReservationReporter = init_reporter_object(target_year, target_month, start_date)
+def make_calendar_list(dataset: MonthDataset, target_date: date, scope: str) -> list:
     ret = []
+    # day は日ごとの索引でその日の予約だけを取り出す
+    items = dataset.day_items(target_date) if scope == "day" else dataset.items
+    for item in items:
+        calendar_item = {"start": item.slot.start_time_iso, "title": item.name}
+        if scope == "day":
+            calendar_item["icon"] = "repeat" if item.type == "access_user" else "person"  # access_user は定期予約なので repeat
+            calendar_item["description"] = f"{item.slot.timeslot} {item.block}"
+        calendar_item["color"] = "secondary"
+        ret.append(calendar_item)
+    return ret
 
-    for user in reporter.access_users:
-        ret.extend(reporter.build_calendar_item(user, scope))
-
-    print(f"access_guests_len={len(reporter.access_guests)}")
 
-    for guest in reporter.access_guests:
-        ret.extend(reporter.build_calendar_item(guest, scope))
-
-    return ret
+def target_month_is_past(target_year: int, target_month: int, today: date = None) -> bool:
+    if today is None:
+        today = date.today()
+    return (target_year, target_month) < (today.year, today.month)
+
+
+# ブラウザでのキャッシュ。過去の月はほぼ変わらないので1日、それ以外は毎回 ETag で確認させる
+def get_cache_control(target_year: int, target_month: int) -> str:
+    if target_month_is_past(target_year, target_month):
+        return "private, max-age=86400"
+    return "private, no-cache"
+
+
+# 月のデータのキャッシュの期限 (local_ttl, s3_ttl, hard_ttl)。期限はキャッシュのキーに含まれるので、handler と prewarm_handler で同じものを使う
+def get_month_dataset_ttls(target_year: int, target_month: int, today: date = None) -> tuple[int, int, int]:
+    if target_month_is_past(target_year, target_month, today):
+        return 3600 * 24, 3600 * 24 * 30 * 12 * 100, None  # 1 day, 100 years
+    # 予約の変更はタグの無効化で反映されるので、期限は RemoteLock を直接変更した場合などのためのもの
+    # s3_ttl の 1 日を過ぎても hard_ttl の 7 日以内なら前の値をすぐに返し、バックグラウンドで作り直す
+    return 3600 * 6, 3600 * 24, 3600 * 24 * 7  # 6 hours, 1 day, 7 days
+
+
+"""
+期間指定 (from, to) の問い合わせ
+月のデータ (月ごとのキャッシュ) を組み合わせ、期間内の予約を開始時刻の順に NDJSON (1行に1件) で返す。
+月のデータは最大 RANGE_WORKERS 件ずつ並列に取得し、古い月から順に行にしていくので、
+手元に持つ月のデータは RANGE_WORKERS 件程度に収まる。期間は RANGE_MAX_MONTHS か月まで。
+"""
+RANGE_MAX_MONTHS = 36
+RANGE_WORKERS = 4
+
+
+def load_month_dataset(target_year: int, target_month: int, cache_refresh: bool = False) -> MonthDataset:
+    local_ttl, s3_ttl, hard_ttl = get_month_dataset_ttls(target_year, target_month)
+    return get_month_dataset(target_year, target_month, local_ttl, s3_ttl, hard_ttl, cache_refresh)
+
+
+# start から end までの月のデータを月の順に返す。先の月は workers 件まで並列に取得しておく
+def iter_month_datasets(start: date, end: date, cache_refresh: bool = False, workers: int = RANGE_WORKERS):
+    # バケットはスレッドごとに作る (get_cache_bucket)。各スレッドが SSM を読みに行かないよう、設定だけを先に読んでおく
+    get_config()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for target_year, target_month in iter_months(start, end):
+            pending.append(executor.submit(load_month_dataset, target_year, target_month, cache_refresh))
+            if len(pending) >= workers:
+                yield pending.popleft().result()
+        while len(pending) > 0:
+            yield pending.popleft().result()
+
+
+# 期間内の予約を1件ずつ返す。format は reservation か calendar (calendar は scope=month と同じ形)
+def iter_range_items(format: str, start: date, end: date, cache_refresh: bool = False):
+    start_iso, end_iso = start.isoformat(), end.isoformat()
+    for dataset in iter_month_datasets(start, end, cache_refresh):
+        if format == "reservation":
+            items = make_reservation_list(dataset)
+        else:
+            items = make_calendar_list(dataset, start, "month")
+        for item in items:
+            day = item["start_time" if format == "reservation" else "start"][:10]
+            if start_iso <= day <= end_iso:
+                yield item
+
+
+def range_handler(event: dict, params: dict) -> dict[str, Any]:
+    format: str = params.get("format")
+    if not format in ("reservation", "calendar"):
+        return error_json("Bad parameter", f"invalid format {format}")
+    if not "to" in params:
+        return error_json("Bad parameter", "missing 'to'")
+    try:
+        start: date = date.fromisoformat(params["from"])
+        end: date = date.fromisoformat(params["to"])
+    except ValueError:
+        return error_json("invalid parameter", f"invalid date from={params['from']}, to={params['to']}")
+    if start > end or start.year < 2022:
+        return error_json("invalid parameter", f"invalid range from={start}, to={end}")
+    months: int = (end.year - start.year) * 12 + end.month - start.month + 1
+    if months > RANGE_MAX_MONTHS:
+        return error_json("invalid parameter", f"range must be within {RANGE_MAX_MONTHS} months")
+    cache_refresh: bool = str(params.get("cacheRefresh", "")).lower() in ("true", "1")
+
+    logger.info(f"format: {format}, from: {start}, to: {end}, months: {months}")
+    body = "".join(json.dumps(item, ensure_ascii=False) + "\n" for item in iter_range_items(format, start, end, cache_refresh))
+    return ret_body_cacheable(event, body.encode("utf-8"), "application/x-ndjson;charset=UTF-8", get_cache_control(end.year, end.month))
+
+
+# 内部用レポート (町内会員ごとの利用回数と請求料金、予約された枠数と利用率、解錠が無かった枠、解錠の失敗)
+# storebatch が作った利用データとイベントストアを集計する。期間は from, to (省略時は start の月)
+def usage_handler(event: dict, params: dict) -> dict[str, Any]:
+    try:
+        if "from" in params:
+            if not "to" in params:
+                return error_json("Bad parameter", "missing 'to'")
+            start: date = date.fromisoformat(params["from"])
+            end: date = date.fromisoformat(params["to"])
+        elif "start" in params:
+            start_date: str = date.today().isoformat() if params["start"] == "today" else params["start"]
+            start: date = date.fromisoformat(start_date).replace(day=1)
+            end: date = start.replace(day=calendar.monthrange(start.year, start.month)[1])
+        else:
+            return error_json("Bad parameter", "missing 'from' or 'start'")
+    except ValueError:
+        return error_json("invalid parameter", f"invalid date {params}")
+    if start > end or start.year < 2022:
+        return error_json("invalid parameter", f"invalid range from={start}, to={end}")
+    months: list[str] = [month_key(y, m) for y, m in iter_months(start, end)]
+    if len(months) > RANGE_MAX_MONTHS:
+        return error_json("invalid parameter", f"range must be within {RANGE_MAX_MONTHS} months")
+
+    # pandas は内部用レポートでのみ使うので、ここで読み込む
+    from usage import USAGE_COLUMNS, make_usage_report
+    from events import read_events
+
+    s3bucket = get_cache_bucket()
+    buffer_min: int = get_config().remotelock_buffer_min
+    t0 = time.perf_counter()
+    table = read_used_data(s3bucket, start, end, USAGE_COLUMNS)
+    events, event_months = read_events(s3bucket, start, end)
+    t1 = time.perf_counter()
+    report: dict[str, Any] = make_usage_report(table, events, event_months, buffer_min)
+    t2 = time.perf_counter()
+    logger.info(f"usage report from: {start}, to: {end}, rows: {len(table)}, events: {len(events['id'])}, read: {t1 - t0:.3f}s, aggregate: {t2 - t1:.3f}s")
+
+    built_months = {entry["month"] for entry in report["utilization"]["months"]}
+    report = {
+        "from": start.isoformat(),
+        "to": end.isoformat(),
+        "missing_months": [m for m in months if not m in built_months],
+        "missing_event_months": [m for m in months if not m in event_months],
+        **report,
+    }
+    return ret_json_cacheable(event, report, get_cache_control(end.year, end.month))
 
 
 @logger.inject_lambda_context(log_event=True)
@@ -222,10 +385,14 @@ def handler(event: dict, context: LambdaContext) -> dict[str, Any]:
         return error_json("Bad parameter", "No parameters")
 
     params = event["queryStringParameters"]
+    if params.get("format") == "usage":
+        return usage_handler(event, params)
+    if "from" in params:
+        return range_handler(event, params)
 
     if not "format" in params:
         return error_json("Bad parameter", "missing 'format'")
-    format: str = params["format"]  # reservation or calendar
+    format: str = params["format"]  # reservation, calendar or usage
 
     scope: str = None
     if format == "calendar":
@@ -235,7 +402,7 @@ def handler(event: dict, context: LambdaContext) -> dict[str, Any]:
 
     cache_refresh: bool = False
     if "cacheRefresh" in params:
-        cache_refresh = params["cacheRefresh"]
+        cache_refresh = str(params["cacheRefresh"]).lower() in ("true", "1")
 
     if not "start" in params:
         return error_json("Bad parameter", "missing 'start'")
@@ -249,20 +416,37 @@ def handler(event: dict, context: LambdaContext) -> dict[str, Any]:
         return error_json("invalid parameter", f"invalid target year {target_year}")
     if target_month < 1 or target_month > 12:
         return error_json("invalid parameter", f"invalid target month {target_month}")
-    today: datetime = datetime.now()
-    target_month_is_past = (today.year == target_year and today.month > target_month) or (target_month < today.year)
-    local_ttl = 3600 * 24  # 1 day
-    s3_ttl = 3600 * 24 * 30 * 12 * 100  # 100 years
-    if not target_month_is_past:
-        local_ttl = 3600  # 1 hour
-        s3_ttl = 3600 * 6  # 6 hours
+    local_ttl, s3_ttl, hard_ttl = get_month_dataset_ttls(target_year, target_month)
 
     logger.info(f"format: {format}, scope: {scope}, start_date: {start_date}, target_year: {target_year}, target_month: {target_month}, target_day: {target_day}")
 
+    cache_control: str = get_cache_control(target_year, target_month)
     if format == "reservation":
-        return ret_json(200, make_reservation_list(target_year, target_month, start_date, local_ttl, s3_ttl, cache_refresh))
+        dataset: MonthDataset = get_month_dataset(target_year, target_month, local_ttl, s3_ttl, hard_ttl, cache_refresh)
+        return ret_json_cacheable(event, make_reservation_list(dataset), cache_control)
     if format == "calendar":
         if scope == "month" or scope == "day":
-            return ret_json(200, make_calendar_list(target_year, target_month, start_date, scope, local_ttl, s3_ttl, cache_refresh))
+            dataset: MonthDataset = get_month_dataset(target_year, target_month, local_ttl, s3_ttl, hard_ttl, cache_refresh)
+            return ret_json_cacheable(event, make_calendar_list(dataset, date(target_year, target_month, target_day), scope), cache_control)
 
     return ret_json(400, {"message": f"Bad parameter: format={format}, scope={scope}"})
+
+
+# 先月、今月、来月の月のデータを作り直して S3 のキャッシュに入れておく (スケジュールで実行する)
+# reservation も calendar (month, day) も月のデータから作るので、月のデータだけを作れば全ての形式が温まる
+# 月が変わった直後は先月が過去の月の期限 (別のキャッシュのキー) になるので、先月も作る
+@logger.inject_lambda_context(log_event=True)
+def prewarm_handler(event: dict, context: LambdaContext) -> dict[str, Any]:
+    today: date = date.today()
+    this_month: date = today.replace(day=1)
+    last_month: date = (this_month - timedelta(days=1)).replace(day=1)
+    next_month: date = (this_month + timedelta(days=31)).replace(day=1)
+    ret = []
+    for target in (last_month, this_month, next_month):
+        local_ttl, s3_ttl, hard_ttl = get_month_dataset_ttls(target.year, target.month, today)
+        t0 = time.perf_counter()
+        dataset: MonthDataset = get_month_dataset(target.year, target.month, local_ttl, s3_ttl, hard_ttl, cache_refresh=True)
+        elapsed_ms = round((time.perf_counter() - t0) * 1000, 1)
+        logger.info({"service": "report", "command": "prewarm", "month": month_tag(target.year, target.month), "items": len(dataset.rows), "elapsed_ms": elapsed_ms})
+        ret.append({"month": f"{target.year:04}-{target.month:02}", "items": len(dataset.rows), "elapsed_ms": elapsed_ms})
+    return ret_json(200, {"message": "prewarmed", "months": ret})
@@ -0,0 +1,140 @@
+from datetime import date
+
+# 公会堂の時間枠。(開始時刻, 終了時刻, 判定時刻) で、開始/終了時刻は Reserva の予約枠と同じ。
+# access guest の鍵の有効時間帯が判定時刻 (0時からの分) をまたいでいれば、その枠を予約しているとみなす。
+# 鍵は予約の n 分前から有効になるので、判定時刻は枠の開始時刻より後にしてある。
+SLOT_TABLE: tuple[tuple[str, str, int], ...] = (
+    ("05:00", "09:00", 7 * 60),  # 早朝枠
+    ("09:00", "13:00", 10 * 60),  # 午前枠
+    ("13:00", "17:00", 15 * 60),  # 午後枠
+    ("17:00", "21:00", 19 * 60),  # 夜枠
+)
+SLOT_COUNT: int = len(SLOT_TABLE)
+SLOT_INDEX: dict[tuple[str, str], int] = {(start, end): i for i, (start, end, _probe) in enumerate(SLOT_TABLE)}
+MINUTES_PER_DAY: int = 24 * 60
+
+
+# 1日の中の1枠を表す不変な値
+# 日付の ordinal と SLOT_TABLE の添字を1つの整数 key (ordinal * SLOT_COUNT + index) として保持し、
+# 文字列表現は参照されたときに組み立てる。key の大小は時系列順と一致する。
+class Slot:
+    __slots__ = ("key",)
+
+    def __init__(self, ordinal: int, index: int) -> None:
+        if not 0 <= index < SLOT_COUNT:
+            raise ValueError(f"invalid slot index {index}")
+        object.__setattr__(self, "key", ordinal * SLOT_COUNT + index)
+
+    @classmethod
+    def from_key(cls, key: int) -> "Slot":
+        return cls(key // SLOT_COUNT, key % SLOT_COUNT)
+
+    @classmethod
+    def from_times(cls, day: date, start_time: str, end_time: str) -> "Slot":
+        index = SLOT_INDEX.get((start_time, end_time))
+        if index is None:
+            raise ValueError(f"{start_time}-{end_time} is not a slot of the hall")
+        return cls(day.toordinal(), index)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Slot is immutable")
+
+    def __reduce__(self):
+        return (Slot, (self.ordinal, self.index))
+
+    def __hash__(self) -> int:
+        return self.key
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, Slot):
+            return NotImplemented
+        return self.key == other.key
+
+    def __lt__(self, other: "Slot") -> bool:
+        return self.key < other.key
+
+    def __le__(self, other: "Slot") -> bool:
+        return self.key <= other.key
+
+    def __gt__(self, other: "Slot") -> bool:
+        return self.key > other.key
+
+    def __ge__(self, other: "Slot") -> bool:
+        return self.key >= other.key
+
+    def __repr__(self) -> str:
+        return f"Slot({self.iso_date} {self.timeslot})"
+
+    @property
+    def ordinal(self) -> int:
+        return self.key // SLOT_COUNT
+
+    @property
+    def index(self) -> int:
+        return self.key % SLOT_COUNT
+
+    @property
+    def date(self) -> date:
+        return date.fromordinal(self.ordinal)
+
+    # RemoteLock 形式 YYYY-MM-DD
+    @property
+    def iso_date(self) -> str:
+        return self.date.isoformat()
+
+    # Reserva 形式 YYYY/MM/DD
+    @property
+    def day(self) -> str:
+        return self.iso_date.replace("-", "/")
+
+    # HH:MM-HH:MM
+    @property
+    def timeslot(self) -> str:
+        start, end, _probe = SLOT_TABLE[self.index]
+        return f"{start}-{end}"
+
+    # YYYY/MM/DD HH:MM
+    @property
+    def start_time(self) -> str:
+        return f"{self.day} {SLOT_TABLE[self.index][0]}"
+
+    @property
+    def end_time(self) -> str:
+        return f"{self.day} {SLOT_TABLE[self.index][1]}"
+
+    # YYYY-MM-DDTHH:MM:00.000000
+    @property
+    def start_time_iso(self) -> str:
+        return f"{self.iso_date}T{SLOT_TABLE[self.index][0]}:00.000000"
+
+    @property
+    def end_time_iso(self) -> str:
+        return f"{self.iso_date}T{SLOT_TABLE[self.index][1]}:00.000000"
+
+
+# "YYYY-MM-DDTHH:MM:SS" 形式の日時文字列の日付部分を ordinal にする
+def iso_ordinal(dt: str) -> int:
+    return date(int(dt[:4]), int(dt[5:7]), int(dt[8:10])).toordinal()
+
+
+# 時間帯のリスト (starts_at, ends_at) をまとめて枠に分類する
+# 返り値は (開始日の ordinal のリスト, 枠のビットマスクのリスト)。ビット i は SLOT_TABLE[i] に対応する。
+# 時刻は開始日の0時からの分に揃え、開始は切り捨て、終了は切り上げる (秒単位で比較したのと同じ結果になる)。
+def classify_time_ranges(starts_at_list: list[str], ends_at_list: list[str]) -> tuple[list[int], list[int]]:
+    ordinals: list[int] = [iso_ordinal(s) for s in starts_at_list]
+    starts: list[int] = [int(s[11:13]) * 60 + int(s[14:16]) for s in starts_at_list]
+    ends: list[int] = [
+        (0 if e[:10] == s[:10] else (iso_ordinal(e) - o) * MINUTES_PER_DAY) + int(e[11:13]) * 60 + int(e[14:16]) + (e[17:19] != "00")
+        for o, s, e in zip(ordinals, starts_at_list, ends_at_list)
+    ]
+
+    # 枠ごとに全件をまとめて判定する
+    masks: list[int] = [0] * len(ordinals)
+    for index, (_start, _end, probe) in enumerate(SLOT_TABLE):
+        bit: int = 1 << index
+        masks = [m | bit if s < probe < e else m for m, s, e in zip(masks, starts, ends)]
+    return ordinals, masks
+
+
+def slots_from_mask(ordinal: int, mask: int) -> list[Slot]:
+    return [Slot(ordinal, index) for index in range(SLOT_COUNT) if mask >> index & 1]
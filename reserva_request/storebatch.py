@@ -1,20 +1,35 @@
-from report import get_all_registered_users
-from aws_lambda_powertools.utilities import parameters
+from members import get_all_registered_users
+from config import get_config
 from aws_lambda_powertools import Logger
 from aws_lambda_powertools.utilities.typing import LambdaContext
 from typing import Any
-from util import ret_json, error_json
+from util import ret_json, error_json, invalidate_cache_tags, month_tag
 from remotelock import RemoteLock
-from datetime import datetime, date
+from slot import Slot, SLOT_COUNT
+from datetime import datetime, date, timedelta
 from dateutil.relativedelta import relativedelta
+from events import update_event_store
+from used_data import UsedDataTable, PARTITION_ROOT, MANIFEST_KEY, partition_prefix, write_partition, month_key, read_manifest, write_manifest
+from concurrent.futures import ThreadPoolExecutor
 import calendar
-import pandas as pd
+import multiprocessing
+import os
+import re
+import time
+import traceback
 import boto3
-import botocore
 
 logger = Logger()
 
-COLUMNS = ["slot_start", "slot_end", "user_email", "block", "kumi", "official_flag", "external_flag", "user_name", "guest_name", "objective"]
+# 出力形式
+# partition は used_data のパーティション形式 (pandas 不要)、pkl は pandas の DataFrame (従来形式)
+OUTPUT_FORMATS = ["partition", "pkl"]
+
+
+def used_data_s3_key(target_year: int, target_month: int, output_format: str) -> str:
+    if output_format == "partition":
+        return f"{partition_prefix(target_year, target_month)}/meta.json"
+    return f"used_data_pkl/{target_year}-{target_month:02d}.pkl"
 
 
 def find_member(pre_registered_users, pre_registered_members, guest):
@@ -26,9 +41,22 @@ def find_member(pre_registered_users, pre_registered_members, guest):
     return user, member
 
 
-def make_row(pre_registered_users, pre_registered_members, access_users, access_guests, slot):
-    slot_start = slot["start_time_iso"]
-    slot_end = slot["end_time_iso"]
+# 枠 -> 予約者 (access user / access guest) の索引を1パスで作る
+# access user の後に access guest を入れるので、同じ枠に両方がある場合は access guest が優先される
+def make_slot_index(access_users, access_guests) -> dict[Slot, dict]:
+    slot_index: dict[Slot, dict] = {}
+    for actor in access_users:
+        for slot in actor["timeslots"]:
+            slot_index[slot] = actor
+    for actor in access_guests:
+        for slot in actor["timeslots"]:
+            slot_index[slot] = actor
+    return slot_index
+
+
+def make_row(pre_registered_users, pre_registered_members, slot_index: dict[Slot, dict], slot: Slot):
+    slot_start = slot.start_time_iso
+    slot_end = slot.end_time_iso
     user_email = ""
     block = ""
     kumi = ""
@@ -38,98 +66,269 @@ def make_row(pre_registered_users, pre_registered_members, access_users, access_
     guest_name = ""
     objective = ""
 
-    for user in access_users:
-        for user_time_slot in user["timeslots"]:
-            if user_time_slot["start_time_iso"] == slot_start and user_time_slot["end_time_iso"] == slot_end:
-                user_email = user["email"]
-                block = ""
-                kumi = ""
-                official_flag = str(True)
-                external_flag = str(False)
-                user_name = user["name"]
-                guest_name = ""
-                objective = "定期予約"
-                break
-
-    for guest in access_guests:
-        for guest_time_slot in guest["timeslots"]:
-            if guest_time_slot["start_time_iso"] == slot_start and guest_time_slot["end_time_iso"] == slot_end:
-                user, member = find_member(pre_registered_users, pre_registered_members, guest)
-                user_email = guest["email"]
-                block = member["block"]
-                kumi = member["kumi"]
-                official_flag = str(kumi == "公認団体")
-                external_flag = str(False)
-                user_name = member["member_name"]
-                guest_name = guest["name"]
-                objective = user["objective"]
-                break
+    actor = slot_index.get(slot)
+    if actor is None:
+        pass
+    elif actor["type"] == "access_user":
+        user_email = actor["email"]
+        official_flag = str(True)
+        external_flag = str(False)
+        user_name = actor["name"]
+        objective = "定期予約"
+    else:
+        user, member = find_member(pre_registered_users, pre_registered_members, actor)
+        user_email = actor["email"]
+        block = member["block"]
+        kumi = member["kumi"]
+        official_flag = str(kumi == "公認団体")
+        external_flag = str(False)
+        user_name = member["member_name"]
+        guest_name = actor["name"]
+        objective = user["objective"]
 
     return [slot_start, slot_end, user_email, block, kumi, official_flag, external_flag, user_name, guest_name, objective]
 
 
-def make_used_data_pkl(target_year: int, target_month: int, pre_registered_users: dict[str, Any], pre_registered_members: dict[str, Any], remotelock: RemoteLock):
-    start_day: datetime = datetime(target_year, target_month, 1)
+def make_used_data_table(pre_registered_users: dict[str, Any], pre_registered_members: dict[str, Any], slot_index: dict[Slot, dict], target_year: int, target_month: int) -> UsedDataTable:
+    table = UsedDataTable()
+    for day in range(calendar.monthrange(target_year, target_month)[1]):
+        ordinal: int = date(target_year, target_month, day + 1).toordinal()
+        for index in range(SLOT_COUNT):
+            slot = Slot(ordinal, index)
+            table.append(f"{day}-{index+1}", make_row(pre_registered_users, pre_registered_members, slot_index, slot))
+    return table
 
-    access_users = remotelock.get_users(start_day)
-    access_guests = remotelock.get_access_guests(target_year, target_month)
 
-    times = [("05:00", "09:00"), ("09:00", "13:00"), ("13:00", "17:00"), ("17:00", "21:00")]
-    df = pd.DataFrame(index=[], columns=COLUMNS)
-    for day in range(calendar.monthrange(target_year, target_month)[1]):
-        dt = date(target_year, target_month, day + 1)
-        dt_iso = dt.isoformat()
-        for time in times:
-            start_time, end_time = time
-            slot = remotelock.make_slot(dt.strftime("%Y-%m-%d"), dt_iso, start_time, end_time)
-            df.loc[f"{day}-{times.index(time)+1}"] = make_row(pre_registered_users, pre_registered_members, access_users, access_guests, slot)
+# 月の利用データを作成する。テーブルとマニフェストのエントリを返す。
+# access_users と access_guests は当該月の分 (RemoteLock.make_access_users / get_access_guests_range で取得したもの)
+def build_month(
+    target_year: int,
+    target_month: int,
+    pre_registered_users: dict[str, Any],
+    pre_registered_members: dict[str, Any],
+    access_users: list[dict],
+    access_guests: list[dict],
+) -> tuple[UsedDataTable, dict[str, Any]]:
+    slot_index = make_slot_index(access_users, access_guests)
+    table = make_used_data_table(pre_registered_users, pre_registered_members, slot_index, target_year, target_month)
+    # 行には access guest が入るので、同じ枠の access user は別に記録する (report が両方を表示できるように)
+    guest_slots = {slot for actor in access_guests for slot in actor["timeslots"]}
+    table.shared_access_users = [
+        [slot.start_time_iso, slot.end_time_iso, actor["name"], actor["email"]]
+        for slot, actor in sorted(((slot, actor) for actor in access_users for slot in actor["timeslots"] if slot in guest_slots), key=lambda r: r[0].key)
+    ]
 
     logger.info(f"{len(pre_registered_users)} registered users, {len(pre_registered_members)} registered members, {len(access_guests)} access guests, {len(access_users)} access users.")
 
-    file_name = f"{target_year}-{target_month:02d}.pkl"
-    local_file_name = f"/tmp/{file_name}"
-    s3_key = f"used_data_pkl/{file_name}"
-    df.to_pickle(f"/tmp/{file_name}")
-    s3 = boto3.resource("s3")
-    s3bucket = s3.Bucket(parameters.get_parameter("reserva_bucket_info"))
-    s3bucket.upload_file(local_file_name, s3_key)
-    logger.info(f"pkl file {s3_key} uploaded.")
+    entry = {
+        "num_rows": len(table),
+        "digest": table.digest(),
+        "access_users": len(access_users),
+        "access_guests": len(access_guests),
+        "built_at": datetime.now().isoformat(timespec="seconds"),
+    }
+    return table, entry
 
 
-def check_used_data_pkl(target_year: int, target_month: int):
-    today = date.today()
-    if today.year == target_year and today.month == target_month:
-        return True
+def upload_month(s3bucket, table: UsedDataTable, target_year: int, target_month: int, output_format: str) -> None:
+    s3_key = used_data_s3_key(target_year, target_month, output_format)
+    if output_format == "partition":
+        write_partition(s3bucket, table, target_year, target_month)
+    else:
+        local_file_name = f"/tmp/{s3_key.split('/')[-1]}"
+        table.write_pickle(local_file_name)
+        s3bucket.upload_file(local_file_name, s3_key)
+    logger.info(f"{output_format} file {s3_key} uploaded.")
 
-    file_name = f"{target_year}-{target_month:02d}.pkl"
-    s3_key = f"used_data_pkl/{file_name}"
-    s3 = boto3.resource("s3")
-    s3bucket = s3.Bucket(parameters.get_parameter("reserva_bucket_info"))
+
+# 複数の月を順に作成する。作成した月のアップロードはスレッドで行い、その間に次の月を作成する。
+# jobs は (年, 月, 前回のダイジェスト) のリスト。月毎に (年, 月, マニフェストのエントリ, 所要時間) を返す。
+def build_months(
+    jobs: list[tuple[int, int, str]],
+    pre_registered_users: dict[str, Any],
+    pre_registered_members: dict[str, Any],
+    access_user_records: list[dict],
+    access_guests_by_month: dict[str, list[dict]],
+    bucket_name: str,
+    output_format: str,
+) -> list[tuple[int, int, dict[str, Any], dict[str, Any]]]:
+    remotelock = RemoteLock()
+    s3bucket = boto3.resource("s3").Bucket(bucket_name)
+
+    def timed_upload(table, target_year, target_month) -> float:
+        t0 = time.perf_counter()
+        upload_month(s3bucket, table, target_year, target_month, output_format)
+        return time.perf_counter() - t0
+
+    results = []
+    with ThreadPoolExecutor(max_workers=1) as uploader:
+        for target_year, target_month, previous_digest in jobs:
+            t0 = time.perf_counter()
+            access_users = remotelock.make_access_users(access_user_records, datetime(target_year, target_month, 1))
+            access_guests = access_guests_by_month.get(month_key(target_year, target_month), [])
+            table, entry = build_month(target_year, target_month, pre_registered_users, pre_registered_members, access_users, access_guests)
+            build_sec = time.perf_counter() - t0
+            upload = None
+            if entry["digest"] != previous_digest:
+                upload = uploader.submit(timed_upload, table, target_year, target_month)
+            results.append((target_year, target_month, entry, build_sec, upload))
+
+        ret = []
+        for target_year, target_month, entry, build_sec, upload in results:
+            timing = {
+                "month": month_key(target_year, target_month),
+                "rows": entry["num_rows"],
+                "build_ms": round(build_sec * 1000, 1),
+                "upload_ms": round(upload.result() * 1000, 1) if upload else None,
+                "uploaded": upload is not None,
+            }
+            logger.info({"service": "storebatch", "command": "build_month", **timing})
+            ret.append((target_year, target_month, entry, timing))
+    return ret
+
+
+def build_months_worker(conn, *args) -> None:
     try:
-        s3bucket.Object(s3_key).load()
-        logger.info(f"pkl file exists.")
-        return False
-    except botocore.exceptions.ClientError as e:
-        if e.response["Error"]["Code"] == "404":
-            return True
+        conn.send(("ok", build_months(*args)))
+    except Exception:
+        conn.send(("error", traceback.format_exc()))
+    finally:
+        conn.close()
+
+
+# 月を子プロセスに振り分けて並列に作成する
+# Lambda には /dev/shm が無く multiprocessing.Pool や Queue が使えないため、Process と Pipe で実装している。
+# 子プロセスには fork で元データを引き継ぎ、結果だけを Pipe で受け取る。結果は月の順に並べて返すので、並列数によらず同じになる。
+# 失敗した子プロセスがあっても、他の子プロセスが作成 (アップロード) した月の結果と、失敗した子プロセスのエラーを返す。
+def build_months_parallel(jobs: list[tuple[int, int, str]], processes: int, *args) -> tuple[list[tuple[int, int, dict[str, Any], dict[str, Any]]], list[str]]:
+    workers = []
+    for i in range(min(processes, len(jobs))):
+        parent_conn, child_conn = multiprocessing.Pipe(duplex=False)
+        process = multiprocessing.Process(target=build_months_worker, args=(child_conn, jobs[i::processes], *args))
+        process.start()
+        child_conn.close()
+        workers.append((process, parent_conn))
+
+    ret = []
+    errors = []
+    for process, parent_conn in workers:
+        try:
+            status, result = parent_conn.recv()
+        except EOFError:
+            # 子プロセスが結果を送らずに終了した (メモリ不足で kill された等)
+            status, result = "error", "worker process exited without result"
+        process.join()
+        if status == "ok":
+            ret.extend(result)
         else:
-            raise
+            errors.append(result)
+    ret.sort(key=lambda r: (r[0], r[1]))
+    return ret, errors
+
+
+def manifest_key(output_format: str) -> str:
+    if output_format == "partition":
+        return MANIFEST_KEY
+    return "used_data_pkl/_manifest.json"
+
+
+# マニフェストを1回読む。まだ無い場合はプレフィックスを1回一覧して既存の月からマニフェストを作る。
+def load_manifest(s3bucket, output_format: str) -> dict[str, Any]:
+    manifest = read_manifest(s3bucket, manifest_key(output_format))
+    if manifest is not None:
+        return manifest
+
+    if output_format == "partition":
+        prefix, pattern = PARTITION_ROOT, re.compile(r"/year=([0-9]{4})/month=([0-9]{2})/meta\.json$")
+    else:
+        prefix, pattern = "used_data_pkl/", re.compile(r"/([0-9]{4})-([0-9]{2})\.pkl$")
+    months = {}
+    for obj in s3bucket.objects.filter(Prefix=prefix):
+        m = pattern.search(obj.key)
+        if m:
+            months[month_key(int(m.group(1)), int(m.group(2)))] = {}
+    logger.info(f"manifest not found. {len(months)} months found by listing {prefix}.")
+    return {"months": months}
+
+
+# 作成する月を決める
+# - マニフェストに無い月は作成する
+# - RemoteLock に元データが残っている月 (期限切れの access guest が削除される前の月) は作成し直し、内容が変わっていればアップロードする
+# それより古い月は、元データが削除されて内容が欠けるため作成し直さない
+def plan_months(manifest: dict[str, Any], months: list[tuple[int, int]], today: date, expired_days: int) -> list[tuple[int, int]]:
+    retention_start: date = today - timedelta(days=expired_days)
+    ret = []
+    for year, month in months:
+        month_end = date(year, month, calendar.monthrange(year, month)[1])
+        if not month_key(year, month) in manifest["months"] or month_end >= retention_start:
+            ret.append((year, month))
+    return ret
 
 
 @logger.inject_lambda_context(log_event=True)
 def handler(event: dict, context: LambdaContext) -> dict[str, Any]:
+    # スケジュールイベントで {"format": "pkl"} を指定すると従来の pkl 形式で出力する (pandas が必要)
+    if not isinstance(event, dict):
+        event = {}
+    output_format: str = event.get("format", "partition")
+    if not output_format in OUTPUT_FORMATS:
+        return error_json("Bad parameter", f"invalid format {output_format}")
+
     remotelock = RemoteLock()
     pre_registered_users, pre_registered_members = get_all_registered_users()
+    s3 = boto3.resource("s3")
+    config = get_config()
+    s3bucket = s3.Bucket(config.reserva_bucket_info)
+    expired_days: int = config.remotelock_expired_days_for_access_guest
 
-    thismonth_start = date.today().replace(day=1)
+    # 解錠イベントを取り込む。失敗しても利用データの作成は続ける
+    events_result = None
+    try:
+        events_result = update_event_store(s3bucket, remotelock)
+        logger.info({"service": "storebatch", "command": "update_event_store", **events_result})
+    except Exception as e:
+        logger.error({"service": "storebatch", "command": "update_event_store", "error": str(e)})
+
+    today = date.today()
+    thismonth_start = today.replace(day=1)
+    months = []
     for i in range(0, 24):
         target_day = thismonth_start - relativedelta(months=i)
-        target_year = target_day.year
-        target_month = target_day.month
-        logger.info(f"target_year={target_year}, target_month={target_month}")
-        if check_used_data_pkl(target_year, target_month):
-            make_used_data_pkl(target_year, target_month, pre_registered_users, pre_registered_members, remotelock)
-        else:
-            break
+        months.append((target_day.year, target_day.month))
+
+    manifest = load_manifest(s3bucket, output_format)
+    targets = plan_months(manifest, months, today, expired_days)
+    if len(targets) == 0:
+        return ret_json(200, {"message": "no month to build", "months": [], "events": events_result})
+
+    # access user と access guest は対象の全期間分をまとめて1回だけ取得する
+    access_user_records = remotelock.get_access_user_records()
+    oldest_year, oldest_month = min(targets)
+    newest_year, newest_month = max(targets)
+    access_guests_by_month = remotelock.get_access_guests_range(oldest_year, oldest_month, newest_year, newest_month)
+    logger.info(f"{len(access_user_records)} access users, {sum(len(g) for g in access_guests_by_month.values())} access guests for {len(targets)} months.")
+
+    jobs = [(y, m, manifest["months"].get(month_key(y, m), {}).get("digest")) for y, m in targets]
+    args = (pre_registered_users, pre_registered_members, access_user_records, access_guests_by_month, s3bucket.name, output_format)
+    # 並列数は Lambda の vCPU 数。{"parallel": false} で直列に実行する
+    processes: int = os.cpu_count() or 1
+    if event.get("parallel", True) and processes > 1 and len(jobs) > 1:
+        results, errors = build_months_parallel(jobs, processes, *args)
+    else:
+        results, errors = build_months(jobs, *args), []
+
+    for target_year, target_month, entry, _timing in results:
+        manifest["months"][month_key(target_year, target_month)] = entry
+    write_manifest(s3bucket, manifest, manifest_key(output_format))
+
+    # report は過去の月を利用データから作るので、アップロードした月のキャッシュを無効化する
+    # (利用データができる前に RemoteLock から作ってキャッシュした月も、次は利用データから作り直される)
+    uploaded = [month_tag(y, m) for y, m, _entry, timing in results if timing["uploaded"]]
+    if output_format == "partition" and len(uploaded) > 0:
+        invalidate_cache_tags(uploaded, s3bucket)
+
+    # 失敗した月があれば、作成できた月をマニフェストに記録してキャッシュを無効化してから失敗にする
+    if len(errors) > 0:
+        raise RuntimeError(f"month build failed in worker process: {errors[0]}")
 
-    return ret_json(200, {"message": "hello world"})
+    return ret_json(200, {"message": f"{len(results)} months built", "months": [timing for _y, _m, _entry, timing in results], "events": events_result})
@@ -0,0 +1,170 @@
+from used_data import UsedDataTable
+from typing import Any
+from datetime import date
+import numpy as np
+import pandas as pd
+
+# 利用料金 (2024年4月の町内会総会で決定。2024年5月以降の都度予約1枠ごと)
+FEE_PER_SLOT = 500
+FEE_START_DATE = date(2024, 5, 1)
+
+# 集計に使う利用データの列
+USAGE_COLUMNS = ["slot_start", "slot_end", "block", "kumi", "official_flag", "user_name"]
+
+"""
+内部用レポートの集計
+  利用データ (1行 = 1日の1枠) を DataFrame にし、行ごとの判定 (予約済み、都度予約、請求対象) を列として一度に作ってから groupby で集計する。
+  都度予約は町内会員 (ブロック、組、町内会員名) ごとに、定期予約は団体名ごとに数える。
+  町内会公認団体 (official_flag が True) の枠は請求しない。
+  解錠イベントがある月は、予約された枠ごとに成功した解錠があったかを区間結合で調べ、解錠が無かった枠と解錠の失敗を数える。
+"""
+
+
+def make_usage_frame(table: UsedDataTable) -> pd.DataFrame:
+    df = pd.DataFrame({column: table.columns[column] for column in USAGE_COLUMNS}, dtype=object)
+    df["month"] = df["slot_start"].str[:7]
+    df["reserved"] = df["user_name"] != ""
+    # 都度予約の行には町内会員のブロックが入り、定期予約の行は空になる
+    df["guest"] = df["reserved"] & (df["block"] != "")
+    df["access_user"] = df["reserved"] & (df["block"] == "")
+    df["billable"] = df["guest"] & (df["official_flag"] != "True") & (df["slot_start"] >= FEE_START_DATE.isoformat())
+    return df
+
+
+def aggregate_members(df: pd.DataFrame) -> list[dict[str, Any]]:
+    guests = df[df["guest"]]
+    if guests.empty:
+        return []
+    keys = ["block", "kumi", "user_name"]
+    totals = guests.groupby(keys).agg(slots=("guest", "size"), billable_slots=("billable", "sum"))
+    months = guests.groupby(keys + ["month"]).size().unstack(fill_value=0)
+    totals = totals.join(months).sort_values(["slots", "block", "kumi"], ascending=[False, True, True])
+
+    ret = []
+    for (block, kumi, member_name), row in zip(totals.index, totals.itertuples(index=False)):
+        billable_slots = int(row.billable_slots)
+        ret.append(
+            {
+                "block": block,
+                "kumi": kumi,
+                "member_name": member_name,
+                "slots": int(row.slots),
+                "billable_slots": billable_slots,
+                "fee": billable_slots * FEE_PER_SLOT,
+                "months": {month: int(count) for month, count in zip(months.columns, row[2:]) if count > 0},
+            }
+        )
+    return ret
+
+
+def aggregate_blocks(df: pd.DataFrame) -> list[dict[str, Any]]:
+    guests = df[df["guest"]]
+    if guests.empty:
+        return []
+    totals = guests.groupby(["block", "kumi"]).agg(slots=("guest", "size"), billable_slots=("billable", "sum"), members=("user_name", "nunique"))
+    return [
+        {"block": block, "kumi": kumi, "members": int(members), "slots": int(slots), "billable_slots": int(billable_slots), "fee": int(billable_slots) * FEE_PER_SLOT}
+        for (block, kumi), (slots, billable_slots, members) in zip(totals.index, totals.itertuples(index=False))
+    ]
+
+
+def aggregate_groups(df: pd.DataFrame) -> list[dict[str, Any]]:
+    counts = df[df["access_user"]].groupby("user_name").size().sort_values(ascending=False)
+    return [{"name": name, "slots": int(slots)} for name, slots in counts.items()]
+
+
+# 月ごとの予約された枠数と利用率 (予約された枠数 / 全枠数)
+def aggregate_utilization(df: pd.DataFrame) -> dict[str, Any]:
+    months = df.groupby("month").agg(slots=("reserved", "size"), reserved_slots=("reserved", "sum"), guest_slots=("guest", "sum"), access_user_slots=("access_user", "sum"))
+
+    def make_entry(slots: int, reserved_slots: int, guest_slots: int, access_user_slots: int) -> dict[str, Any]:
+        return {
+            "slots": int(slots),
+            "reserved_slots": int(reserved_slots),
+            "guest_slots": int(guest_slots),
+            "access_user_slots": int(access_user_slots),
+            "rate": round(reserved_slots / slots, 4) if slots > 0 else 0.0,
+        }
+
+    return {
+        "months": [{"month": month, **make_entry(*row)} for month, row in zip(months.index, months.itertuples(index=False))],
+        "total": make_entry(*months.sum()) if not months.empty else make_entry(0, 0, 0, 0),
+    }
+
+
+"""
+予約された枠と解錠イベントの区間結合
+  鍵は予約の remotelock_buffer_min 分前から有効になるので、枠の区間は [開始 - buffer_min, 終了 - buffer_min) とする。
+  終了の直前の buffer_min 分は次の枠の予約者が入る時間なので、次の枠に数える (同じ解錠が2つの枠に数えられることはない)。
+  イベントの時刻を並べた配列に対して各区間の両端を searchsorted で引き、差を区間内のイベント数とする。
+  結合は時刻だけで行い、解錠した人が枠の予約者かどうかは見ない (利用データに予約者の RemoteLock の id が無いため)。
+  そのため active_slots は「枠の時間帯に扉が解錠された」枠の数で、予約者が来たかどうか (出席) ではない。
+  同じ時間帯に別の人 (access user など) が解錠すれば、予約者が来なかった枠も active になる。
+"""
+
+
+# 成功した解錠かどうか
+def unlocked_mask(columns: dict[str, list]) -> np.ndarray:
+    event_types = np.asarray(columns["event_type"], dtype=object)
+    statuses = np.asarray(columns["status"], dtype=object)
+    return (event_types == "unlocked_event") & (statuses != "failed")
+
+
+# 枠ごと (開始と終了は分) に区間内のイベント数を返す。event_minutes は並んでいなくてもよい
+def count_events_in_slots(event_minutes: np.ndarray, slot_starts: np.ndarray, slot_ends: np.ndarray, buffer_min: int) -> np.ndarray:
+    sorted_minutes = np.sort(np.asarray(event_minutes, dtype=np.int64))
+    return np.searchsorted(sorted_minutes, slot_ends - buffer_min, side="left") - np.searchsorted(sorted_minutes, slot_starts - buffer_min, side="left")
+
+
+# "YYYY-MM-DDTHH:MM:SS..." の列を 1970-01-01 0時からの分にする (events.iso_minute と同じ値)
+def slot_minutes(values: pd.Series) -> np.ndarray:
+    return pd.to_datetime(values.str[:19], format="%Y-%m-%dT%H:%M:%S").to_numpy().astype("datetime64[m]").astype(np.int64)
+
+
+# 解錠イベントのある月 (event_months) について、予約された枠の時間帯の解錠の有無と解錠の失敗を集計する
+def aggregate_unlocks(df: pd.DataFrame, events: dict[str, list], event_months: list[str], buffer_min: int) -> dict[str, Any]:
+    reserved = df[df["reserved"] & df["month"].isin(event_months)]
+    unlocked = unlocked_mask(events)
+    minutes = np.asarray(events["minute"], dtype=np.int64)
+    active = count_events_in_slots(minutes[unlocked], slot_minutes(reserved["slot_start"]), slot_minutes(reserved["slot_end"]), buffer_min) > 0
+    reserved = reserved.assign(active=active)
+
+    failed = pd.DataFrame({column: events[column] for column in ["occurred_at", "event_type", "status", "user_type", "user_id"]}, dtype=object)[~unlocked]
+    months = reserved.groupby("month").agg(reserved_slots=("active", "size"), active_slots=("active", "sum")).reindex(event_months, fill_value=0)
+    months["failed_unlocks"] = failed["occurred_at"].str[:7].value_counts().reindex(event_months, fill_value=0)
+
+    inactive = reserved[~reserved["active"]]
+    return {
+        "buffer_min": buffer_min,
+        "months": [
+            {
+                "month": month,
+                "reserved_slots": int(reserved_slots),
+                "active_slots": int(active_slots),
+                "inactive_slots": int(reserved_slots - active_slots),
+                "failed_unlocks": int(failed_unlocks),
+                "active_rate": round(active_slots / reserved_slots, 4) if reserved_slots > 0 else 0.0,
+            }
+            for month, (reserved_slots, active_slots, failed_unlocks) in zip(months.index, months.itertuples(index=False))
+        ],
+        "inactive_reservations": inactive[["slot_start", "slot_end", "block", "kumi", "user_name"]].to_dict(orient="records"),
+        "failed_unlocks": failed.to_dict(orient="records"),
+    }
+
+
+# 利用データから内部用レポートを作る
+# events (events.read_events で読んだもの) を渡すと、event_months の月について解錠が無かった枠と解錠の失敗も集計する
+def make_usage_report(table: UsedDataTable, events: dict[str, list] = None, event_months: list[str] = None, buffer_min: int = 0) -> dict[str, Any]:
+    df = make_usage_frame(table)
+    members = aggregate_members(df)
+    ret = {
+        "fee_per_slot": FEE_PER_SLOT,
+        "total_fee": sum(member["fee"] for member in members),
+        "members": members,
+        "blocks": aggregate_blocks(df),
+        "groups": aggregate_groups(df),
+        "utilization": aggregate_utilization(df),
+    }
+    if events is not None:
+        ret["unlocks"] = aggregate_unlocks(df, events, event_months, buffer_min)
+    return ret
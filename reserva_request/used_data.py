@@ -0,0 +1,214 @@
+from typing import Any, Callable
+from datetime import date
+import hashlib
+import json
+import zlib
+import botocore
+
+# 月単位の利用データ (1行 = 1日の1枠) の列
+COLUMNS = ["slot_start", "slot_end", "user_email", "block", "kumi", "official_flag", "external_flag", "user_name", "guest_name", "objective"]
+
+# パーティションの形式のバージョン。形式を変えたら上げる (プレフィックスが変わるので新旧は共存できる)
+SCHEMA_VERSION = 1
+PARTITION_ROOT = f"used_data/v{SCHEMA_VERSION}"
+
+
+# 利用データを列ごとのリストとして組み立てる
+# 行を追加するたびに DataFrame を伸ばすのではなく、最後に一度だけ表に変換する。pandas は to_dataframe でのみ読み込む。
+# 1枠1行なので、同じ枠に access guest がいる access user (定期予約) は行に入らない。それらは shared_access_users に
+# [slot_start, slot_end, user_name, user_email] として持つ
+class UsedDataTable:
+    def __init__(self, columns: list[str] = COLUMNS) -> None:
+        self.index: list[str] = []
+        self.columns: dict[str, list] = {column: [] for column in columns}
+        self.shared_access_users: list[list[str]] = []
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def append(self, label: str, row: list) -> None:
+        self.index.append(label)
+        for values, value in zip(self.columns.values(), row):
+            values.append(value)
+
+    def extend(self, other: "UsedDataTable") -> None:
+        self.index.extend(other.index)
+        for column, values in self.columns.items():
+            values.extend(other.columns[column])
+
+    # 従来の pkl と同じ形 (全列 object 型、行ラベルは "日-枠") の DataFrame にする
+    def to_dataframe(self):
+        import pandas as pd
+
+        return pd.DataFrame(self.columns, index=pd.Index(self.index, dtype=object), columns=list(self.columns), dtype=object)
+
+    def write_pickle(self, path: str) -> None:
+        self.to_dataframe().to_pickle(path)
+
+    # 内容が同じなら同じ値になるダイジェスト。再作成した月の内容が変わったかどうかの判定に使う
+    # shared_access_users が無い月は以前と同じ値にする
+    def digest(self) -> str:
+        content = [self.index, self.columns] + ([self.shared_access_users] if len(self.shared_access_users) > 0 else [])
+        return hashlib.sha256(json.dumps(content, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+"""
+パーティション形式 (PARTITION_ROOT/year=YYYY/month=MM/)
+  data.bin  : 列ごとに JSON の配列を zlib で圧縮したものを連結したもの
+  meta.json : スキーマのバージョン、行数、各列の data.bin 内の位置と統計情報 (min, max, 空文字の数, 異なり数)、
+              行に入らなかった access user (shared_access_users。以前のものには無い)
+読み込み時は meta.json だけを見て月や日付で対象を絞り込み、必要な列の範囲だけを data.bin から Range 指定で取得する。
+"""
+
+
+def partition_prefix(year: int, month: int) -> str:
+    return f"{PARTITION_ROOT}/year={year:04}/month={month:02}"
+
+
+def column_stats(values: list) -> dict[str, Any]:
+    non_empty = [v for v in values if v != ""]
+    return {
+        "min": min(non_empty) if non_empty else None,
+        "max": max(non_empty) if non_empty else None,
+        "empty_count": len(values) - len(non_empty),
+        "distinct_count": len(set(values)),
+    }
+
+
+def encode_partition(table: UsedDataTable, year: int, month: int) -> tuple[dict[str, Any], bytes]:
+    chunks: list[bytes] = []
+    offset: int = 0
+
+    def add_chunk(values: list) -> dict[str, int]:
+        nonlocal offset
+        chunk = zlib.compress(json.dumps(values, ensure_ascii=False).encode("utf-8"), 9)
+        chunks.append(chunk)
+        ret = {"offset": offset, "length": len(chunk)}
+        offset += len(chunk)
+        return ret
+
+    meta: dict[str, Any] = {
+        "schema_version": SCHEMA_VERSION,
+        "year": year,
+        "month": month,
+        "num_rows": len(table),
+        "index": add_chunk(table.index),
+        "columns": [],
+        "shared_access_users": table.shared_access_users,
+    }
+    for column, values in table.columns.items():
+        meta["columns"].append({"name": column, "type": "string", **add_chunk(values), "stats": column_stats(values)})
+    return meta, b"".join(chunks)
+
+
+# read_range(offset, length) で data.bin の一部を読み、必要な列だけを展開する
+# 複数の列を読む場合は、先頭の列から末尾の列までを1回で読む
+def decode_partition(meta: dict[str, Any], read_range: Callable[[int, int], bytes], columns: list[str] = None) -> UsedDataTable:
+    if meta["schema_version"] != SCHEMA_VERSION:
+        raise RuntimeError(f"unsupported schema version {meta['schema_version']}")
+    if columns is None:
+        columns = [c["name"] for c in meta["columns"]]
+    column_meta = {c["name"]: c for c in meta["columns"]}
+    targets = [meta["index"]] + [column_meta[column] for column in columns]
+    start = min(t["offset"] for t in targets)
+    end = max(t["offset"] + t["length"] for t in targets)
+    data = read_range(start, end - start)
+
+    def load(t: dict) -> list:
+        return json.loads(zlib.decompress(data[t["offset"] - start : t["offset"] - start + t["length"]]).decode("utf-8"))
+
+    table = UsedDataTable(columns)
+    table.index = load(meta["index"])
+    table.shared_access_users = meta.get("shared_access_users", [])
+    for column in columns:
+        table.columns[column] = load(column_meta[column])
+    return table
+
+
+def write_partition(s3bucket, table: UsedDataTable, year: int, month: int) -> dict[str, Any]:
+    meta, data = encode_partition(table, year, month)
+    prefix = partition_prefix(year, month)
+    # meta.json が存在すれば data.bin も揃っているように、data.bin を先に書く
+    s3bucket.Object(f"{prefix}/data.bin").put(Body=data, ContentType="application/octet-stream")
+    s3bucket.Object(f"{prefix}/meta.json").put(Body=json.dumps(meta, ensure_ascii=False), ContentType="application/json")
+    return meta
+
+
+# S3 の JSON オブジェクトを読む。存在しない場合は None
+def get_json(s3bucket, key: str) -> Any:
+    try:
+        res = s3bucket.Object(key).get()
+    except botocore.exceptions.ClientError as e:
+        if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+            return None
+        raise
+    return json.loads(res["Body"].read().decode("utf-8"))
+
+
+def read_partition_meta(s3bucket, year: int, month: int) -> dict[str, Any]:
+    return get_json(s3bucket, f"{partition_prefix(year, month)}/meta.json")
+
+
+def read_partition(s3bucket, meta: dict[str, Any], columns: list[str] = None) -> UsedDataTable:
+    obj = s3bucket.Object(f"{partition_prefix(meta['year'], meta['month'])}/data.bin")
+
+    def read_range(offset: int, length: int) -> bytes:
+        return obj.get(Range=f"bytes={offset}-{offset + length - 1}")["Body"].read()
+
+    return decode_partition(meta, read_range, columns)
+
+
+def iter_months(start: date, end: date):
+    year, month = start.year, start.month
+    while (year, month) <= (end.year, end.month):
+        yield year, month
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+
+
+# start から end まで (両端を含む) の利用データをパーティションから読む
+# columns を指定した場合はその列だけを取得する。パーティションが存在しない月は飛ばす。
+def read_used_data(s3bucket, start: date, end: date, columns: list[str] = None) -> UsedDataTable:
+    if columns is None:
+        columns = list(COLUMNS)
+    # 日付での絞り込みに slot_start が必要なので、指定がなくても読む
+    read_columns = columns if "slot_start" in columns else ["slot_start"] + columns
+    start_iso, end_iso = start.isoformat(), end.isoformat()
+
+    ret = UsedDataTable(columns)
+    for year, month in iter_months(start, end):
+        meta = read_partition_meta(s3bucket, year, month)
+        if meta is None or meta["num_rows"] == 0:
+            continue
+        stats = next(c["stats"] for c in meta["columns"] if c["name"] == "slot_start")
+        if stats["max"][:10] < start_iso or stats["min"][:10] > end_iso:
+            continue
+        part = read_partition(s3bucket, meta, read_columns)
+        selected = [i for i, slot_start in enumerate(part.columns["slot_start"]) if start_iso <= slot_start[:10] <= end_iso]
+        if len(selected) == len(part):
+            ret.extend(part)
+            continue
+        ret.index.extend(part.index[i] for i in selected)
+        for column in columns:
+            values = part.columns[column]
+            ret.columns[column].extend(values[i] for i in selected)
+    return ret
+
+
+"""
+マニフェスト (PARTITION_ROOT/_manifest.json)
+  どの月が存在するかを月毎のエントリ (行数、内容のダイジェスト、元データの件数、作成日時) で記録する。
+  存在確認のために月毎に HEAD を投げるのではなく、これを1回読めば済むようにする。
+"""
+MANIFEST_KEY = f"{PARTITION_ROOT}/_manifest.json"
+
+
+def month_key(year: int, month: int) -> str:
+    return f"{year:04}-{month:02}"
+
+
+def read_manifest(s3bucket, key: str = MANIFEST_KEY) -> dict[str, Any]:
+    return get_json(s3bucket, key)
+
+
+def write_manifest(s3bucket, manifest: dict[str, Any], key: str = MANIFEST_KEY) -> None:
+    s3bucket.Object(key).put(Body=json.dumps(manifest, ensure_ascii=False, sort_keys=True), ContentType="application/json")
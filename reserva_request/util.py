@@ -1,14 +1,20 @@
-from aws_lambda_powertools.utilities import parameters
+from config import get_config
 
-from typing import Any
+from typing import Any, Callable, NamedTuple
+from collections import OrderedDict
 import json
-import gspread
 from datetime import datetime, timedelta, timezone
 
+import base64
 import hashlib
 import json
 import boto3
-from functools import wraps
+import botocore
+from functools import cache, wraps
+import threading
+import time
+import gzip
+import zlib
 
 
 def ret_json(status_code: int, json_dict: dict) -> dict[str, Any]:
@@ -19,11 +25,254 @@ def error_json(title: str, message: str) -> dict[str, Any]:
     return ret_json(400, {"title": title, "message": message})
 
 
-def hybrid_dict_cache(local_ttl_argname: str = "local_ttl", s3_ttl_argname: str = "s3_ttl", default_local_ttl: int = 300, default_s3_ttl: int = 3600 * 24, __local_only: bool = False):
+# 対応している圧縮形式。br は brotli モジュールがある場合だけ使う
+# 最初の応答のときに一度だけ決める (brotli の import を応答ごとに試さない)
+@cache
+def response_encoders() -> dict[str, Callable[[bytes], bytes]]:
+    ret = {"gzip": lambda body: gzip.compress(body, 6, mtime=0)}
+    try:
+        import brotli
 
-    s3 = boto3.resource("s3")
-    s3bucket = s3.Bucket(parameters.get_parameter("reserva_bucket_info"))
-    cache: dict = {}
+        ret["br"] = lambda body: brotli.compress(body, quality=5)
+    except ImportError:
+        pass
+    return ret
+
+
+# Accept-Encoding から使う圧縮形式を選ぶ (br を優先、q=0 は不可)。圧縮しない場合は None
+def choose_encoding(accept_encoding: str, encoders: dict) -> str:
+    accepted = {}
+    for part in accept_encoding.split(","):
+        name, _sep, params = part.strip().partition(";")
+        q = 1.0
+        for param in params.split(";"):
+            key, _eq, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[name.strip().lower()] = q
+    for name in ("br", "gzip"):
+        q = accepted.get(name, accepted.get("*", 0.0))
+        if name in encoders and q > 0:
+            return name
+    return None
+
+
+# HTTP のキャッシュに対応した ret_json
+def ret_json_cacheable(event: dict, json_dict: Any, cache_control: str, min_compress_size: int = 1024) -> dict[str, Any]:
+    body = json.dumps(json_dict, ensure_ascii=False).encode("utf-8")
+    return ret_body_cacheable(event, body, "application/json;charset=UTF-8", cache_control, min_compress_size)
+
+
+# 内容のハッシュを ETag にし、If-None-Match が一致すれば本文なしの 304 を返す。
+# Accept-Encoding に応じて圧縮し (min_compress_size バイト以上の場合)、Base64 にして返す。
+def ret_body_cacheable(event: dict, body: bytes, content_type: str, cache_control: str, min_compress_size: int = 1024) -> dict[str, Any]:
+    request_headers = {k.lower(): v for k, v in (event.get("headers") or {}).items()}
+    # 圧縮の有無によらず同じ内容なので弱い ETag にする
+    etag = f'W/"{hashlib.sha256(body).hexdigest()[:32]}"'
+    headers = {"Content-Type": content_type, "ETag": etag, "Cache-Control": cache_control, "Vary": "Accept-Encoding"}
+
+    if_none_match = request_headers.get("if-none-match", "")
+    candidates = [tag.strip() for tag in if_none_match.split(",") if tag.strip()]
+    if "*" in candidates or etag.removeprefix("W/") in [tag.removeprefix("W/") for tag in candidates]:
+        return {"statusCode": 304, "headers": headers, "body": ""}
+
+    encoders = response_encoders()
+    encoding = choose_encoding(request_headers.get("accept-encoding", ""), encoders) if len(body) >= min_compress_size else None
+    if encoding is None:
+        return {"statusCode": 200, "headers": headers, "body": body.decode("utf-8")}
+    headers["Content-Encoding"] = encoding
+    return {"statusCode": 200, "headers": headers, "body": base64.b64encode(encoders[encoding](body)).decode("ascii"), "isBase64Encoded": True}
+
+
+class CacheEntry(NamedTuple):
+    data: Any
+    local_expire: datetime
+    etag: str
+    s3_expire: datetime
+    hard_expire: datetime  # この時刻までは期限切れでも (再計算の間の) 古い値として返せる
+    size: int  # JSON にしたときのバイト数 (メモリ使用量の目安)
+    created: datetime  # 計算を始めた時刻。タグを無効化した時刻より前なら使わない
+
+
+# hybrid_dict_cache のプロセス内のキャッシュ
+# 件数 (max_entries) とおおよそのバイト数 (max_bytes) の上限を超えたら、最後に使われたのが古い順に捨てる。
+# ローカルの期限が切れても hard_expire までは、S3 の再検証や古い値を返すのに使えるので残す。
+# それ以外の期限切れは sweep_interval 秒ごとにまとめて捨てる。
+# バックグラウンドの再計算からも書き込むので、操作は lock の中で行う。
+class LocalCache:
+    def __init__(self, max_entries: int, max_bytes: int, sweep_interval: int = 60) -> None:
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sweep_interval = sweep_interval
+        self.entries: OrderedDict[str, CacheEntry] = OrderedDict()
+        self.bytes: int = 0
+        self.last_sweep: datetime = datetime.now(timezone.utc)
+        self.lock = threading.Lock()
+        self.stats: dict[str, int] = {"hits": 0, "s3_hits": 0, "revalidated": 0, "misses": 0, "invalidated": 0, "coalesced": 0, "lease_waits": 0, "stale": 0, "refresh_errors": 0, "evictions": 0, "expired": 0}
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, key: str) -> CacheEntry:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key: str, entry: CacheEntry) -> None:
+        with self.lock:
+            self.pop(key)
+            self.entries[key] = entry
+            self.bytes += entry.size
+            now = datetime.now(timezone.utc)
+            if (now - self.last_sweep).total_seconds() >= self.sweep_interval or len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+                self.sweep(now)
+            while len(self.entries) > 1 and (len(self.entries) > self.max_entries or self.bytes > self.max_bytes):
+                _key, evicted = self.entries.popitem(last=False)
+                self.bytes -= evicted.size
+                self.stats["evictions"] += 1
+
+    def pop(self, key: str) -> CacheEntry:
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry.size
+        return entry
+
+    def sweep(self, now: datetime) -> None:
+        self.last_sweep = now
+        for key in [k for k, e in self.entries.items() if now > e.local_expire and now > e.hard_expire]:
+            self.pop(key)
+            self.stats["expired"] += 1
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    # 統計を1つ増やす。バックグラウンドの再計算や結果を待っていたスレッドからも呼ばれるので lock の中で行う
+    def count(self, name: str) -> None:
+        with self.lock:
+            self.stats[name] += 1
+
+    def cache_stats(self) -> dict[str, int]:
+        with self.lock:
+            return {**self.stats, "entries": len(self.entries), "bytes": self.bytes}
+
+
+# hybrid_dict_cache が S3 に保存する形式。JSON のバイト列の (圧縮, 展開) の組
+# 形式の名前は S3 のメタデータ codec に入れる。codec が無いオブジェクト (以前に保存したもの) は json として読む
+CACHE_CODECS: dict[str, tuple[Callable[[bytes], bytes], Callable[[bytes], bytes]]] = {
+    "json": (lambda body: body, lambda body: body),
+    "json+zlib": (lambda body: zlib.compress(body, 6), zlib.decompress),
+    "json+gzip": (lambda body: gzip.compress(body, 6, mtime=0), gzip.decompress),
+}
+
+# 条件付きの PUT / DELETE で条件が合わなかった (他のインスタンスが先に書いた) ときのエラーコード
+LEASE_CONFLICT_CODES = ("PreconditionFailed", "ConditionalRequestConflict", "412", "409")
+
+
+# キャッシュ用のバケット。最初に使うときに SSM の reserva_bucket_info から決める (import 時には AWS にアクセスしない)
+# boto3 のセッションと resource はスレッド間で共有できないので、スレッドごとに自分のセッションから作る
+cache_bucket_local = threading.local()
+
+
+def get_cache_bucket():
+    bucket = getattr(cache_bucket_local, "bucket", None)
+    if bucket is None:
+        bucket = boto3.session.Session().resource("s3").Bucket(get_config().reserva_bucket_info)
+        cache_bucket_local.bucket = bucket
+    return bucket
+
+
+"""
+キャッシュのタグ (例: month:2024-05)
+タグを無効化した時刻を S3 の CACHE_TAG_ROOT/<tag>.json に記録し、それより前に計算を始めたキャッシュは使わない。
+読んだ時刻は CACHE_TAG_TTL 秒だけプロセス内に保持する (無効化したプロセスには即座に反映する)
+"""
+CACHE_TAG_ROOT = "cache_tags"
+CACHE_TAG_TTL = 30
+# (バケット名, タグ) -> (無効化した時刻 (無ければ None), 読んだ時刻)
+tag_cache: dict[tuple[str, str], tuple[datetime, datetime]] = {}
+
+
+def month_tag(year: int, month: int) -> str:
+    return f"month:{year:04}-{month:02}"
+
+
+def invalidate_cache_tags(tags: list[str], s3bucket=None) -> None:
+    if s3bucket is None:
+        s3bucket = get_cache_bucket()
+    now = datetime.now(timezone.utc)
+    for tag in sorted(set(tags)):
+        s3bucket.Object(f"{CACHE_TAG_ROOT}/{tag}.json").put(Body=json.dumps({"invalidated_at": now.isoformat()}), ContentType="application/json")
+        tag_cache[(s3bucket.name, tag)] = (now, now)
+
+
+# タグのうち最後に無効化された時刻。どれも無効化されていなければ None
+def get_tags_invalidated_at(tags: list[str], s3bucket=None) -> datetime:
+    if s3bucket is None:
+        s3bucket = get_cache_bucket()
+    now = datetime.now(timezone.utc)
+    ret = None
+    for tag in tags:
+        cached = tag_cache.get((s3bucket.name, tag))
+        if cached is not None and (now - cached[1]).total_seconds() < CACHE_TAG_TTL:
+            invalidated_at = cached[0]
+        else:
+            try:
+                body = s3bucket.Object(f"{CACHE_TAG_ROOT}/{tag}.json").get()["Body"].read()
+                invalidated_at = datetime.fromisoformat(json.loads(body.decode("utf-8"))["invalidated_at"])
+            except botocore.exceptions.ClientError as e:
+                if not e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+                    raise
+                invalidated_at = None
+            tag_cache[(s3bucket.name, tag)] = (invalidated_at, now)
+        if invalidated_at is not None and (ret is None or ret < invalidated_at):
+            ret = invalidated_at
+    return ret
+
+
+"""
+hybrid_dict_cache: 関数の返り値 (JSON にできるもの) をプロセス内と S3 の2段でキャッシュする
+- 期限は引数 local_ttl / s3_ttl (名前は local_ttl_argname / s3_ttl_argname で変えられる) で関数呼び出しごとに指定できる
+- 引数 hard_ttl を s3_ttl (S3 を使わない場合は local_ttl) より長く指定すると stale-while-revalidate になる。
+  期限が切れてから hard_ttl (計算した時刻から) までは古い値をすぐに返し、バックグラウンドのスレッドで再計算して両方のキャッシュを更新する。
+  Lambda では応答を返すとスレッドも止まるので、再計算が終わらなければ次の呼び出しのときに続きを行う。
+- s3bucket を指定しなければ、S3 を最初に使うときに SSM の reserva_bucket_info から決める (import 時には AWS にアクセスしない)
+- プロセス内のキャッシュは関数ごとに max_entries 件、max_bytes バイトまで。統計は inner.cache_stats() で取得できる
+- S3 には codec の形式で保存する (CACHE_CODECS)
+- tags に引数からタグのリストを返す関数を指定すると、invalidate_cache_tags でそのタグを無効化したときに、
+  それより前に計算を始めたキャッシュは (期限内でも、stale-while-revalidate でも) 使わずに計算し直す
+- キャッシュミスの計算は同じキーにつき1つだけ行う。同じプロセス内では後から来た呼び出しが結果を待ち、
+  他の Lambda インスタンスとは S3 のリースで調整する (リースを取れなかったインスタンスは S3 のキャッシュを lease_poll_interval 秒ごとに見に行く)
+"""
+
+
+def hybrid_dict_cache(
+    local_ttl_argname: str = "local_ttl",
+    s3_ttl_argname: str = "s3_ttl",
+    default_local_ttl: int = 300,
+    default_s3_ttl: int = 3600 * 24,
+    __local_only: bool = False,
+    s3bucket=None,
+    max_entries: int = 128,
+    max_bytes: int = 16 * 1024 * 1024,
+    hard_ttl_argname: str = "hard_ttl",
+    lease_ttl: int = 60,
+    lease_poll_interval: float = 1.0,
+    codec: str = "json+zlib",
+    tags: Callable[..., list[str]] = None,
+):
+    if not codec in CACHE_CODECS:
+        raise ValueError(f"unknown codec {codec}")
+
+    # s3bucket を指定しなければ、呼び出したスレッドのバケットを使う (バックグラウンドの再計算は別のスレッド)
+    def get_bucket():
+        return s3bucket if s3bucket is not None else get_cache_bucket()
 
     def make_key(f, *args, **kwargs):
         argstr = "a-" + "-".join(map(str, args))
@@ -31,39 +280,223 @@ def hybrid_dict_cache(local_ttl_argname: str = "local_ttl", s3_ttl_argname: str
         return f"{f.__name__}/{sha512}.json"
 
     """
-    メタデータ: ['Metadata']
-    Last Modified: ['LastModified']
+    S3 のキャッシュは1回の GET で読む。期限はメタデータ ['Metadata']['expired'] (と ['hard_expired']) に入っている。
+    - オブジェクトが無い (NoSuchKey) 場合はキャッシュミス
+    - 手元に同じキーの ETag があれば (held) IfNoneMatch を付け、変わっていなければ (304) 手元のデータを使う
+    返り値は (data, ETag, S3 の期限, hard_expire, バイト数, 計算を始めた時刻)。キャッシュミスまたは hard_expire を過ぎている場合は None
+    S3 を使わない場合は手元のデータを S3 の代わりにする
     """
 
-    def try_s3_cache(key: str) -> dict:
+    def try_s3_cache(key: str, held: CacheEntry, local_cache: LocalCache) -> tuple:
         if __local_only:
-            return None
+            if held is None or datetime.now(timezone.utc) > held.hard_expire:
+                return None
+            return (held.data, None, held.local_expire, held.hard_expire, held.size, held.created)
 
-        objs = list(s3bucket.objects.filter(Prefix=key))
-        if not (len(objs) == 1 and objs[0].key == key):
-            # キャッシュミス
-            return None
+        obj = get_bucket().Object(key)
+        try:
+            if held is not None and held.etag is not None:
+                res: dict = obj.get(IfNoneMatch=held.etag)
+            else:
+                res: dict = obj.get()
+        except botocore.exceptions.ClientError as e:
+            code = e.response["Error"]["Code"]
+            if code in ("NoSuchKey", "404"):
+                # キャッシュミス
+                return None
+            if not code in ("304", "NotModified"):
+                raise
+            # 変わっていない
+            if datetime.now(timezone.utc) > held.hard_expire:
+                print(f"cache key={key} expired={held.s3_expire}")
+                return None
+            local_cache.count("revalidated")
+            return (held.data, held.etag, held.s3_expire, held.hard_expire, held.size, held.created)
 
-        obj = s3bucket.Object(key)
-        res: dict = obj.get()
-        metadata = res["Metadata"]
-        expired: datetime = datetime.fromisoformat(metadata["expired"])
-        if datetime.now(timezone.utc) > expired:
+        expired: datetime = datetime.fromisoformat(res["Metadata"]["expired"])
+        hard_expired: datetime = datetime.fromisoformat(res["Metadata"].get("hard_expired", res["Metadata"]["expired"]))
+        if datetime.now(timezone.utc) > hard_expired:
             # キャッシュ切れ
             print(f"cache key={key} expired={expired}")
             return None
         # dict で返す
-        body = res["Body"].read().decode("utf-8")
-        return json.loads(body)
+        codec_name = res["Metadata"].get("codec", "json")
+        if not codec_name in CACHE_CODECS:
+            print(f"cache key={key} unknown codec={codec_name}")
+            return None
+        body = CACHE_CODECS[codec_name][1](res["Body"].read())
+        # created が無いもの (以前に保存したもの) は更新日時を使う
+        created: datetime = datetime.fromisoformat(res["Metadata"]["created"]) if "created" in res["Metadata"] else res["LastModified"]
+        local_cache.count("s3_hits")
+        return (json.loads(body.decode("utf-8")), res["ETag"], expired, hard_expired, len(body), created)
+
+    """
+    S3 のリース (key + ".lease")
+    キャッシュミスしたときに、同じキーを複数の Lambda インスタンスが同時に計算しないようにする。
+    条件付き PUT (IfNoneMatch="*") で作成できたインスタンスだけが計算し、他のインスタンスは S3 のキャッシュが更新されるのを待つ。
+    リースは lease_ttl 秒で期限切れになり、計算したインスタンスが落ちていても次のインスタンスが取り直せる。
+    期限切れのリースは読んだときの ETag を IfMatch に付けて上書きするので、同時に取り直そうとしても1つのインスタンスしか取れない。
+    取ったリースの ETag を返し、解放も IfMatch で行うので、期限切れの後で他のインスタンスが取り直したリースは消さない。
+    """
+
+    def acquire_lease(key: str) -> str:
+        obj = get_bucket().Object(f"{key}.lease")
+        for _retry in range(2):
+            body = json.dumps({"expires": (datetime.now(timezone.utc) + timedelta(seconds=lease_ttl)).isoformat()})
+            try:
+                return obj.put(Body=body, IfNoneMatch="*")["ETag"]
+            except botocore.exceptions.ClientError as e:
+                if not e.response["Error"]["Code"] in LEASE_CONFLICT_CODES:
+                    raise
+            try:
+                res = obj.get()
+            except botocore.exceptions.ClientError as e:
+                if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+                    continue
+                raise
+            lease = json.loads(res["Body"].read().decode("utf-8"))
+            if datetime.now(timezone.utc) <= datetime.fromisoformat(lease["expires"]):
+                return None
+            # 期限切れのリースを読んだときのまま (他のインスタンスが取り直していなければ) 上書きする
+            try:
+                return obj.put(Body=body, IfMatch=res["ETag"])["ETag"]
+            except botocore.exceptions.ClientError as e:
+                code = e.response["Error"]["Code"]
+                if code in ("NoSuchKey", "404"):
+                    continue
+                if not code in LEASE_CONFLICT_CODES:
+                    raise
+                return None
+        return None
 
-    def regist_s3_cache(key: str, data: dict, expired: datetime):
+    # 自分のリース (etag) のままであれば消す
+    def release_lease(key: str, etag: str) -> None:
+        try:
+            get_bucket().Object(f"{key}.lease").delete(IfMatch=etag)
+        except botocore.exceptions.ClientError as e:
+            if not e.response["Error"]["Code"] in LEASE_CONFLICT_CODES + ("NoSuchKey", "404"):
+                raise
+            print(f"cache key={key} lease was taken over")
+
+    def lease_exists(key: str) -> bool:
+        try:
+            get_bucket().Object(f"{key}.lease").load()
+        except botocore.exceptions.ClientError as e:
+            if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+                return False
+            raise
+        return True
+
+    # 他のインスタンスの計算結果が S3 に書かれるのを待つ。リースが消えるか lease_ttl を過ぎたら None
+    # invalidated_at (タグを無効化した時刻) より前に計算を始めたものは待っている結果ではない
+    def wait_for_lease_holder(key: str, held: CacheEntry, local_cache: LocalCache, invalidated_at: datetime) -> tuple:
+        def usable(hit: tuple) -> bool:
+            return hit is not None and datetime.now(timezone.utc) <= hit[2] and (invalidated_at is None or hit[5] >= invalidated_at)
+
+        deadline = datetime.now(timezone.utc) + timedelta(seconds=lease_ttl)
+        while datetime.now(timezone.utc) < deadline:
+            time.sleep(lease_poll_interval)
+            hit = try_s3_cache(key, held, local_cache)
+            if usable(hit):
+                return hit
+            if not lease_exists(key):
+                # 結果を書かずに終わった場合は最後にもう一度だけ読む
+                hit = try_s3_cache(key, held, local_cache)
+                return hit if usable(hit) else None
+        return None
+
+    # S3 に書き、(ETag, バイト数) を返す
+    def regist_s3_cache(key: str, data: dict, expired: datetime, hard_expired: datetime, created: datetime, tag_list: list[str]) -> tuple[str, int]:
+        body = json.dumps(data, ensure_ascii=False).encode("utf-8")
         if __local_only:
-            return
+            return None, len(body)
 
-        obj = s3bucket.Object(key)
-        obj.put(Body=json.dumps(data, ensure_ascii=False), Metadata={"expired": expired.isoformat()})
+        obj = get_bucket().Object(key)
+        metadata = {"expired": expired.isoformat(), "hard_expired": hard_expired.isoformat(), "codec": codec, "created": created.isoformat(), "tags": ",".join(tag_list)}
+        res = obj.put(Body=CACHE_CODECS[codec][0](body), ContentType="application/octet-stream", Metadata=metadata)
+        return res.get("ETag"), len(body)
 
     def wrapper(f):
+        local_cache = LocalCache(max_entries, max_bytes)
+        # バックグラウンドで再計算中のキー
+        refreshing: set[str] = set()
+        refreshing_lock = threading.Lock()
+        # 計算中のキー -> {"event", "data", "ok"}。同じプロセスで同じキーを同時に要求したら、後から来た方は結果を待つ
+        flights: dict[str, dict] = {}
+        flights_lock = threading.Lock()
+
+        # 関数を呼んで両方のキャッシュに書く
+        def compute(key: str, args: tuple, kwargs: dict, local_ttl: int, s3_ttl: int, hard_ttl: int, tag_list: list[str]):
+            created = datetime.now(timezone.utc)
+            data = f(*args, **kwargs)
+            now = datetime.now(timezone.utc)
+            soft_ttl = local_ttl if __local_only else s3_ttl
+            s3_expire = now + timedelta(seconds=s3_ttl)
+            hard_expire = now + timedelta(seconds=max(soft_ttl, hard_ttl if hard_ttl is not None else soft_ttl))
+            etag, size = regist_s3_cache(key, data, s3_expire, hard_expire, created, tag_list)
+            local_cache.put(key, CacheEntry(data, now + timedelta(seconds=local_ttl), etag, s3_expire, hard_expire, size, created))
+            return data
+
+        # キャッシュミスしたときの計算。他のインスタンスがリースを持っていればその結果を待つ
+        def compute_with_lease(key: str, held: CacheEntry, invalidated_at: datetime, args: tuple, kwargs: dict, local_ttl: int, s3_ttl: int, hard_ttl: int, tag_list: list[str]):
+            if __local_only:
+                return compute(key, args, kwargs, local_ttl, s3_ttl, hard_ttl, tag_list)
+            lease = acquire_lease(key)
+            if lease is None:
+                hit = wait_for_lease_holder(key, held, local_cache, invalidated_at)
+                if hit is not None:
+                    local_cache.count("lease_waits")
+                    (data, etag, s3_expire, hard_expire, size, created) = hit
+                    local_cache.put(key, CacheEntry(data, datetime.now(timezone.utc) + timedelta(seconds=local_ttl), etag, s3_expire, hard_expire, size, created))
+                    return data
+                # 待っても結果が書かれなかったので自分で計算する
+            try:
+                return compute(key, args, kwargs, local_ttl, s3_ttl, hard_ttl, tag_list)
+            finally:
+                if lease is not None:
+                    release_lease(key, lease)
+
+        def compute_single_flight(key: str, held: CacheEntry, invalidated_at: datetime, *compute_args):
+            while True:
+                with flights_lock:
+                    flight = flights.get(key)
+                    leader = flight is None
+                    if leader:
+                        flight = {"event": threading.Event(), "data": None, "ok": False}
+                        flights[key] = flight
+                if not leader:
+                    flight["event"].wait()
+                    if flight["ok"]:
+                        local_cache.count("coalesced")
+                        return flight["data"]
+                    # 先に計算していた方が失敗したので、自分で計算し直す
+                    continue
+                try:
+                    flight["data"] = compute_with_lease(key, held, invalidated_at, *compute_args)
+                    flight["ok"] = True
+                    return flight["data"]
+                finally:
+                    with flights_lock:
+                        flights.pop(key, None)
+                    flight["event"].set()
+
+        def refresh(*compute_args):
+            key = compute_args[0]
+            try:
+                # 他のインスタンスが再計算中なら任せる
+                if __local_only:
+                    compute(*compute_args)
+                elif (lease := acquire_lease(key)) is not None:
+                    try:
+                        compute(*compute_args)
+                    finally:
+                        release_lease(key, lease)
+            except Exception as e:
+                local_cache.count("refresh_errors")
+                print(f"cache key={key} refresh failed: {e!r}")
+            finally:
+                with refreshing_lock:
+                    refreshing.discard(key)
 
         @wraps(f)
         def inner(*args, **kwargs):
@@ -77,26 +510,53 @@ def hybrid_dict_cache(local_ttl_argname: str = "local_ttl", s3_ttl_argname: str
             s3_ttl: int = default_s3_ttl
             if s3_ttl_argname in kwargs:
                 s3_ttl = int(kwargs[s3_ttl_argname])
+            hard_ttl: int = None
+            if kwargs.get(hard_ttl_argname) is not None:
+                hard_ttl = int(kwargs[hard_ttl_argname])
             key: str = make_key(f, *args, **kwargs)
-            data = None
-            if key in cache and not cache_refresh:
-                (data, local_expire) = cache[key]
-                if datetime.now(timezone.utc) > local_expire:
-                    cache.pop(key)
-                    data = None
-                else:
-                    return data
+            tag_list: list[str] = tags(*args, **kwargs) if tags is not None else []
+            if cache_refresh:
+                local_cache.count("misses")
+                return compute(key, args, kwargs, local_ttl, s3_ttl, hard_ttl, tag_list)
+
+            invalidated_at: datetime = get_tags_invalidated_at(tag_list, get_bucket()) if len(tag_list) > 0 else None
+            held: CacheEntry = local_cache.get(key)
+            invalidated: bool = False
+            if held is not None and (invalidated_at is not None and held.created < invalidated_at):
+                invalidated = True
+                held = None
+            if held is not None and datetime.now(timezone.utc) <= held.local_expire:
+                local_cache.count("hits")
+                return held.data
 
-            data = None
-            if not cache_refresh:
-                data = try_s3_cache(key)
-            if data is None:
-                data = f(*args, **kwargs)
-                s3_expire = datetime.now(timezone.utc) + timedelta(seconds=s3_ttl)
-                regist_s3_cache(key, data, s3_expire)
-            cache[key] = (data, datetime.now(timezone.utc) + timedelta(seconds=local_ttl))
+            hit = try_s3_cache(key, held, local_cache)
+            if hit is not None and (invalidated_at is not None and hit[5] < invalidated_at):
+                invalidated = True
+                hit = None
+            if invalidated:
+                local_cache.count("invalidated")
+            if hit is None:
+                local_cache.count("misses")
+                return compute_single_flight(key, held, invalidated_at, args, kwargs, local_ttl, s3_ttl, hard_ttl, tag_list)
+
+            (data, etag, s3_expire, hard_expire, size, created) = hit
+            now = datetime.now(timezone.utc)
+            if now <= s3_expire:
+                local_cache.put(key, CacheEntry(data, now + timedelta(seconds=local_ttl), etag, s3_expire, hard_expire, size, created))
+                return data
+
+            # 期限は切れたが hard_expire 前なので古い値を返し、再計算はバックグラウンドで行う
+            local_cache.count("stale")
+            local_cache.put(key, CacheEntry(data, now, etag, s3_expire, hard_expire, size, created))
+            with refreshing_lock:
+                if key in refreshing:
+                    return data
+                refreshing.add(key)
+            threading.Thread(target=refresh, args=(key, args, kwargs, local_ttl, s3_ttl, hard_ttl, tag_list), daemon=True).start()
             return data
 
+        inner.cache_stats = local_cache.cache_stats
+        inner.cache_clear = local_cache.clear
         return inner
 
     return wrapper
@@ -105,11 +565,15 @@ def hybrid_dict_cache(local_ttl_argname: str = "local_ttl", s3_ttl_argname: str
 class GSpreadsheetUtil:
     @classmethod
     def get_workbook(cls):
-        apikey = parameters.get_parameter("ichiba_google_apikey", transform="json")
+        # gspread は読み込みに時間がかかるので、シートを開くときに読み込む (report はキャッシュにあれば使わない)
+        import gspread
+
+        config = get_config()
+        apikey = config.ichiba_google_apikey
         with open("/tmp/apikey.json", "w") as f:
             json.dump(apikey, f, indent=4)
         gc = gspread.service_account(filename="/tmp/apikey.json")
-        workbook = gc.open_by_key(parameters.get_parameter("ichiba_google_spreadsheet_key"))
+        workbook = gc.open_by_key(config.ichiba_google_spreadsheet_key)
         return workbook
 
     # 事前登録シートから当該メールアドレスを元に登録情報を取り出す
@@ -0,0 +1,26 @@
+from moto import mock_aws
+import boto3
+import pytest
+
+
+# moto の S3 に作った空のバケット
+@pytest.fixture
+def s3bucket():
+    with mock_aws():
+        s3 = boto3.resource("s3", region_name="us-east-1")
+        bucket = s3.Bucket("test-bucket")
+        bucket.create()
+        yield bucket
+
+
+# logger.inject_lambda_context が参照する Lambda のコンテキスト
+class LambdaContext:
+    function_name = "test"
+    memory_limit_in_mb = 128
+    invoked_function_arn = "arn:aws:lambda:ap-northeast-1:123456789012:function:test"
+    aws_request_id = "request-id"
+
+
+@pytest.fixture
+def lambda_context():
+    return LambdaContext()
@@ -0,0 +1,85 @@
+from reserva_request import config
+from moto import mock_aws
+import boto3
+import json
+import pytest
+
+PARAMETERS = {
+    "reserva_systeminfo": json.dumps({"bus_id": "b", "svd_id": "s", "day_range": 180, "auth_token": "t"}),
+    "reserva_userinfo": json.dumps({"userid": "u", "password": "p"}),
+    "ichiba_google_apikey": json.dumps({"type": "service_account"}),
+    "ichiba_google_spreadsheet_key": "sheet",
+    "reserva_bucket_info": "reserva-bucket",
+    "remotelock_buffer_min": "30",
+    "remotelock_expired_days_for_access_guest": "60",
+    "remotelock_clientkey": json.dumps({"client_id": "id", "client_secret": "secret"}),
+    "remotelock_token": json.dumps({"access_token": "a", "refresh_token": "r", "expires_at": 0}),
+}
+
+
+@pytest.fixture
+def ssm(monkeypatch):
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "ap-northeast-1")
+    monkeypatch.delenv(config.CONFIG_FILE_ENV, raising=False)
+    config.clear_config()
+    with mock_aws():
+        client = boto3.client("ssm")
+        for name, value in PARAMETERS.items():
+            client.put_parameter(Name=name, Value=value, Type="String")
+        yield client
+    config.clear_config()
+
+
+def count_get_parameters(mocker) -> list:
+    calls = []
+    original = boto3.client
+
+    def client(*args, **kwargs):
+        c = original(*args, **kwargs)
+        c.meta.events.register("provide-client-params.ssm.GetParameters", lambda params, **kw: calls.append(params["Names"]))
+        return c
+
+    mocker.patch.object(config.boto3, "client", side_effect=client)
+    return calls
+
+
+def test_get_config(ssm, mocker, monkeypatch):
+    calls = count_get_parameters(mocker)
+    c = config.get_config()
+    assert c.remotelock_buffer_min == 30
+    assert c.reserva_systeminfo["day_range"] == 180
+    assert c.reserva_bucket_info == "reserva-bucket"
+    # 全てのパラメータを1回で読み、期限内は読み直さない
+    assert config.get_config() is c
+    assert len(calls) == 1 and len(calls[0]) == len(PARAMETERS)
+
+    ssm.put_parameter(Name="remotelock_buffer_min", Value="15", Type="String", Overwrite=True)
+    assert config.get_config().remotelock_buffer_min == 30
+    assert config.get_config(force_fetch=True).remotelock_buffer_min == 15
+    monkeypatch.setattr(config, "CONFIG_TTL", -1)
+    config.get_config()
+    assert len(calls) == 3
+
+
+def test_get_config_missing(ssm):
+    ssm.delete_parameter(Name="remotelock_token")
+    with pytest.raises(RuntimeError):
+        config.get_config()
+
+
+def test_get_config_override(ssm, mocker, monkeypatch, tmp_path):
+    calls = count_get_parameters(mocker)
+    # 環境変数で上書きしたものは SSM から読まない
+    monkeypatch.setenv("RESERVA_CONFIG_REMOTELOCK_BUFFER_MIN", "45")
+    assert config.get_config().remotelock_buffer_min == 45
+    assert not "remotelock_buffer_min" in calls[0]
+
+    # 全て上書きすれば SSM にアクセスしない (ファイルでは JSON のパラメータをオブジェクトで書いてもよい)
+    values = {name: json.loads(value) if value.startswith("{") else value for name, value in PARAMETERS.items()}
+    path = tmp_path / "config.json"
+    path.write_text(json.dumps(values))
+    monkeypatch.setenv(config.CONFIG_FILE_ENV, str(path))
+    c = config.get_config(force_fetch=True)
+    assert len(calls) == 1
+    assert c.remotelock_buffer_min == 45
+    assert c.remotelock_clientkey == {"client_id": "id", "client_secret": "secret"}
@@ -0,0 +1,65 @@
+from reserva_request.events import WATERMARK_KEY, update_event_store, read_events, iso_minute
+from reserva_request.usage import count_events_in_slots
+from datetime import date
+import numpy as np
+import json
+
+
+def make_event(id: str, occurred_at: str, event_type: str = "unlocked_event") -> dict:
+    return {"id": id, "occurred_at": occurred_at, "event_type": event_type, "status": "succeeded", "user_type": "access_guest", "user_id": "g"}
+
+
+class FakeRemoteLock:
+    def __init__(self, events: list[dict]) -> None:
+        self.events = events
+        self.since = []
+
+    def get_events_since(self, since: str = "") -> list[dict]:
+        self.since.append(since)
+        return [e for e in self.events if e["occurred_at"] >= since]
+
+
+def test_update_event_store(s3bucket):
+    remotelock = FakeRemoteLock([make_event("e1", "2024-04-30T20:00:00"), make_event("e2", "2024-05-01T09:30:00")])
+    assert update_event_store(s3bucket, remotelock, date(2024, 5, 1)) == {"read": 2, "added": {"2024-04": 1, "2024-05": 1}, "watermark": "2024-05-01T09:30:00"}
+
+    # 2回目は watermark 以降だけを読み、同じ時刻の既存イベントは追加しない
+    remotelock.events.append(make_event("e3", "2024-05-01T09:30:00", "access_denied"))
+    remotelock.events.append(make_event("e4", "2024-05-03T10:00:00"))
+    assert update_event_store(s3bucket, remotelock, date(2024, 5, 3))["added"] == {"2024-05": 2}
+    assert remotelock.since == ["", "2024-05-01T09:30:00"]
+    assert json.loads(s3bucket.Object(WATERMARK_KEY).get()["Body"].read())["occurred_at"] == "2024-05-03T10:00:00"
+
+    events, months = read_events(s3bucket, date(2024, 5, 1), date(2024, 6, 30))
+    assert months == ["2024-05"]
+    assert events["id"] == ["e2", "e3", "e4"]
+    assert events["minute"][0] == iso_minute("2024-05-01T09:30:00")
+
+    # 新しいイベントが無ければ月のファイルは書かず、取り込みが済んだ月だけを進める
+    assert update_event_store(s3bucket, remotelock, date(2024, 7, 2)) == {"read": 1, "added": {}, "watermark": "2024-05-03T10:00:00"}
+    assert json.loads(s3bucket.Object(WATERMARK_KEY).get()["Body"].read())["months"] == ["2024-04", "2024-05", "2024-06", "2024-07"]
+    # イベントが無かった 2024-06 も取り込みが済んだ月で、まだ取り込んでいない 2024-08 は含めない
+    events, months = read_events(s3bucket, date(2024, 4, 1), date(2024, 8, 31))
+    assert months == ["2024-04", "2024-05", "2024-06", "2024-07"]
+    assert events["id"] == ["e1", "e2", "e3", "e4"]
+
+
+def test_read_events_range(s3bucket):
+    remotelock = FakeRemoteLock([make_event("e1", "2024-04-30T20:00:00"), make_event("e2", "2024-05-01T09:30:00", "access_denied"), make_event("e3", "2024-05-03T10:00:00")])
+    update_event_store(s3bucket, remotelock, date(2024, 5, 31))
+    # 期間の途中から始まる月と途中で終わる月は、期間内のイベントだけを読む
+    events, months = read_events(s3bucket, date(2024, 4, 30), date(2024, 5, 1))
+    assert months == ["2024-04", "2024-05"]
+    assert events["id"] == ["e1", "e2"]
+    events, months = read_events(s3bucket, date(2024, 5, 2), date(2024, 5, 31))
+    assert events["id"] == ["e3"]
+    assert all(len(values) == 1 for values in events.values())
+
+
+def test_count_events_in_slots():
+    slot_starts = np.array([iso_minute("2024-05-01T09:00:00"), iso_minute("2024-05-01T13:00:00"), iso_minute("2024-05-02T09:00:00")])
+    slot_ends = slot_starts + 240
+    # 枠の開始の 30 分前からの解錠は、その枠の利用とみなす
+    events = np.array([iso_minute("2024-05-01T12:40:00"), iso_minute("2024-05-01T08:50:00"), iso_minute("2024-05-01T16:20:00")])
+    assert count_events_in_slots(events, slot_starts, slot_ends, 30).tolist() == [1, 2, 0]
+    assert count_events_in_slots(events, slot_starts, slot_ends, 0).tolist() == [1, 1, 0]
@@ -1,5 +1,9 @@
-from reserva_request.util import hybrid_dict_cache
+from reserva_request.util import hybrid_dict_cache, invalidate_cache_tags, month_tag, LocalCache
+from datetime import datetime, timedelta, timezone
+import boto3
+import json
 import pytest
+import threading
 import time
 
 access_count: int = 0
@@ -58,3 +62,310 @@ def test_s3_cache():
     time.sleep(15)
     get_data("test_s3_2")
     assert access_count == 2
+
+
+def test_s3_cache_single_get(s3bucket, mocker):
+    calls = []
+
+    @hybrid_dict_cache(default_local_ttl=0, default_s3_ttl=60, s3bucket=s3bucket)
+    def get_s3_data(key: str):
+        calls.append(key)
+        return {"key": key}
+
+    list_spy = mocker.spy(s3bucket.objects, "filter")
+    # 初回は NoSuchKey でキャッシュミスになり、関数を呼んで S3 に書く
+    assert get_s3_data("a") == {"key": "a"}
+    assert calls == ["a"]
+    assert len(list(s3bucket.objects.all())) == 1
+    # ローカルの期限が切れても S3 の内容が変わっていなければ (304) 関数を呼ばない
+    assert get_s3_data("a") == {"key": "a"}
+    assert calls == ["a"]
+    assert list_spy.call_count == 0
+
+    # 他のインスタンスが書き換えた場合は新しい内容を読む
+    obj = next(iter(s3bucket.objects.all())).Object()
+    metadata = obj.get()["Metadata"]
+    # codec が無いものは以前の形式 (json) として読む
+    metadata.pop("codec")
+    obj.put(Body='{"key": "b"}', Metadata=metadata)
+    assert get_s3_data("a") == {"key": "b"}
+    assert calls == ["a"]
+
+
+def test_s3_cache_expired(s3bucket):
+    calls = []
+
+    @hybrid_dict_cache(default_local_ttl=0, s3bucket=s3bucket)
+    def get_s3_data(key: str, s3_ttl: int = 60):
+        calls.append(key)
+        return {"key": key}
+
+    get_s3_data("a", s3_ttl=0)
+    get_s3_data("a", s3_ttl=0)
+    assert calls == ["a", "a"]
+
+
+def test_local_cache_bounded():
+    calls = []
+
+    @hybrid_dict_cache(__local_only=True, default_local_ttl=60, max_entries=2)
+    def get_bounded_data(key: str):
+        calls.append(key)
+        return {"key": key}
+
+    get_bounded_data("a")
+    get_bounded_data("b")
+    get_bounded_data("a")
+    # 上限を超えたら最後に使われたのが古い b を捨てる
+    get_bounded_data("c")
+    get_bounded_data("a")
+    get_bounded_data("b")
+    assert calls == ["a", "b", "c", "b"]
+    stats = get_bounded_data.cache_stats()
+    assert stats["hits"] == 2 and stats["misses"] == 4 and stats["evictions"] == 2
+    assert stats["entries"] == 2 and stats["bytes"] == len('{"key": "a"}') * 2
+
+
+def test_local_cache_bytes_and_sweep():
+    @hybrid_dict_cache(__local_only=True, max_entries=2, max_bytes=100)
+    def get_sized_data(key: str, size: int, local_ttl: int = 60):
+        return {"key": key, "value": "x" * size}
+
+    get_sized_data("a", 40)
+    get_sized_data("b", 40)
+    assert get_sized_data.cache_stats()["evictions"] == 1
+    assert get_sized_data.cache_stats()["bytes"] <= 100
+
+    # 上限を超えたときは、使われた順より先に期限切れを捨てる
+    get_sized_data.cache_clear()
+    get_sized_data("c", 1, local_ttl=-1)
+    get_sized_data("d", 1, local_ttl=-1)
+    get_sized_data("e", 1)
+    stats = get_sized_data.cache_stats()
+    assert stats["expired"] == 2 and stats["evictions"] == 1 and stats["entries"] == 1
+
+
+def join_refresh_threads():
+    for thread in threading.enumerate():
+        if thread is not threading.current_thread() and thread.daemon:
+            thread.join(5)
+
+
+
+def test_local_cache_count_threads():
+    cache = LocalCache(8, 1024)
+    # 複数のスレッドから同時に数えても失われない
+    threads = [threading.Thread(target=lambda: [cache.count("hits") for _i in range(20000)]) for _j in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(30)
+    assert cache.cache_stats()["hits"] == 80000
+
+def test_stale_while_revalidate(s3bucket):
+    calls = []
+
+    @hybrid_dict_cache(default_local_ttl=0, default_s3_ttl=0, s3bucket=s3bucket)
+    def get_swr_data(key: str, hard_ttl: int = None):
+        calls.append(key)
+        return {"count": len(calls)}
+
+    assert get_swr_data("a", hard_ttl=60) == {"count": 1}
+    # 期限切れでも hard_ttl 内なら古い値をすぐに返し、バックグラウンドで再計算する
+    assert get_swr_data("a", hard_ttl=60) == {"count": 1}
+    join_refresh_threads()
+    assert len(calls) == 2
+    assert get_swr_data("a", hard_ttl=60) == {"count": 2}
+    join_refresh_threads()
+    assert get_swr_data.cache_stats()["stale"] == 2
+
+    # hard_ttl を指定しなければ期限切れで再計算を待つ
+    assert get_swr_data("b") == {"count": 4}
+    assert get_swr_data("b") == {"count": 5}
+
+
+def test_single_flight_in_process():
+    calls = []
+    started = threading.Event()
+    release = threading.Event()
+
+    @hybrid_dict_cache(__local_only=True, default_local_ttl=60)
+    def get_slow_data(key: str):
+        calls.append(key)
+        started.set()
+        release.wait(5)
+        return {"key": key}
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(get_slow_data("a"))) for _i in range(3)]
+    threads[0].start()
+    started.wait(5)
+    for thread in threads[1:]:
+        thread.start()
+    time.sleep(0.1)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert calls == ["a"]
+    assert results == [{"key": "a"}] * 3
+    assert get_slow_data.cache_stats()["coalesced"] == 2
+
+
+def test_single_flight_s3_lease(s3bucket):
+    def get_shared_data(key: str):
+        calls.append(key)
+        return {"value": "computed"}
+
+    calls = []
+    hybrid_dict_cache(default_s3_ttl=60, s3bucket=s3bucket)(get_shared_data)("a")
+    obj = next(iter(s3bucket.objects.all())).Object()
+    expired = (datetime.now(timezone.utc) - timedelta(seconds=1)).isoformat()
+    obj.put(Body='{"value": "old"}', Metadata={"expired": expired})
+
+    # 他のインスタンスがリースを持って計算中で、少し後に結果を書く
+    lease = s3bucket.Object(f"{obj.key}.lease")
+    lease.put(Body=json.dumps({"expires": (datetime.now(timezone.utc) + timedelta(seconds=30)).isoformat()}))
+
+    def finish_other_instance():
+        time.sleep(0.3)
+        fresh = (datetime.now(timezone.utc) + timedelta(seconds=60)).isoformat()
+        obj.put(Body='{"value": "other"}', Metadata={"expired": fresh})
+        lease.delete()
+
+    other = threading.Thread(target=finish_other_instance)
+    other.start()
+    calls = []
+    follower = hybrid_dict_cache(default_s3_ttl=60, s3bucket=s3bucket, lease_poll_interval=0.05)(get_shared_data)
+    assert follower("a") == {"value": "other"}
+    other.join(5)
+    assert calls == []
+    assert follower.cache_stats()["lease_waits"] == 1
+
+    # 期限切れのリースは取り直して自分で計算する
+    obj.put(Body='{"value": "old"}', Metadata={"expired": expired})
+    lease.put(Body=json.dumps({"expires": expired}))
+    follower.cache_clear()
+    assert follower("a") == {"value": "computed"}
+    assert calls == ["a"]
+    assert len([o for o in s3bucket.objects.all() if o.key.endswith(".lease")]) == 0
+
+
+# 別の Lambda インスタンスのバケット。リースを最初に読んだところで、もう一方のインスタンスも読むまで待つ
+class RacingBucket:
+    def __init__(self, name: str, barrier: threading.Barrier):
+        self.bucket = boto3.resource("s3", region_name="us-east-1").Bucket(name)
+        self.barrier = barrier
+        self.waited = False
+
+    def Object(self, key: str):
+        obj = self.bucket.Object(key)
+        if not key.endswith(".lease") or self.waited:
+            return obj
+        racing = self
+
+        class RacingObject:
+            def __getattr__(self, name):
+                return getattr(obj, name)
+
+            def get(self, **kwargs):
+                res = obj.get(**kwargs)
+                racing.waited = True
+                racing.barrier.wait(5)
+                return res
+
+        return RacingObject()
+
+
+def test_s3_lease_race(s3bucket):
+    def get_shared_data(key: str):
+        calls.append(key)
+        time.sleep(0.2)
+        return {"value": "computed"}
+
+    calls = []
+    hybrid_dict_cache(default_s3_ttl=60, s3bucket=s3bucket)(get_shared_data)("a")
+    obj = next(iter(s3bucket.objects.all())).Object()
+    obj.delete()
+    # 落ちたインスタンスが残した期限切れのリース
+    expired = (datetime.now(timezone.utc) - timedelta(seconds=1)).isoformat()
+    s3bucket.Object(f"{obj.key}.lease").put(Body=json.dumps({"expires": expired}))
+
+    calls = []
+    barrier = threading.Barrier(2)
+    instances = [hybrid_dict_cache(default_s3_ttl=60, s3bucket=RacingBucket(s3bucket.name, barrier), lease_poll_interval=0.05)(get_shared_data) for _i in range(2)]
+
+    # 2つのインスタンスが同時に期限切れのリースを読んでも、取り直せるのは1つだけ
+    results = []
+    threads = [threading.Thread(target=lambda f=f: results.append(f("a"))) for f in instances]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+    assert results == [{"value": "computed"}] * 2
+    assert calls == ["a"]
+    assert sum(f.cache_stats()["lease_waits"] for f in instances) == 1
+    assert len([o for o in s3bucket.objects.all() if o.key.endswith(".lease")]) == 0
+
+
+def test_s3_lease_taken_over(s3bucket):
+    # 計算に lease_ttl より長くかかり、その間に他のインスタンスがリースを取り直した
+    def get_slow_data(key: str):
+        for lease in [o.Object() for o in s3bucket.objects.all() if o.key.endswith(".lease")]:
+            lease.put(Body=json.dumps({"expires": (datetime.now(timezone.utc) + timedelta(seconds=60)).isoformat()}))
+            leases.append(lease.key)
+        return {"value": "computed"}
+
+    leases = []
+    assert hybrid_dict_cache(default_s3_ttl=60, s3bucket=s3bucket)(get_slow_data)("a") == {"value": "computed"}
+    # 他のインスタンスのリースは消さない
+    assert len(leases) == 1
+    assert [o.key for o in s3bucket.objects.all() if o.key.endswith(".lease")] == leases
+
+
+@pytest.mark.parametrize("codec", ["json", "json+zlib", "json+gzip"])
+def test_s3_cache_codec(s3bucket, codec):
+    @hybrid_dict_cache(default_local_ttl=0, s3bucket=s3bucket, codec=codec)
+    def get_report_data(key: str):
+        return [{"date": "2024-05-07", "timeslot": "09:00-13:00", "name": "山田", "block": "1ブロック 2組 山田"}] * 50
+
+    data = get_report_data("a")
+    obj = next(iter(s3bucket.objects.all())).Object()
+    res = obj.get()
+    assert res["Metadata"]["codec"] == codec
+    if codec != "json":
+        assert len(res["Body"].read()) < len(json.dumps(data, ensure_ascii=False).encode("utf-8")) / 10
+    get_report_data.cache_clear()
+    assert get_report_data("a") == data
+    assert get_report_data.cache_stats()["s3_hits"] == 1
+
+
+def test_unknown_codec():
+    with pytest.raises(ValueError):
+        hybrid_dict_cache(codec="xml")
+
+
+def test_cache_tag_invalidation(s3bucket):
+    calls = []
+
+    def get_month_data(year: int, month: int):
+        calls.append((year, month))
+        return {"count": len(calls)}
+
+    def tags(year: int, month: int) -> list[str]:
+        return [month_tag(year, month)]
+
+    cached = hybrid_dict_cache(default_local_ttl=3600, s3bucket=s3bucket, tags=tags)(get_month_data)
+    assert cached(2024, 5) == {"count": 1}
+    assert cached(2024, 6) == {"count": 2}
+    assert cached(2024, 5) == {"count": 1}
+
+    # 無効化したタグの月だけ、期限内でも計算し直す
+    invalidate_cache_tags([month_tag(2024, 5)], s3bucket)
+    assert cached(2024, 5) == {"count": 3}
+    assert cached(2024, 6) == {"count": 2}
+    assert cached.cache_stats()["invalidated"] == 1
+
+    # 他のインスタンスにも S3 経由で反映される
+    other = hybrid_dict_cache(default_local_ttl=3600, s3bucket=s3bucket, tags=tags)(get_month_data)
+    assert other(2024, 5) == {"count": 3}
+    assert calls == [(2024, 5), (2024, 6), (2024, 5)]
@@ -0,0 +1,130 @@
+from reserva_request import remotelock
+from datetime import datetime, date
+import json
+import time
+import pytest
+
+
+def test_make_calendar_list():
+    access_info_list = [
+        {"day": "Tue", "slot": ["09:00", "13:00", "13:00", "17:00"], "week": [1]},
+        {"unused-date": "2024-05-18"},
+        {"day": "Sat", "slot": ["17:00", "21:00"], "week": [1, 3]},
+    ]
+    r: remotelock.RemoteLock = remotelock.RemoteLock()
+    target_list, exception_list = r.make_calendar_list(access_info_list, datetime(2024, 5, 1), 31)
+
+    assert [slot.start_time for slot in target_list] == ["2024/05/04 17:00", "2024/05/07 09:00", "2024/05/07 13:00"]
+    assert target_list[0] == remotelock.Slot.from_times(date(2024, 5, 4), "17:00", "21:00")
+    # 例外日が先頭、その後に第n週に該当しない日が日付順に並ぶ
+    assert [e["start_date"] for e in exception_list] == ["2024-05-18", "2024-05-11", "2024-05-14", "2024-05-21", "2024-05-25", "2024-05-28"]
+
+
+def test_make_calendar_list_empty_exception():
+    r: remotelock.RemoteLock = remotelock.RemoteLock()
+    target_list, exception_list = r.make_calendar_list([{"day": "Wed", "slot": ["05:00", "09:00"], "week": [1, 2, 3, 4, 5]}], datetime(2024, 5, 1), 7, exp_day_range=365)
+    assert [slot.day for slot in target_list] == ["2024/05/01"]
+    # 例外日がない場合は1年先のダミーが入る
+    assert exception_list == [{"start_date": "2025-05-01", "end_date": "2025-05-01"}]
+
+
+def test_make_calendar_list_unknown_slot():
+    r: remotelock.RemoteLock = remotelock.RemoteLock()
+    with pytest.raises(ValueError):
+        r.make_calendar_list([{"day": "Wed", "slot": ["09:00", "17:00"], "week": [1]}], datetime(2024, 5, 1), 7)
+
+
+def test_make_access_users_skips_invalid_rule(mocker):
+    def record(id: str, slot: list[str]) -> dict:
+        department = json.dumps([{"day": "Wed", "slot": slot, "week": [1]}])
+        return {"id": id, "attributes": {"name": f"団体{id}", "email": f"{id}@example.com", "department": department}}
+
+    error = mocker.patch.object(remotelock.logger, "error")
+    r: remotelock.RemoteLock = remotelock.RemoteLock()
+    # 枠に無い時間帯を設定した access user は飛ばし、他の access user は返す
+    users = r.make_access_users([record("u1", ["10:00", "12:00"]), record("u2", ["09:00", "13:00"])], datetime(2024, 5, 1), 7)
+    assert [(u["id"], u["timeslots"]) for u in users] == [("u2", [remotelock.Slot.from_times(date(2024, 5, 1), "09:00", "13:00")])]
+    error.assert_called_once()
+    assert error.call_args.args[0]["id"] == "u1"
+
+
+def test_get_access_guests_range(mocker):
+    # 新しい順に並んだ 2024-06 から 2024-02 までの access guest を1ページ2件で返す
+    starts = ["2024-06-02", "2024-05-20", "2024-05-03", "2024-04-10", "2024-03-15", "2024-02-01"]
+    items = [
+        {"id": str(i), "attributes": {"name": f"guest{i}", "email": "", "starts_at": f"{d}T08:30:00", "ends_at": f"{d}T13:00:00"}}
+        for i, d in enumerate(starts)
+    ]
+    pages = []
+
+    def api(path, params={}, method="POST", with_metadata=False):
+        pages.append(params["page"])
+        page = params["page"]
+        return items[(page - 1) * 2 : page * 2], {"total_pages": 3}
+
+    r: remotelock.RemoteLock = remotelock.RemoteLock()
+    mocker.patch.object(r, "api", side_effect=api)
+    guests = r.get_access_guests_range(2024, 4, 2024, 5)
+    assert {ym: [g["id"] for g in gs] for ym, gs in guests.items()} == {"2024-05": ["1", "2"], "2024-04": ["3"]}
+    assert guests["2024-05"][0]["timeslots"][0].timeslot == "09:00-13:00"
+    # 2024-03 の guest を読んだところで終わる
+    assert pages == [1, 2, 3]
+
+    pages.clear()
+    assert [g["id"] for g in r.get_access_guests(2024, 6)] == ["0"]
+    assert pages == [1]
+
+
+def test_get_events_since(mocker):
+    # 新しい順に並んだイベントを1ページ2件で返す。occurred_at は UTC
+    events = [
+        ("e5", "unlocked_event", "2024-05-02T01:00:00Z"),
+        ("e4", "autolock_event", "2024-05-01T23:00:00Z"),
+        ("e3", "access_denied", "2024-05-01T00:30:00Z"),
+        ("e2", "unlocked_event", "2024-05-01T00:30:00Z"),
+        ("e1", "unlocked_event", "2024-04-30T15:30:00Z"),
+        ("e0", "unlocked_event", "2024-04-01T00:00:00Z"),
+    ]
+    items = [
+        {"id": i, "type": t, "attributes": {"occurred_at": o, "time_zone": "Asia/Tokyo", "status": "succeeded", "associated_resource_type": "access_guest", "associated_resource_id": "g"}}
+        for i, t, o in events
+    ]
+    pages = []
+
+    def api(path, params={}, method="POST", with_metadata=False):
+        assert params["sort"] == "-occurred_at"
+        pages.append(params["page"])
+        page = params["page"]
+        return items[(page - 1) * 2 : page * 2], {"total_pages": 3}
+
+    r: remotelock.RemoteLock = remotelock.RemoteLock()
+    mocker.patch.object(r, "api", side_effect=api)
+    ret = r.get_events_since("2024-05-01T09:30:00")
+    # ローカル時刻にそろえ、古い順に並べる。watermark と同じ時刻のイベントも返す
+    assert [(e["id"], e["occurred_at"]) for e in ret] == [("e2", "2024-05-01T09:30:00"), ("e3", "2024-05-01T09:30:00"), ("e5", "2024-05-02T10:00:00")]
+    assert ret[0]["user_type"] == "access_guest"
+    # 全て watermark より前のページを読んだところで終わる
+    assert pages == [1, 2, 3]
+
+    pages.clear()
+    assert [e["id"] for e in r.get_events(2024, 5)] == ["e1", "e2", "e3", "e5"]
+
+
+def test_get_token(monkeypatch, mocker):
+    monkeypatch.setenv("RESERVA_CONFIG_FILE", "./tests/unit/config.json")
+    monkeypatch.setenv("RESERVA_CONFIG_REMOTELOCK_TOKEN", '{"access_token": "old", "refresh_token": "r", "expires_at": 0}')
+    remotelock.clear_config()
+    r: remotelock.RemoteLock = remotelock.RemoteLock()
+
+    # 期限切れでも、読み直したトークン (他の Lambda が更新したもの) が有効なら更新しない
+    def renewed(force_fetch=False):
+        if force_fetch:
+            monkeypatch.setenv("RESERVA_CONFIG_REMOTELOCK_TOKEN", f'{{"access_token": "new", "refresh_token": "r2", "expires_at": {int(time.time()) + 3600}}}')
+        return original(force_fetch)
+
+    original = remotelock.get_config
+    mocker.patch.object(remotelock, "get_config", side_effect=renewed)
+    post = mocker.patch.object(remotelock.requests, "post")
+    assert r._RemoteLock__get_token() == "new"
+    post.assert_not_called()
+    remotelock.clear_config()
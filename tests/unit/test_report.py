@@ -0,0 +1,191 @@
+from reserva_request.report import MonthDataset, MonthItem, make_month_dataset_from_used_data, make_calendar_list
+from reserva_request import remotelock, report, storebatch
+from datetime import date
+import calendar
+import json
+from reserva_request.used_data import UsedDataTable, write_partition, write_manifest
+
+
+def test_make_month_dataset_from_used_data(s3bucket):
+    table = UsedDataTable()
+    table.append("0-1", ["2024-05-01T05:00:00.000000", "2024-05-01T09:00:00.000000", "", "", "", "", "", "", "", ""])
+    table.append("0-2", ["2024-05-01T09:00:00.000000", "2024-05-01T13:00:00.000000", "", "", "", "True", "", "体操クラブ", "", "定期予約"])
+    table.append("0-3", ["2024-05-01T13:00:00.000000", "2024-05-01T17:00:00.000000", "a@example.com", "1ブロック", "2組", "False", "False", "山田", "ゲスト", "会議"])
+    write_partition(s3bucket, table, 2024, 5)
+    registered_users = {"a@example.com": {"user_name": "山田花子"}}
+
+    # 月の途中で作られた利用データは使わない
+    write_manifest(s3bucket, {"months": {"2024-05": {"built_at": "2024-05-31T01:00:00"}}})
+    assert make_month_dataset_from_used_data(s3bucket, 2024, 5, registered_users) is None
+
+    write_manifest(s3bucket, {"months": {"2024-05": {"built_at": "2024-06-01T01:00:00"}}})
+    dataset = make_month_dataset_from_used_data(s3bucket, 2024, 5, registered_users)
+    assert [(item.slot.timeslot, item.type, item.name, item.block) for item in dataset.items] == [
+        ("09:00-13:00", "access_user", "体操クラブ", "定期予約(町内会公認団体)"),
+        ("13:00-17:00", "access_guest", "山田花子", "1ブロック 2組 山田"),
+    ]
+
+    # 利用データが無い月
+    assert make_month_dataset_from_used_data(s3bucket, 2024, 4, registered_users) is None
+
+
+
+def test_make_month_dataset_from_used_data_shared_slot(s3bucket):
+    def slot(day: int, start: str, end: str):
+        return remotelock.Slot.from_times(date(2024, 5, day), start, end)
+
+    users = {"a@example.com": {"member_id": "m1", "objective": "会議", "user_name": "山田花子"}}
+    members = {"m1": {"block": "1ブロック", "kumi": "2組", "member_name": "山田"}}
+    access_users = [{"type": "access_user", "name": "体操クラブ", "email": "club@example.com", "timeslots": [slot(7, "09:00", "13:00"), slot(14, "09:00", "13:00")]}]
+    access_guests = [{"type": "access_guest", "name": "ゲスト", "email": "a@example.com", "timeslots": [slot(7, "09:00", "13:00")]}]
+    table, _entry = storebatch.build_month(2024, 5, users, members, access_users, access_guests)
+    write_partition(s3bucket, table, 2024, 5)
+    write_manifest(s3bucket, {"months": {"2024-05": {"built_at": "2024-06-01T01:00:00"}}})
+
+    # 同じ枠に access user と access guest がいても、RemoteLock から作った場合と同じく両方を返す
+    reporter = report.ReservationReporter.__new__(report.ReservationReporter)
+    reporter.target_year, reporter.target_month = 2024, 5
+    reporter.registered_users, reporter.community_members = users, members
+    reporter.access_users, reporter.access_guests = access_users, access_guests
+    dataset = make_month_dataset_from_used_data(s3bucket, 2024, 5, users)
+    assert dataset.to_dict() == reporter.build_month_dataset().to_dict()
+    assert [(item.slot.day, item.type) for item in dataset.items] == [("2024/05/07", "access_user"), ("2024/05/07", "access_guest"), ("2024/05/14", "access_user")]
+
+def test_month_dataset_day_index():
+    def slot(day: int, start: str, end: str):
+        return remotelock.Slot.from_times(date(2024, 5, day), start, end)
+
+    items = [
+        MonthItem(slot(31, "17:00", "21:00"), "access_user", "体操クラブ", "定期予約(町内会公認団体)"),
+        MonthItem(slot(2, "09:00", "13:00"), "access_user", "体操クラブ", "定期予約(町内会公認団体)"),
+        MonthItem(slot(2, "09:00", "13:00"), "access_guest", "山田花子", "1ブロック 2組 山田"),
+        MonthItem(slot(1, "05:00", "09:00"), "access_guest", "山田花子", "1ブロック 2組 山田"),
+    ]
+    dataset = MonthDataset(2024, 5, items)
+    # 枠の順に並び、同じ枠は元の順
+    assert [item.name for item in dataset.items] == ["山田花子", "体操クラブ", "山田花子", "体操クラブ"]
+    assert len(dataset.day_offsets) == 32
+    assert [item.type for item in dataset.day_items(date(2024, 5, 2))] == ["access_user", "access_guest"]
+    assert dataset.day_items(date(2024, 5, 3)) == ()
+    assert dataset.day_items(date(2024, 5, 31))[0].slot == items[0].slot
+    assert dataset.day_items(date(2024, 6, 1)) == ()
+
+    # キャッシュの形式との往復と、days の無い以前の形式
+    data = dataset.to_dict()
+    assert MonthDataset.from_dict(data).items == dataset.items
+    legacy = {"year": 2024, "month": 5, "items": [[item.slot.key, item.type, item.name, item.block] for item in items]}
+    assert MonthDataset.from_dict(legacy).to_dict() == data
+
+    day = make_calendar_list(MonthDataset.from_dict(data), date(2024, 5, 2), "day")
+    assert [(c["icon"], c["description"]) for c in day] == [("repeat", "09:00-13:00 定期予約(町内会公認団体)"), ("person", "09:00-13:00 1ブロック 2組 山田")]
+
+
+# 月初と月末に1件ずつ予約がある月のデータ。get_month_dataset の代わりに返し、呼ばれた月を loaded に記録する
+def fixed_month_datasets(mocker) -> list[tuple[int, int]]:
+    loaded = []
+
+    def get_month_dataset(target_year, target_month, local_ttl, s3_ttl, hard_ttl=None, cache_refresh=False):
+        loaded.append((target_year, target_month))
+        last_day = calendar.monthrange(target_year, target_month)[1]
+        return MonthDataset(
+            target_year,
+            target_month,
+            (
+                MonthItem(remotelock.Slot.from_times(date(target_year, target_month, last_day), "17:00", "21:00"), "access_guest", "山田花子", "1ブロック 2組 山田"),
+                MonthItem(remotelock.Slot.from_times(date(target_year, target_month, 1), "09:00", "13:00"), "access_user", "体操クラブ", "定期予約(町内会公認団体)"),
+            ),
+        )
+
+    mocker.patch.object(report, "get_month_dataset", side_effect=get_month_dataset)
+    mocker.patch.object(report, "get_config")
+    return loaded
+
+
+def range_request(params: dict) -> dict:
+    return report.range_handler({"queryStringParameters": params}, params)
+
+
+def test_range_handler_validation(mocker):
+    loaded = fixed_month_datasets(mocker)
+    res = range_request({"format": "reservation", "from": "2024-01-01"})
+    assert res["statusCode"] == 400 and json.loads(res["body"])["message"] == "missing 'to'"
+    res = range_request({"format": "reservation", "from": "2024-03-01", "to": "2024-02-29"})
+    assert res["statusCode"] == 400 and json.loads(res["body"])["message"] == "invalid range from=2024-03-01, to=2024-02-29"
+    # 2022-01 から 2025-01 は 37 か月
+    res = range_request({"format": "calendar", "from": "2022-01-01", "to": "2025-01-01"})
+    assert res["statusCode"] == 400 and json.loads(res["body"])["message"] == "range must be within 36 months"
+    assert range_request({"format": "calendar", "from": "2022-01-01", "to": "2024-12-31"})["statusCode"] == 200
+    res = range_request({"format": "usage", "from": "2024-01-01", "to": "2024-01-31"})
+    assert res["statusCode"] == 400
+    assert len(loaded) == 36
+
+
+def test_range_handler_items(mocker):
+    fixed_month_datasets(mocker)
+    # 期間の途中から始まる月と途中で終わる月は、期間内の予約だけを返す。月をまたいでも開始時刻の順に並ぶ
+    res = range_request({"format": "reservation", "from": "2024-01-15", "to": "2024-03-10"})
+    assert res["statusCode"] == 200
+    assert res["headers"]["Content-Type"] == "application/x-ndjson;charset=UTF-8"
+    lines = res["body"].splitlines()
+    assert [json.loads(line)["start_time"][:16] for line in lines] == ["2024-01-31T17:00", "2024-02-01T09:00", "2024-02-29T17:00", "2024-03-01T09:00"]
+
+    res = range_request({"format": "calendar", "from": "2024-02-29", "to": "2024-03-01"})
+    assert [json.loads(line) for line in res["body"].splitlines()] == [
+        {"start": "2024-02-29T17:00:00.000000", "title": "山田花子", "color": "secondary"},
+        {"start": "2024-03-01T09:00:00.000000", "title": "体操クラブ", "color": "secondary"},
+    ]
+    # 同じ日の1日だけ
+    res = range_request({"format": "reservation", "from": "2024-02-01", "to": "2024-02-01"})
+    assert [json.loads(line)["name"] for line in res["body"].splitlines()] == ["体操クラブ"]
+
+
+def test_iter_month_datasets_prefetch(mocker):
+    loaded = fixed_month_datasets(mocker)
+    datasets = report.iter_month_datasets(date(2024, 11, 1), date(2025, 3, 31), workers=2)
+    # 最初の月を返した時点では、先の月は workers 件までしか取得していない
+    first = next(datasets)
+    assert (first.year, first.month) == (2024, 11)
+    assert set(loaded) <= {(2024, 11), (2024, 12)}
+    assert [(dataset.year, dataset.month) for dataset in datasets] == [(2024, 12), (2025, 1), (2025, 2), (2025, 3)]
+    assert sorted(loaded) == [(2024, 11), (2024, 12), (2025, 1), (2025, 2), (2025, 3)]
+
+
+def test_load_month_dataset(mocker):
+    fixed_month_datasets(mocker)
+    # handler と同じ期限で月のデータを取得する
+    dataset = report.load_month_dataset(2024, 1, cache_refresh=True)
+    assert (dataset.year, dataset.month, len(dataset.rows)) == (2024, 1, 2)
+    report.get_month_dataset.assert_called_once_with(2024, 1, *report.get_month_dataset_ttls(2024, 1), True)
+
+
+def test_month_dataset_ttls():
+    today = date(2024, 12, 15)
+    assert report.target_month_is_past(2024, 11, today)
+    assert not report.target_month_is_past(2024, 12, today)
+    assert not report.target_month_is_past(2025, 1, today)
+    # 過去の月は長い期限で期限切れの値を使わず、今月と来月は hard_ttl まで前の値を使う
+    assert report.get_month_dataset_ttls(2024, 11, today) == (3600 * 24, 3600 * 24 * 30 * 12 * 100, None)
+    assert report.get_month_dataset_ttls(2024, 12, today) == (3600 * 6, 3600 * 24, 3600 * 24 * 7)
+    assert report.get_month_dataset_ttls(2025, 1, today) == report.get_month_dataset_ttls(2024, 12, today)
+
+
+def test_prewarm_handler(mocker, lambda_context):
+    class FixedDate(date):
+        @classmethod
+        def today(cls):
+            return cls(2025, 1, 10)
+
+    mocker.patch.object(report, "date", FixedDate)
+    fixed_month_datasets(mocker)
+    res = report.prewarm_handler({}, lambda_context)
+    assert [m["month"] for m in json.loads(res["body"])["months"]] == ["2024-12", "2025-01", "2025-02"]
+    prewarmed = report.get_month_dataset.call_args_list
+    assert [call.args[:2] for call in prewarmed] == [(2024, 12), (2025, 1), (2025, 2)]
+    assert all(call.kwargs["cache_refresh"] for call in prewarmed)
+
+    # handler も同じ期限 (キャッシュのキー) で月のデータを読むので、温めたキャッシュが使われる
+    for call in prewarmed:
+        report.get_month_dataset.reset_mock()
+        year, month = call.args[:2]
+        report.handler({"queryStringParameters": {"format": "reservation", "start": f"{year:04}-{month:02}-01"}}, lambda_context)
+        assert report.get_month_dataset.call_args.args[:5] == call.args[:5]
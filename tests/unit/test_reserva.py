@@ -1,5 +1,6 @@
 
 from reserva_request import app, remotelock
+from datetime import date
 import pytest
 
 def read_rsv_info_from_reservation_html_file(filename:str) -> dict[str, str]:
@@ -23,7 +24,65 @@ def test_reserva_html_info():
         read_rsv_info_from_reservation_html_file("./tests/unit/html/reserva_20220812_double_invalid.html")
     assert str(e.value) == "連続していない複数の予約はサポートされていません。予約されている時間帯: [2022/08/12 09:00～13:00] [2022/08/12 17:00～21:00]"
 
-def test_remotelock_rsv_time():
+def test_remotelock_rsv_time(monkeypatch):
+    # SSM を使わずに remotelock_buffer_min を 30 分にする
+    monkeypatch.setenv("RESERVA_CONFIG_FILE", "./tests/unit/config.json")
+    remotelock.clear_config()
     assert get_transformed_rsv_time_from_rsv_info(read_rsv_info_from_reservation_html_file("./tests/unit/html/reserva_20220812_single.html")) == ('2022-08-07T16:30:00', '2022-08-07T21:00:00')
     assert get_transformed_rsv_time_from_rsv_info(read_rsv_info_from_reservation_html_file("./tests/unit/html/reserva_20220812_double.html")) == ('2022-08-12T08:30:00', '2022-08-12T17:00:00')
     assert get_transformed_rsv_time_from_rsv_info(read_rsv_info_from_reservation_html_file("./tests/unit/html/reserva_20220812_triple.html")) == ('2022-08-12T08:30:00', '2022-08-12T21:00:00')
+
+
+def test_handler_invalidates_report_cache_on_error(monkeypatch, mocker, lambda_context):
+    # SSM とスプレッドシートを使わずに handler を動かす
+    def handler_init():
+        monkeypatch.setattr(app, "AUTH_TOKEN", "token", raising=False)
+        monkeypatch.setattr(app, "RESERVA_DAY_RANGE", 60, raising=False)
+        monkeypatch.setattr(app, "workbook", None, raising=False)
+
+    rsv_info = {"hidden_rsv_no": "1", "rsv_time": "2024/05/07 09:00〜13:00", "email": "ichibachonaikai+test@gmail.com", "rsv_status": "申請中"}
+    mocker.patch.object(app, "handler_init", side_effect=handler_init)
+    mocker.patch.object(app, "get_reservation_info_from_reserva", return_value=rsv_info)
+    mocker.patch.object(app.GSpreadsheetUtil, "get_registered_info_from_spreadsheet", return_value={"name": "山田"})
+    mocker.patch.object(app, "RemoteLock")
+    invalidate = mocker.patch.object(app, "invalidate_report_cache")
+    append = mocker.patch.object(app, "append_log_to_spreadsheet")
+    event = {"headers": {"authorization": "token"}, "body": {"command": ["request"], "url": ["https://reserva.be/"]}}
+
+    # 鍵を発行した後に approve が例外になっても、予約を変更した月のキャッシュを無効化する
+    mocker.patch.object(app, "approve", side_effect=RuntimeError("approve failed"))
+    with pytest.raises(RuntimeError):
+        app.handler(event, lambda_context)
+    invalidate.assert_called_once_with(["2024/05/07 09:00〜13:00"])
+
+    # スプレッドシートへの追記が例外になった場合も同じ
+    invalidate.reset_mock()
+    app.approve.side_effect = None
+    app.approve.return_value = "success"
+    append.side_effect = RuntimeError("append failed")
+    with pytest.raises(RuntimeError):
+        app.handler(event, lambda_context)
+    invalidate.assert_called_once_with(["2024/05/07 09:00〜13:00"])
+
+
+def test_batch_handler_invalidates_exception_months(monkeypatch, mocker, lambda_context):
+    monkeypatch.setattr(app, "handler_init", lambda: monkeypatch.setattr(app, "RESERVA_DAY_RANGE", 60, raising=False))
+    mocker.patch.object(app, "reserva_login")
+    users = [
+        {"name": "体操クラブ", "timeslots": [], "exception_timeslots": [{"start_date": "2024-05-18", "end_date": "2024-05-18"}]},
+        {"name": "囲碁クラブ", "timeslots": [remotelock.Slot.from_times(date(2024, 6, 4), "09:00", "13:00")], "exception_timeslots": [{"start_date": "2024-07-02", "end_date": "2024-07-02"}]},
+    ]
+    remotelock_class = mocker.patch.object(app, "RemoteLock")
+    remotelock_class.return_value.get_users.return_value = users
+    invalidate = mocker.patch.object(app, "invalidate_report_cache")
+
+    # Reserva の予約が途中で例外になっても、更新したアクセス不可日の月は無効化する
+    mocker.patch.object(app, "reserva_create_reservation", side_effect=RuntimeError("reserva error"))
+    with pytest.raises(RuntimeError):
+        app.batch_handler({}, lambda_context)
+    invalidate.assert_called_once_with(["2024-05-18"])
+
+    invalidate.reset_mock()
+    app.reserva_create_reservation.side_effect = lambda user, target_list: target_list
+    app.batch_handler({}, lambda_context)
+    invalidate.assert_called_once_with(["2024-05-18", "2024-07-02", "2024/06/04"])
@@ -0,0 +1,42 @@
+from reserva_request.slot import Slot, SLOT_TABLE, classify_time_ranges, slots_from_mask
+from datetime import date
+import pickle
+import pytest
+
+
+def test_slot_views():
+    slot = Slot.from_times(date(2024, 5, 7), "13:00", "17:00")
+    assert slot.index == 2
+    assert slot.date == date(2024, 5, 7)
+    assert slot.day == "2024/05/07"
+    assert slot.iso_date == "2024-05-07"
+    assert slot.timeslot == "13:00-17:00"
+    assert slot.start_time == "2024/05/07 13:00"
+    assert slot.end_time == "2024/05/07 17:00"
+    assert slot.start_time_iso == "2024-05-07T13:00:00.000000"
+    assert slot.end_time_iso == "2024-05-07T17:00:00.000000"
+
+
+def test_slot_value_semantics():
+    ordinal = date(2024, 5, 7).toordinal()
+    slots = [Slot(ordinal + 1, 0), Slot(ordinal, 3), Slot(ordinal, 0)]
+    assert sorted(slots) == [Slot(ordinal, 0), Slot(ordinal, 3), Slot(ordinal + 1, 0)]
+    assert len({Slot(ordinal, 1), Slot(ordinal, 1), Slot.from_key(Slot(ordinal, 1).key)}) == 1
+    assert pickle.loads(pickle.dumps(slots[1])) == slots[1]
+    with pytest.raises(AttributeError):
+        slots[0].key = 0
+    with pytest.raises(ValueError):
+        Slot(ordinal, len(SLOT_TABLE))
+    with pytest.raises(ValueError):
+        Slot.from_times(date(2024, 5, 7), "09:00", "17:00")
+
+
+def test_classify_time_ranges():
+    ordinals, masks = classify_time_ranges(
+        ["2024-05-07T08:30:00", "2024-05-07T04:30:00", "2024-05-07T10:00:00", "2024-05-07T16:30:00", "2024-05-31T16:30:00"],
+        ["2024-05-07T13:00:00", "2024-05-07T17:00:00", "2024-05-07T15:00:01", "2024-05-07T19:00:00", "2024-06-01T01:00:00"],
+    )
+    assert ordinals == [date(2024, 5, 7).toordinal()] * 4 + [date(2024, 5, 31).toordinal()]
+    # 判定時刻 (7:00, 10:00, 15:00, 19:00) をまたぐ枠だけが立つ
+    assert masks == [0b0010, 0b0111, 0b0100, 0b0000, 0b1000]
+    assert [slot.timeslot for slot in slots_from_mask(ordinals[1], masks[1])] == ["05:00-09:00", "09:00-13:00", "13:00-17:00"]
@@ -0,0 +1,143 @@
+from reserva_request import storebatch, remotelock
+from reserva_request.used_data import MANIFEST_KEY, partition_prefix, read_manifest, write_manifest
+from datetime import date
+import json
+import pytest
+
+
+@pytest.fixture
+def offline(s3bucket, monkeypatch, mocker):
+    # SSM と RemoteLock、事前登録シートを使わずに handler を動かす
+    monkeypatch.setenv("RESERVA_CONFIG_FILE", "./tests/unit/config.json")
+    monkeypatch.setenv("RESERVA_CONFIG_RESERVA_BUCKET_INFO", s3bucket.name)
+    remotelock.clear_config()
+    mocker.patch.object(storebatch, "get_all_registered_users", return_value=({}, {}))
+    mocker.patch.object(storebatch.RemoteLock, "get_access_user_records", return_value=[])
+    mocker.patch.object(storebatch.RemoteLock, "get_access_guests_range", return_value={})
+    mocker.patch.object(storebatch.RemoteLock, "get_events_since", return_value=[])
+    yield s3bucket
+    remotelock.clear_config()
+
+
+def invalidated_tags(s3bucket) -> list[str]:
+    return sorted(obj.key for obj in s3bucket.objects.filter(Prefix="cache_tags/"))
+
+
+def test_handler_invalidates_uploaded_months(offline, lambda_context):
+    res = storebatch.handler({"parallel": False}, lambda_context)
+    body = json.loads(res["body"])
+    assert body["message"] == "24 months built"
+    # 初回は全ての月をアップロードし、その月の report のキャッシュを無効化する
+    tags = invalidated_tags(offline)
+    assert len(tags) == 24
+    this_month = date.today().replace(day=1)
+    assert f"cache_tags/month:{this_month.year:04}-{this_month.month:02}.json" in tags
+
+    # 内容が変わらなければアップロードも無効化もしない
+    for obj in offline.objects.filter(Prefix="cache_tags/"):
+        obj.delete()
+    body = json.loads(storebatch.handler({"parallel": False}, lambda_context)["body"])
+    assert len(body["months"]) > 0 and not any(timing["uploaded"] for timing in body["months"])
+    assert invalidated_tags(offline) == []
+    assert read_manifest(offline, MANIFEST_KEY) is not None
+
+
+def test_load_manifest(s3bucket):
+    # マニフェストがあれば一覧せずにそのまま使う
+    s3bucket.Object(f"{partition_prefix(2024, 1)}/meta.json").put(Body=b"{}")
+    write_manifest(s3bucket, {"months": {"2024-03": {"digest": "d"}}})
+    assert storebatch.load_manifest(s3bucket, "partition") == {"months": {"2024-03": {"digest": "d"}}}
+
+
+def test_load_manifest_listing(s3bucket):
+    # マニフェストが無ければ既存の月を一覧してマニフェストを作る (meta.json の無い月は含めない)
+    s3bucket.Object(f"{partition_prefix(2024, 1)}/meta.json").put(Body=b"{}")
+    s3bucket.Object(f"{partition_prefix(2024, 2)}/meta.json").put(Body=b"{}")
+    s3bucket.Object(f"{partition_prefix(2024, 3)}/part-0.json").put(Body=b"{}")
+    s3bucket.Object(storebatch.used_data_s3_key(2023, 12, "pkl")).put(Body=b"")
+    assert storebatch.load_manifest(s3bucket, "partition") == {"months": {"2024-01": {}, "2024-02": {}}}
+    assert storebatch.load_manifest(s3bucket, "pkl") == {"months": {"2023-12": {}}}
+
+
+def test_plan_months():
+    manifest = {"months": {"2024-01": {}, "2024-02": {}, "2024-03": {}}}
+    months = [(2024, 4), (2024, 3), (2024, 2), (2024, 1), (2023, 12)]
+    # 元データが残っている期間は 2024-02-29 から。月末がそれ以降の月は作成し直し、それより古い月はマニフェストにあれば作成しない
+    assert storebatch.plan_months(manifest, months, date(2024, 4, 15), 46) == [(2024, 4), (2024, 3), (2024, 2), (2023, 12)]
+    assert storebatch.plan_months(manifest, months, date(2024, 4, 15), 45) == [(2024, 4), (2024, 3), (2023, 12)]
+
+
+# put したキーだけを記録する S3 バケットの代わり
+class StubBucket:
+    def __init__(self):
+        self.keys = []
+
+    def Object(self, key):
+        bucket = self
+
+        class StubObject:
+            def put(self, **kwargs):
+                bucket.keys.append(key)
+
+        return StubObject()
+
+
+def comparable(results) -> list:
+    # 作成日時と所要時間は実行ごとに変わるので除く
+    return [
+        (y, m, {k: v for k, v in entry.items() if k != "built_at"}, {k: v for k, v in timing.items() if not k in ("build_ms", "upload_ms")})
+        for y, m, entry, timing in results
+    ]
+
+
+def test_build_months_parallel(mocker):
+    bucket = StubBucket()
+    mocker.patch.object(storebatch.boto3, "resource").return_value.Bucket.return_value = bucket
+    users = {"guest@example.com": {"member_id": "m1", "objective": "会議"}}
+    members = {"m1": {"block": "1", "kumi": "2", "member_name": "町内 太郎"}}
+    guest = {"type": "access_guest", "email": "guest@example.com", "name": "ゲスト", "timeslots": [remotelock.Slot.from_times(date(2024, 2, 3), "09:00", "13:00")]}
+    jobs = [(2024, 1, None), (2024, 2, None), (2024, 3, None)]
+    args = (users, members, [], {"2024-02": [guest]}, "test-bucket", "partition")
+
+    sequential = storebatch.build_months(jobs, *args)
+    parallel, errors = storebatch.build_months_parallel(jobs, 2, *args)
+    assert errors == []
+    assert comparable(parallel) == comparable(sequential)
+    assert [timing["uploaded"] for _y, _m, _entry, timing in parallel] == [True, True, True]
+    assert sequential[0][2]["digest"] != sequential[1][2]["digest"]
+
+    # 前回とダイジェストが同じ月はアップロードしない
+    bucket.keys.clear()
+    jobs = [(y, m, entry["digest"] if m != 3 else None) for y, m, entry, _timing in sequential]
+    for results in (storebatch.build_months(jobs, *args), storebatch.build_months_parallel(jobs, 2, *args)[0]):
+        assert [timing["uploaded"] for _y, _m, _entry, timing in results] == [False, False, True]
+    # 子プロセスのアップロードは親の StubBucket には残らないので、直列の分だけを確かめる
+    assert bucket.keys == [f"{partition_prefix(2024, 3)}/data.bin", f"{partition_prefix(2024, 3)}/meta.json"]
+
+
+def test_build_months_parallel_partial_failure(mocker):
+    mocker.patch.object(storebatch.boto3, "resource").return_value.Bucket.return_value = StubBucket()
+    # 2024-02 の access guest は事前登録に無いので、2024-02 を作成する子プロセスだけが失敗する
+    guest = {"type": "access_guest", "email": "unknown@example.com", "name": "ゲスト", "timeslots": [remotelock.Slot.from_times(date(2024, 2, 3), "09:00", "13:00")]}
+    jobs = [(2024, 1, None), (2024, 2, None), (2024, 3, None)]
+    results, errors = storebatch.build_months_parallel(jobs, 2, {}, {}, [], {"2024-02": [guest]}, "test-bucket", "partition")
+    assert [(y, m) for y, m, _entry, _timing in results] == [(2024, 1), (2024, 3)]
+    assert len(errors) == 1 and "Cannot find member for unknown@example.com" in errors[0]
+
+
+def test_handler_records_months_before_failure(offline, lambda_context, mocker):
+    # 並列に作成した月の一部が失敗した
+    def build_months_parallel(jobs, processes, *args):
+        results = storebatch.build_months([job for job in jobs if job[:2] != failed], *args)
+        return results, ["Traceback: worker failed"]
+
+    this_month = date.today().replace(day=1)
+    failed = (this_month.year, this_month.month)
+    mocker.patch.object(storebatch.os, "cpu_count", return_value=2)
+    mocker.patch.object(storebatch, "build_months_parallel", side_effect=build_months_parallel)
+    with pytest.raises(RuntimeError):
+        storebatch.handler({}, lambda_context)
+    # 作成できた月はマニフェストに記録し、キャッシュを無効化してある
+    months = read_manifest(offline, MANIFEST_KEY)["months"]
+    assert len(months) == 23 and not f"{this_month.year:04}-{this_month.month:02}" in months
+    assert len(invalidated_tags(offline)) == 23
@@ -0,0 +1,81 @@
+from reserva_request.usage import make_usage_report
+from reserva_request.used_data import UsedDataTable
+from reserva_request.events import iso_minute
+
+
+def make_row(slot_start: str, block: str = "", kumi: str = "", official: str = "", user_name: str = "", guest_name: str = "") -> list:
+    return [f"{slot_start}:00.000000", "", "", block, kumi, official, "False" if user_name else "", user_name, guest_name, ""]
+
+
+def test_make_usage_report():
+    table = UsedDataTable()
+    rows = [
+        # 2024-04 は料金の対象外
+        make_row("2024-04-30T09:00", "1ブロック", "2組", "False", "山田", "g1"),
+        make_row("2024-04-30T13:00"),
+        make_row("2024-05-01T09:00", "1ブロック", "2組", "False", "山田", "g2"),
+        make_row("2024-05-01T13:00", "1ブロック", "2組", "False", "山田", "g3"),
+        make_row("2024-05-02T09:00", "2ブロック", "公認団体", "True", "体操クラブ", "g4"),
+        make_row("2024-05-02T13:00", official="True", user_name="囲碁の会"),
+        make_row("2024-05-02T17:00"),
+        make_row("2024-05-03T09:00"),
+    ]
+    for i, row in enumerate(rows):
+        table.append(str(i), row)
+
+    report = make_usage_report(table)
+    assert report["members"][0] == {
+        "block": "1ブロック",
+        "kumi": "2組",
+        "member_name": "山田",
+        "slots": 3,
+        "billable_slots": 2,
+        "fee": 1000,
+        "months": {"2024-04": 1, "2024-05": 2},
+    }
+    # 公認団体は請求しない
+    assert report["members"][1]["fee"] == 0
+    assert report["total_fee"] == 1000
+    assert [(b["block"], b["kumi"], b["slots"], b["fee"]) for b in report["blocks"]] == [("1ブロック", "2組", 3, 1000), ("2ブロック", "公認団体", 1, 0)]
+    assert report["groups"] == [{"name": "囲碁の会", "slots": 1}]
+    assert [(m["month"], m["slots"], m["reserved_slots"], m["rate"]) for m in report["utilization"]["months"]] == [("2024-04", 2, 1, 0.5), ("2024-05", 6, 4, 0.6667)]
+    assert report["utilization"]["total"]["reserved_slots"] == 5
+
+
+def test_make_usage_report_empty():
+    report = make_usage_report(UsedDataTable())
+    assert report["members"] == [] and report["groups"] == []
+    assert report["utilization"]["total"]["slots"] == 0
+
+
+def test_make_usage_report_unlocks():
+    table = UsedDataTable()
+    rows = [
+        make_row("2024-05-01T09:00", "1ブロック", "2組", "False", "山田", "g1"),
+        make_row("2024-05-01T13:00", "1ブロック", "2組", "False", "山田", "g2"),
+        make_row("2024-05-01T17:00"),
+        make_row("2024-06-01T09:00", official="True", user_name="囲碁の会"),
+    ]
+    for i, row in enumerate(rows):
+        row[1] = row[0][:11] + {"05": "09", "09": "13", "13": "17", "17": "21"}[row[0][11:13]] + ":00:00.000000"
+        table.append(str(i), row)
+    events = {
+        "id": ["e1", "e2", "e3"],
+        "occurred_at": ["2024-05-01T08:45:00", "2024-05-01T16:45:00", "2024-06-01T09:10:00"],
+        "minute": [iso_minute("2024-05-01T08:45:00"), iso_minute("2024-05-01T16:45:00"), iso_minute("2024-06-01T09:10:00")],
+        "event_type": ["unlocked_event", "access_denied", "unlocked_event"],
+        "status": ["succeeded", "", "succeeded"],
+        "user_type": ["access_guest", "access_guest", "access_user"],
+        "user_id": ["g1", "g2", "u1"],
+    }
+
+    # 2024-06 はイベントストアに無い月として扱う
+    unlocks = make_usage_report(table, events, ["2024-05"], 30)["unlocks"]
+    assert unlocks["months"] == [{"month": "2024-05", "reserved_slots": 2, "active_slots": 1, "inactive_slots": 1, "failed_unlocks": 1, "active_rate": 0.5}]
+    assert [(n["slot_start"][:16], n["user_name"]) for n in unlocks["inactive_reservations"]] == [("2024-05-01T13:00", "山田")]
+    assert [f["occurred_at"] for f in unlocks["failed_unlocks"]] == ["2024-05-01T16:45:00"]
+
+    # 解錠した人が予約者かどうかは見ないので、他の人 (access user) の解錠でも枠は active になる
+    events = {column: values + [value] for (column, values), value in zip(events.items(), ["e4", "2024-05-01T12:50:00", iso_minute("2024-05-01T12:50:00"), "unlocked_event", "succeeded", "access_user", "u1"])}
+    unlocks = make_usage_report(table, events, ["2024-05"], 30)["unlocks"]
+    assert unlocks["months"][0]["active_slots"] == 2 and unlocks["inactive_reservations"] == []
@@ -0,0 +1,57 @@
+from reserva_request.used_data import COLUMNS, UsedDataTable, encode_partition, decode_partition, write_partition, read_used_data
+from datetime import date
+
+
+def make_table(year: int = 2024, month: int = 5) -> UsedDataTable:
+    table = UsedDataTable()
+    for day in range(2):
+        iso = f"{year:04}-{month:02}-{day + 1:02}"
+        table.append(f"{day}-1", [f"{iso}T05:00:00.000000", f"{iso}T09:00:00.000000", "", "", "", "", "", "", "", ""])
+        table.append(f"{day}-2", [f"{iso}T09:00:00.000000", f"{iso}T13:00:00.000000", "a@example.com", "1ブロック", "1組", "False", "False", "山田", "山田花子", "会議"])
+    return table
+
+
+def test_used_data_table_dataframe():
+    df = make_table().to_dataframe()
+    assert list(df.columns) == COLUMNS
+    assert list(df.index) == ["0-1", "0-2", "1-1", "1-2"]
+    assert df.loc["0-2", "user_name"] == "山田"
+    assert all(dtype == object for dtype in df.dtypes)
+
+
+def test_partition_roundtrip():
+    table = make_table()
+    meta, data = encode_partition(table, 2024, 5)
+    assert meta["num_rows"] == 4
+    stats = {c["name"]: c["stats"] for c in meta["columns"]}
+    assert stats["user_email"] == {"min": "a@example.com", "max": "a@example.com", "empty_count": 2, "distinct_count": 2}
+    assert stats["slot_start"]["min"] == "2024-05-01T05:00:00.000000"
+
+    reads = []
+
+    def read_range(offset, length):
+        reads.append((offset, length))
+        return data[offset : offset + length]
+
+    loaded = decode_partition(meta, read_range)
+    assert loaded.index == table.index
+    assert loaded.columns == table.columns
+
+    # 列を指定した場合はその列までしか読まない
+    reads.clear()
+    loaded = decode_partition(meta, read_range, ["slot_start"])
+    assert list(loaded.columns) == ["slot_start"]
+    assert reads[0][0] + reads[0][1] < len(data)
+
+
+def test_read_used_data(s3bucket):
+    write_partition(s3bucket, make_table(2024, 4), 2024, 4)
+    write_partition(s3bucket, make_table(2024, 5), 2024, 5)
+
+    table = read_used_data(s3bucket, date(2024, 3, 1), date(2024, 5, 31))
+    assert len(table) == 8
+
+    # 日付と列で絞り込む
+    table = read_used_data(s3bucket, date(2024, 4, 2), date(2024, 5, 1), ["user_email"])
+    assert list(table.columns) == ["user_email"]
+    assert table.columns["user_email"] == ["", "a@example.com", "", "a@example.com"]
@@ -0,0 +1,67 @@
+from reserva_request.util import ret_json_cacheable, choose_encoding, get_cache_bucket, response_encoders
+from reserva_request import remotelock
+from concurrent.futures import ThreadPoolExecutor
+import base64
+import gzip
+import json
+
+
+def test_ret_json_cacheable_etag():
+    data = [{"date": "2024-05-07", "timeslot": "09:00-13:00", "name": "山田"}]
+    res = ret_json_cacheable({"headers": {}}, data, "private, no-cache")
+    assert res["statusCode"] == 200
+    assert json.loads(res["body"]) == data
+    assert res["headers"]["Cache-Control"] == "private, no-cache"
+    etag = res["headers"]["ETag"]
+
+    # 同じ内容なら 304 で本文を返さない
+    res = ret_json_cacheable({"headers": {"If-None-Match": etag}}, data, "private, no-cache")
+    assert res["statusCode"] == 304 and res["body"] == ""
+    res = ret_json_cacheable({"headers": {"if-none-match": '"other", ' + etag.removeprefix("W/")}}, data, "private, no-cache")
+    assert res["statusCode"] == 304
+    res = ret_json_cacheable({"headers": {"if-none-match": etag}}, data + data, "private, no-cache")
+    assert res["statusCode"] == 200
+
+
+def test_ret_json_cacheable_gzip():
+    data = [{"date": "2024-05-07", "timeslot": "09:00-13:00", "name": "山田"}] * 100
+    res = ret_json_cacheable({"headers": {"accept-encoding": "gzip, deflate"}}, data, "private, no-cache")
+    assert res["isBase64Encoded"] and res["headers"]["Content-Encoding"] == "gzip"
+    assert json.loads(gzip.decompress(base64.b64decode(res["body"]))) == data
+    # 小さい本文は圧縮しない
+    res = ret_json_cacheable({"headers": {"accept-encoding": "gzip"}}, data[:1], "private, no-cache")
+    assert not "Content-Encoding" in res["headers"]
+
+
+def test_choose_encoding():
+    encoders = {"gzip": None, "br": None}
+    assert choose_encoding("gzip, deflate, br", encoders) == "br"
+    assert choose_encoding("gzip, br;q=0", encoders) == "gzip"
+    assert choose_encoding("br", {"gzip": None}) is None
+    assert choose_encoding("*", {"gzip": None}) == "gzip"
+    assert choose_encoding("", encoders) is None
+
+
+def test_get_cache_bucket_per_thread(monkeypatch):
+    monkeypatch.setenv("RESERVA_CONFIG_FILE", "./tests/unit/config.json")
+    monkeypatch.setenv("RESERVA_CONFIG_RESERVA_BUCKET_INFO", "test-bucket")
+    remotelock.clear_config()
+    # 同じスレッドでは同じバケットを使い、スレッドごとに別のセッションから作る
+    bucket = get_cache_bucket()
+    assert get_cache_bucket() is bucket
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        other = executor.submit(get_cache_bucket).result()
+    assert other is not bucket
+    assert other.name == bucket.name == "test-bucket"
+    assert other.meta.client is not bucket.meta.client
+    remotelock.clear_config()
+
+
+def test_response_encoders_resolved_once(mocker):
+    response_encoders.cache_clear()
+    encoders = response_encoders()
+    assert "gzip" in encoders
+    # 2回目以降は brotli の import を試さずに同じものを返す
+    import_module = mocker.patch("builtins.__import__", side_effect=AssertionError("import attempted"))
+    assert response_encoders() is encoders
+    import_module.assert_not_called()